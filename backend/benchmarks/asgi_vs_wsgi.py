@@ -0,0 +1,138 @@
+"""
+Compares the WSGI app from create_app with the ASGI app from flaskr.asgi.
+
+Both apps are driven in-process against the same SQLite file, so the numbers
+measure the serving model rather than the network: the WSGI app on a pool of
+`--concurrency` threads, the ASGI app with `--concurrency` asyncio tasks.
+
+    python benchmarks/asgi_vs_wsgi.py --questions 10000 --requests 2000 --concurrency 50
+
+Needs aiosqlite for the ASGI app.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import CATEGORIES, seed  # noqa: E402
+
+
+def workload(count):
+    # (method, path, body) in a fixed mix of listing, category and quiz reads
+    rng = random.Random(0)
+    requests = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.3:
+            requests.append(("GET", "/questions", "page={}".format(rng.randint(1, 20)), None))
+        elif kind < 0.5:
+            requests.append(("GET", "/categories/{}/questions".format(
+                rng.randint(1, len(CATEGORIES))), "", None))
+        elif kind < 0.6:
+            requests.append(("GET", "/categories", "", None))
+        else:
+            requests.append(("POST", "/quizzes", "", json.dumps({
+                "previous_questions": [],
+                "quiz_category": {"id": rng.randint(1, len(CATEGORIES))},
+            })))
+    return requests
+
+
+def run_wsgi(app, requests, concurrency):
+    client = app.test_client()
+
+    def call(request):
+        method, path, query, body = request
+        started = time.perf_counter()
+        client.open(path, method=method, query_string=query, data=body,
+                    content_type="application/json")
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(call, requests))
+    return time.perf_counter() - started, latencies
+
+
+async def run_asgi(app, requests, concurrency):
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    latencies = []
+
+    async def call(request):
+        method, path, query, body = request
+        body = (body or "").encode("utf-8")
+        scope = {
+            "type": "http", "method": method, "path": path, "root_path": "",
+            "query_string": query.encode("latin-1"), "http_version": "1.1",
+            "headers": [(b"content-type", b"application/json")],
+        }
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            pass
+
+        started = time.perf_counter()
+        await app(scope, receive, send)
+        latencies.append(time.perf_counter() - started)
+
+    async def worker():
+        while not queue.empty():
+            await call(queue.get_nowait())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await app.db.close()
+    return elapsed, latencies
+
+
+def report(name, elapsed, latencies):
+    latencies = sorted(latencies)
+    percentile = statistics.quantiles(latencies, n=100)
+    print("{:5} {:8.0f} req/s  p50 {:6.2f}ms  p95 {:6.2f}ms".format(
+        name, len(latencies) / elapsed, percentile[49] * 1000, percentile[94] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--questions", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "trivia.db")
+    # models reads the database URI when it is imported
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    from flaskr import create_app
+    from flaskr.asgi import create_asgi_app
+    from models import db
+
+    config = {
+        "RESPONSE_CACHE_SIZE": 0,
+        "ASYNC_POOL_MAX_SIZE": args.concurrency,
+    }
+    requests = workload(args.requests)
+
+    wsgi_app = create_app(config)
+    with wsgi_app.app_context():
+        seed(db.engine, args.questions)
+    report("wsgi", *run_wsgi(wsgi_app, requests, args.concurrency))
+    asgi_app = create_asgi_app(config)
+    report("asgi", *asyncio.run(run_asgi(asgi_app, requests, args.concurrency)))
+
+
+if __name__ == "__main__":
+    main()
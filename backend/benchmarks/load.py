@@ -0,0 +1,348 @@
+"""
+Load test for every route of the trivia API.
+
+Drives a weighted mix of requests from `--concurrency` threads and reports
+p50/p95/p99 latency per route, overall throughput and peak memory:
+
+    python benchmarks/load.py --questions 100k --requests 5000 --concurrency 32
+
+By default a SQLite bank of `--questions` is generated in a temporary
+directory and the app from create_app is called in-process; `--storage
+memory` generates it in the in-memory backend instead. `--url` sends
+the same mix over HTTP to a running server instead (seed it with seed.py).
+
+`--save FILE` keeps the results as a baseline; `--baseline FILE` compares
+against one and exits with status 1 when a route's p95 or the throughput
+is more than `--threshold` worse.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import CATEGORIES, WORDS, parse_size, seed  # noqa: E402
+
+
+class AppClient:
+    """Calls the Flask app in-process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, content_type="application/json"):
+        response = self.client.open(
+            path, method=method, data=body, content_type=content_type)
+        return response.status_code, response.data
+
+
+class HttpClient:
+    """Sends requests to a running server, one connection per thread."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, content_type="application/json"):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host)
+        headers = {"Content-Type": content_type} if body is not None else {}
+        try:
+            connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.local.connection = None
+            connection.close()
+            raise
+
+
+# Scenarios are fn(client, rng, record); record(route, method, path, ...)
+# times one request and returns (status, body).
+
+def list_categories(client, rng, record):
+    record("GET /categories", "GET", "/categories")
+
+
+def list_questions(client, rng, record):
+    record("GET /questions", "GET", "/questions?page={}".format(rng.randint(1, 50)))
+
+
+def list_questions_by_cursor(client, rng, record):
+    status, body = record("GET /questions", "GET", "/questions")
+    if status == 200:
+        cursor = json.loads(body)["next_cursor"]
+        if cursor:
+            record("GET /questions?cursor", "GET", "/questions?cursor=" + cursor)
+
+
+def list_category_questions(client, rng, record):
+    record("GET /categories/<id>/questions", "GET", "/categories/{}/questions?page={}".format(
+        rng.randint(1, len(CATEGORIES)), rng.randint(1, 5)))
+
+
+def category_stats(client, rng, record):
+    record("GET /categories/stats", "GET", "/categories/stats")
+
+
+def suggest_questions(client, rng, record):
+    # typeahead: one request per letter typed, each extending the last
+    word = rng.choice(WORDS)
+    for end in range(2, min(len(word), 5) + 1):
+        record("GET /questions/suggest", "GET", "/questions/suggest?prefix=" + word[:end])
+
+
+def poll_question_changes(client, rng, record):
+    status, body = record("GET /questions/changes", "GET", "/questions/changes")
+    if status == 200:
+        since = max(0, json.loads(body)["latest_seq"] - rng.randint(0, 50))
+        record("GET /questions/changes?since", "GET",
+               "/questions/changes?since={}".format(since))
+
+
+def search_questions(client, rng, record):
+    term = " ".join(rng.choice(WORDS)[:rng.randint(3, 6)] for _ in range(rng.randint(1, 2)))
+    record("POST /questions/search", "POST", "/questions/search",
+           json.dumps({"search_term": term}))
+
+
+def play_quiz(client, rng, record):
+    category_id = rng.randint(0, len(CATEGORIES))
+    previous = []
+    for _ in range(5):
+        status, body = record("POST /quizzes", "POST", "/quizzes", json.dumps({
+            "previous_questions": previous,
+            "quiz_category": {"id": category_id},
+        }))
+        question = json.loads(body)["question"] if status == 200 else None
+        if question is None:
+            return
+        previous.append(question["id"])
+
+
+def play_quiz_session(client, rng, record):
+    status, body = record("POST /quizzes/sessions", "POST", "/quizzes/sessions", json.dumps({
+        "quiz_category": {"id": rng.randint(0, len(CATEGORIES))}}))
+    if status != 200:
+        return
+    session_id = json.loads(body)["session_id"]
+    for _ in range(5):
+        record("POST /quizzes/sessions/<id>/next", "POST",
+               "/quizzes/sessions/{}/next".format(session_id))
+
+
+def create_and_delete_question(client, rng, record):
+    status, body = record("POST /questions", "POST", "/questions", json.dumps({
+        "question": "Load test question?", "answer": "Answer",
+        "category": rng.randint(1, len(CATEGORIES)), "difficulty": rng.randint(1, 5)}))
+    if status == 200:
+        record("DELETE /questions/<id>", "DELETE",
+               "/questions/{}".format(json.loads(body)["created"]))
+
+
+def batch_write_and_delete_questions(client, rng, record):
+    status, body = record("POST /questions/batch", "POST", "/questions/batch", json.dumps({
+        "operations": [{"op": "insert", "question": {
+            "question": "Batch load test question?", "answer": "Answer",
+            "category": rng.randint(1, len(CATEGORIES)), "difficulty": rng.randint(1, 5),
+        }} for _ in range(5)]}))
+    if status != 200:
+        return
+    created = json.loads(body)["created"]
+    record("POST /questions/batch", "POST", "/questions/batch", json.dumps({
+        "operations": [{"op": "update", "id": id, "question": {"difficulty": rng.randint(1, 5)}}
+                       for id in created]}))
+    record("DELETE /questions?ids", "DELETE",
+           "/questions?ids=" + ",".join(str(id) for id in created))
+
+
+def bulk_import(client, rng, record):
+    rows = "".join(json.dumps({
+        "question": "Bulk load test question?", "answer": "Answer",
+        "category": rng.randint(1, len(CATEGORIES)), "difficulty": rng.randint(1, 5),
+    }) + "\n" for _ in range(20))
+    record("POST /questions/bulk", "POST", "/questions/bulk", rows,
+           content_type="application/x-ndjson")
+
+
+def export_questions(client, rng, record):
+    record("GET /questions/export", "GET", "/questions/export?format=ndjson")
+
+
+def read_metrics(client, rng, record):
+    record("GET /metrics", "GET", "/metrics")
+
+
+# (scenario, weight); every route in flaskr/__init__.py is covered
+SCENARIOS = [
+    (list_categories, 10),
+    (category_stats, 2),
+    (list_questions, 15),
+    (list_questions_by_cursor, 5),
+    (list_category_questions, 15),
+    (search_questions, 15),
+    (suggest_questions, 5),
+    (poll_question_changes, 3),
+    (play_quiz, 15),
+    (play_quiz_session, 10),
+    (create_and_delete_question, 5),
+    (batch_write_and_delete_questions, 2),
+    (bulk_import, 1),
+    (export_questions, 1),
+    (read_metrics, 1),
+]
+
+
+def percentile(values, fraction):
+    # nearest rank on sorted values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run(client, iterations, concurrency, random_seed=0):
+    """Runs `iterations` scenarios and returns the results dict."""
+    rng = random.Random(random_seed)
+    scenarios = [scenario for scenario, weight in SCENARIOS]
+    weights = [weight for scenario, weight in SCENARIOS]
+    plan = [(rng.randrange(2 ** 31), rng.choices(scenarios, weights)[0])
+            for _ in range(iterations)]
+
+    lock = threading.Lock()
+    latencies = {}
+    errors = {}
+
+    def record(route, method, path, body=None, content_type="application/json"):
+        started = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body, content_type)
+        except (OSError, http.client.HTTPException):
+            # connection failures count as server errors
+            status, data = 599, b""
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.setdefault(route, []).append(elapsed)
+            if status >= 500:
+                errors[route] = errors.get(route, 0) + 1
+        return status, data
+
+    def call(item):
+        scenario_seed, scenario = item
+        scenario(client, random.Random(scenario_seed), record)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(call, plan))
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for route, values in sorted(latencies.items()):
+        values.sort()
+        routes[route] = {
+            "requests": len(values),
+            "errors": errors.get(route, 0),
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+        }
+    total = sum(route["requests"] for route in routes.values())
+    return {
+        "routes": routes,
+        "requests": total,
+        "seconds": elapsed,
+        "throughput": total / elapsed,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def report(results):
+    print("{:36} {:>8} {:>6} {:>9} {:>9} {:>9}".format(
+        "route", "requests", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    for route, stats in results["routes"].items():
+        print("{:36} {:8} {:6} {:9.2f} {:9.2f} {:9.2f}".format(
+            route, stats["requests"], stats["errors"],
+            stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+    print("{} requests in {:.1f}s, {:.0f} req/s, peak memory {:.0f} MB".format(
+        results["requests"], results["seconds"], results["throughput"],
+        results["max_rss_mb"]))
+
+
+def regressions(results, baseline, threshold):
+    # Returns a list of messages, one per metric that got worse than allowed.
+    found = []
+    for route, before in baseline["routes"].items():
+        after = results["routes"].get(route)
+        if after is None:
+            continue
+        if after["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            found.append("{} p95 {:.2f}ms, baseline {:.2f}ms".format(
+                route, after["p95_ms"], before["p95_ms"]))
+        if after["errors"] > before["errors"]:
+            found.append("{} {} server errors, baseline {}".format(
+                route, after["errors"], before["errors"]))
+    if results["throughput"] < baseline["throughput"] * (1 - threshold):
+        found.append("throughput {:.0f} req/s, baseline {:.0f} req/s".format(
+            results["throughput"], baseline["throughput"]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--questions", type=parse_size, default="10k",
+                        help="size of the generated bank: 10k, 100k, 1m or a number")
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="number of scenarios to run")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--url", help="base URL of a running server")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite",
+                        help="storage backend of the in-process app")
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare with saved results")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown against the baseline (default 0.2)")
+    args = parser.parse_args()
+
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "trivia.db")
+        # models reads the database URI when it is imported
+        os.environ["DATABASE_URL"] = "sqlite:///" + path
+        from flaskr import create_app
+        from models import db
+
+        app = create_app({"STORAGE": args.storage})
+        with app.app_context():
+            seed(db.engine, args.questions)
+        client = AppClient(app)
+
+    results = run(client, args.requests, args.concurrency)
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.threshold)
+        for message in found:
+            print("REGRESSION " + message)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
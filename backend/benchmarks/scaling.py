@@ -0,0 +1,102 @@
+"""
+Throughput of the pre-fork server by number of workers.
+
+Generates a SQLite bank of `--questions`, then for each count in
+`--workers` starts `python -m flaskr.server` on it and drives the request
+mix of load.py over HTTP from `--concurrency` threads:
+
+    python benchmarks/scaling.py --questions 100k --workers 1,2,4,8 --requests 5000
+
+Prints requests per second and the speedup over the first count. Run the
+load from another machine, or leave it cores to spare, or the client will
+be what is measured.
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from load import HttpClient, run  # noqa: E402
+from seed import parse_size, seed  # noqa: E402
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/categories")
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server on port {} did not start".format(port))
+
+
+def measure(env, workers, threads, requests, concurrency):
+    port = free_port()
+    env = dict(env, WORKERS=str(workers), THREADS=str(threads), PORT=str(port))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "flaskr.server"], cwd=BACKEND, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port)
+        return run(HttpClient("http://127.0.0.1:{}".format(port)), requests, concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--questions", type=parse_size, default="10k",
+                        help="size of the generated bank: 10k, 100k, 1m or a number")
+    parser.add_argument("--workers", default="1,2,4",
+                        help="comma separated worker counts")
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker")
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="number of scenarios per run")
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "trivia.db")
+    # models reads the database URI when it is imported
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    from flaskr import create_app
+    from models import db
+
+    app = create_app({"STORAGE": "sqlite"})
+    with app.app_context():
+        seed(db.engine, args.questions)
+        db.engine.dispose()
+
+    # the workers share quiz sessions through a file next to the bank
+    env = dict(os.environ, STORAGE="sqlite",
+               QUIZ_SESSION_PATH=os.path.join(os.path.dirname(path), "sessions.db"))
+    print("{:>7} {:>9} {:>8} {:>8}".format("workers", "req/s", "speedup", "errors"))
+    first = None
+    for workers in [int(count) for count in args.workers.split(",")]:
+        results = measure(env, workers, args.threads, args.requests, args.concurrency)
+        first = first or results["throughput"]
+        errors = sum(route["errors"] for route in results["routes"].values())
+        print("{:7} {:9.0f} {:7.2f}x {:8}".format(
+            workers, results["throughput"], results["throughput"] / first, errors))
+
+
+if __name__ == "__main__":
+    main()
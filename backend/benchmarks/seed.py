@@ -0,0 +1,108 @@
+"""
+Fills the configured database with a synthetic question bank.
+
+    DATABASE_URL=sqlite:////tmp/trivia.db python benchmarks/seed.py --questions 100000 --reset
+
+The bank is generated from a fixed seed, so runs against the same size are
+comparable. Works on SQLite and PostgreSQL.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+CATEGORIES = ["Science", "Art", "Geography", "History", "Entertainment", "Sports"]
+SIZES = {"10k": 10000, "100k": 100000, "1m": 1000000}
+
+# a small vocabulary, so searches match a realistic share of the bank
+WORDS = (
+    "which what who where when how many first largest smallest river mountain "
+    "painter novel planet element city country ocean king queen war treaty "
+    "album film team player record speed light sound energy atom cell gene "
+    "empire island desert forest bridge tower museum composer opera poem "
+    "equation theory engine rocket moon star galaxy language capital border"
+).split()
+
+
+def questions(count, rng):
+    # yields (question, answer, category, difficulty) rows
+    for _ in range(count):
+        question = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 12)))
+        answer = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+        yield (question.capitalize() + "?", answer.title(),
+               rng.randint(1, len(CATEGORIES)), rng.randint(1, 5))
+
+
+def seed(engine, count, reset=False, batch_size=10000, random_seed=0):
+    """Inserts `count` generated questions, and the categories if missing.
+
+    With reset the existing questions and categories are deleted first.
+    Call it inside an app context so that app's caches see the new rows.
+    Returns the number of questions in the table afterwards.
+    """
+    from models import Category, Question, QuestionChange, notify_question_listeners
+
+    rng = random.Random(random_seed)
+    with engine.begin() as connection:
+        if reset:
+            connection.execute(Question.__table__.delete())
+            connection.execute(Category.__table__.delete())
+        existing = {row[0] for row in connection.execute(Category.__table__.select())}
+        missing = [
+            {"id": position + 1, "type": name}
+            for position, name in enumerate(CATEGORIES) if position + 1 not in existing
+        ]
+        if missing:
+            connection.execute(Category.__table__.insert(), missing)
+
+    batch = []
+    for question, answer, category, difficulty in questions(count, rng):
+        batch.append({"question": question, "answer": answer,
+                      "category": category, "difficulty": difficulty})
+        if len(batch) == batch_size:
+            with engine.begin() as connection:
+                connection.execute(Question.__table__.insert(), batch)
+            batch = []
+    if batch:
+        with engine.begin() as connection:
+            connection.execute(Question.__table__.insert(), batch)
+    # clients following GET /questions/changes reload their copy
+    with engine.begin() as connection:
+        connection.execute(QuestionChange.__table__.insert(), {"action": "reload"})
+
+    # in-process caches of an app built before seeding reload the bank
+    notify_question_listeners("reload", None)
+    with engine.connect() as connection:
+        return connection.execute(
+            Question.__table__.count()).scalar()
+
+
+def parse_size(value):
+    return SIZES.get(value.lower()) or int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--questions", type=parse_size, default="10k",
+                        help="10k, 100k, 1m or a number")
+    parser.add_argument("--reset", action="store_true",
+                        help="delete the existing questions and categories first")
+    args = parser.parse_args()
+
+    from flaskr import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        started = time.perf_counter()
+        total = seed(db.engine, args.questions, reset=args.reset)
+    print("seeded {} questions in {:.1f}s, {} in the bank".format(
+        args.questions, time.perf_counter() - started, total))
+
+
+if __name__ == "__main__":
+    main()
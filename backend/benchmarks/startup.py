@@ -0,0 +1,88 @@
+"""
+Reports where worker start-up time goes.
+
+Imports flaskr in a fresh interpreter with `python -X importtime`, then
+lists the slowest imports and the time spent per top-level package, and
+times create_app() with and without LAZY_INIT:
+
+    python benchmarks/startup.py --top 20
+
+create_app runs against DATABASE_URL, or an in-memory SQLite database when
+it is not set.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIME_CREATE_APP = """
+import os, time
+started = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app()
+built = time.perf_counter()
+print("{:.1f} {:.1f}".format((imported - started) * 1000, (built - imported) * 1000))
+"""
+
+
+def import_times(environ):
+    # Returns [(module, self_us, cumulative_us)] for `import flaskr`.
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import flaskr"],
+        cwd=BACKEND, env=environ, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def create_app_times(environ, lazy):
+    environ = dict(environ, LAZY_INIT="1" if lazy else "0")
+    result = subprocess.run(
+        [sys.executable, "-c", TIME_CREATE_APP],
+        cwd=BACKEND, env=environ, capture_output=True, text=True, check=True)
+    imported, built = result.stdout.split()
+    return float(imported), float(built)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--top", type=int, default=15, help="number of imports listed")
+    args = parser.parse_args()
+
+    environ = dict(os.environ)
+    environ.setdefault("DATABASE_URL", "sqlite://")
+
+    imports = import_times(environ)
+    total = next(cumulative for name, self_us, cumulative in imports if name == "flaskr")
+    print("import flaskr: {:.1f}ms".format(total / 1000))
+
+    print("\nslowest imports (cumulative)")
+    for name, self_us, cumulative in sorted(
+            imports, key=lambda item: item[2], reverse=True)[:args.top]:
+        print("  {:8.1f}ms  {}".format(cumulative / 1000, name))
+
+    packages = {}
+    for name, self_us, cumulative in imports:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    print("\nby package (self time)")
+    for package, self_us in sorted(
+            packages.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print("  {:8.1f}ms  {}".format(self_us / 1000, package))
+
+    print("\ncreate_app")
+    for lazy in (False, True):
+        imported, built = create_app_times(environ, lazy)
+        print("  LAZY_INIT={}  import {:.1f}ms  build {:.1f}ms".format(
+            int(lazy), imported, built))
+
+
+if __name__ == "__main__":
+    main()
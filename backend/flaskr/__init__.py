@@ -1,30 +1,293 @@
 import os
-from flask import Flask, request, abort, jsonify
+import base64
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 import json
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
 from flask_cors import CORS
-import random
-
-# This is importing the setup_db, Question, and Category classes from the models.py file.
-from models import setup_db, Question, Category
+from werkzeug.routing import IntegerConverter
+
+# This is importing the Question and Category classes from the models.py file.
+from models import MAX_ID, db, Question, QuestionBatch, QuestionChange, Category
+from migrations import ensure_schema
+from .quiz import DiskQuizSessions, QuizIndex, QuizSessions, target_difficulty
+from .category_cache import CategoryCache
+from .changes import ChangeSeqs
+from .coalesce import SingleFlight
+from .metrics import Metrics
+from .profiler import Profiler
+from .ratelimit import RateLimiter
+from .search import QuestionSearch, tokenize
+from .snapshot import SnapshotStore, current_snapshot, snapshot_command
+from .replicas import ReplicaRouter, read_only
+from .stats import QuestionStats
+from .storage import make_storage
+from .suggest import SuggestIndex
+from .response_cache import cached, category_scope, make_response_cache
+from .serialize import ID_POSITION, QUESTION_COLUMNS, json_response, question_rows
+from .transfer import EXPORTERS, PARSERS, import_questions, iter_question_rows
+
+
+# QUESTIONS_PER_PAGE is a constant variable that is used to set the number of questions to be
+# displayed per page.
+QUESTIONS_PER_PAGE = 10
+# Suggestions returned by GET /questions/suggest, by default and at most.
+SUGGESTIONS_PER_PREFIX = 10
+MAX_SUGGESTIONS = 50
+# Changes returned by GET /questions/changes, by default and at most.
+CHANGES_PER_PAGE = 100
+MAX_CHANGES = 1000
+
+
+# Cursors are opaque to clients: a urlsafe base64 wrapper around the last id of a page,
+# or around the offset of the next page for ranked search results.
+def encode_cursor(value, key="id"):
+    raw = json.dumps({key: value}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor, key="id"):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        value = json.loads(raw.decode("utf-8"))[key]
+    except (ValueError, KeyError, TypeError, UnicodeError):
+        abort(400)
+    if not isinstance(value, int) or value < 0 or value > MAX_ID:
+        abort(400)
+    return value
+
+
+class IdConverter(IntegerConverter):
+    """<id:name> in a route: an integer up to MAX_ID; larger ones are 404."""
+
+    def __init__(self, map):
+        super().__init__(map, max=MAX_ID)
+
+
+def request_page(request):
+    # the page argument, 1 by default; 400 when its offset is out of range
+    page = request.args.get('page', 1, type=int)
+    if (page - 1) * QUESTIONS_PER_PAGE > MAX_ID:
+        abort(400)
+    return page
+
+
+def is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= MAX_ID
+
+
+def quiz_category_id(body):
+    # The category id of a quiz request body, 0 for all categories; the
+    # frontend sends it as a string. 400 unless it is an id.
+    quiz_category = body.get("quiz_category", None) if isinstance(body, dict) else None
+    if not isinstance(quiz_category, dict):
+        abort(400)
+    category_id = quiz_category.get("id", 0)
+    if isinstance(category_id, str) and category_id.isdigit():
+        category_id = int(category_id)
+    if not is_id(category_id):
+        abort(400)
+    return category_id
+
+
+def previous_question_ids(body):
+    # previous_questions of a quiz request body; 400 unless it is a list of ids
+    previous_questions = body.get("previous_questions", None)
+    if not isinstance(previous_questions, list) or not all(
+            is_id(id) for id in previous_questions):
+        abort(400)
+    return previous_questions
 
 
 # Set up pagination function
-def paginate_questions(request,selection):
-    # QUESTIONS_PER_PAGE is a constant variable that is used to set the number of questions to be
-    # displayed per page.
-    QUESTIONS_PER_PAGE = 10
-    page =request.args.get('page',1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    current_questions = selection[start:end]
-    return current_questions
+def paginate_questions(request, selection, total_questions=None):
+    # selection is an unexecuted Question query; only one page of rows is loaded,
+    # as column tuples rather than Question objects. total_questions is counted
+    # with a query when the caller does not know it.
+    # Returns (current_questions as formatted dicts, total_questions, next_cursor).
+    if total_questions is None:
+        total_questions = selection.order_by(None).with_entities(
+            func.count(Question.id)).scalar()
+
+    cursor = request.args.get('cursor', None, type=str)
+    if cursor:
+        # keyset paging: stable under inserts/deletes and cheap at any depth
+        page_query = selection.filter(
+            Question.id > decode_cursor(cursor)).order_by(Question.id)
+    else:
+        page = request_page(request)
+        if page < 1:
+            return [], total_questions, None
+        page_query = selection.order_by(Question.id).offset(
+            (page - 1) * QUESTIONS_PER_PAGE)
+
+    rows = page_query.with_entities(*QUESTION_COLUMNS).limit(QUESTIONS_PER_PAGE).all()
+
+    next_cursor = None
+    if len(rows) == QUESTIONS_PER_PAGE:
+        next_cursor = encode_cursor(rows[-1][ID_POSITION])
+    return question_rows(rows), total_questions, next_cursor
+
+
+# paginate_questions over a QuestionSnapshot: the same pages, without SQL.
+def paginate_snapshot(request, snapshot, category_id=None):
+    cursor = request.args.get('cursor', None, type=str)
+    if cursor:
+        questions, total_questions = snapshot.page(
+            category_id, after=decode_cursor(cursor), limit=QUESTIONS_PER_PAGE)
+    else:
+        page = request_page(request)
+        if page < 1:
+            return [], len(snapshot.positions(category_id)), None
+        questions, total_questions = snapshot.page(
+            category_id, offset=(page - 1) * QUESTIONS_PER_PAGE, limit=QUESTIONS_PER_PAGE)
+
+    next_cursor = None
+    if len(questions) == QUESTIONS_PER_PAGE:
+        next_cursor = encode_cursor(questions[-1]["id"])
+    return questions, total_questions, next_cursor
+
+
+# Offset of the requested page of a ranked result, None before the first page.
+def page_offset(request):
+    cursor = request.args.get('cursor', None, type=str)
+    if cursor:
+        return decode_cursor(cursor, "offset")
+    page = request_page(request)
+    if page < 1:
+        return None
+    return (page - 1) * QUESTIONS_PER_PAGE
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    app.url_map.converters["id"] = IdConverter
+    # "postgresql", "sqlite" or "memory"; unset picks one from DATABASE_URL
+    app.config["STORAGE"] = os.getenv("STORAGE")
+    # seconds a client's reads stay on the primary after it wrote, when
+    # DATABASE_REPLICA_URLS lists read replicas
+    app.config["REPLICA_STICKY_SECONDS"] = int(os.getenv("REPLICA_STICKY_SECONDS", 5))
+    app.config["QUIZ_INDEX_TTL"] = 60
+    # build the quiz index when the app starts instead of on the first quiz
+    app.config["QUIZ_INDEX_WARM"] = os.getenv("QUIZ_INDEX_WARM", "1") == "1"
+    # no database work while the app is built: the schema step runs before
+    # the first request and caches fill on first use
+    app.config["LAZY_INIT"] = os.getenv("LAZY_INIT", "0") == "1"
+    # serve listings and quizzes from a columnar snapshot of the questions:
+    # a file written by `flask snapshot PATH`, "db" to build it
+    # from the database, or unset for SQL
+    app.config["QUESTION_SNAPSHOT"] = os.getenv("QUESTION_SNAPSHOT")
+    # seconds before a "db" snapshot is rebuilt, or a file is mapped again
+    # after a local write; 0 waits for the next write, or a new file
+    app.config["QUESTION_SNAPSHOT_TTL"] = int(os.getenv("QUESTION_SNAPSHOT_TTL", 60))
+    app.config["QUIZ_SESSION_TTL"] = 3600
+    app.config["QUIZ_SESSION_LIMIT"] = 10000
+    # question ids held by all quiz sessions, 4 bytes each
+    app.config["QUIZ_SESSION_MAX_IDS"] = 50000000
+    # a SQLite file that keeps quiz sessions for every worker; unset keeps
+    # them in the worker's memory
+    app.config["QUIZ_SESSION_PATH"] = os.getenv("QUIZ_SESSION_PATH")
+    app.config["CATEGORY_CACHE_TTL"] = 300
+    # seconds a listing's change log seq, its ETag, is kept before it is read
+    # again; writes made by this worker are seen at once
+    app.config["CHANGE_SEQ_TTL"] = 1
+    # set to a shared path so every worker sees category writes immediately
+    app.config["CATEGORY_VERSION_FILE"] = os.getenv("CATEGORY_VERSION_FILE")
+    app.config["SEARCH_INDEX_TTL"] = 300
+    app.config["SUGGEST_INDEX_TTL"] = 300
+    # prefixes whose matches are kept for typeahead
+    app.config["SUGGEST_CACHE_SIZE"] = 1024
+    # seconds between reconciling the question counts with the database
+    app.config["STATS_RECONCILE_INTERVAL"] = 60
+    # rows per multi-row INSERT in POST /questions/bulk
+    app.config["BULK_CHUNK_SIZE"] = 200
+    # items per POST /questions/batch or DELETE /questions request
+    app.config["BATCH_MAX_ITEMS"] = 1000
+    # cached listing pages; RESPONSE_CACHE_PATH shares them between workers
+    app.config["RESPONSE_CACHE_SIZE"] = 1024
+    app.config["RESPONSE_CACHE_TTL"] = 30
+    app.config["RESPONSE_CACHE_PATH"] = os.getenv("RESPONSE_CACHE_PATH")
+    # concurrent identical reads of cached routes share one run of the view
+    app.config["COALESCE_READS"] = os.getenv("COALESCE_READS", "1") == "1"
+    app.config["COALESCE_TIMEOUT"] = 10
+    # token bucket per client and endpoint; a rate of 0 turns limiting off.
+    # RATE_LIMITS maps endpoint names to their own (rate, burst)
+    app.config["RATE_LIMIT_PER_SECOND"] = float(os.getenv("RATE_LIMIT_PER_SECOND", 0))
+    app.config["RATE_LIMIT_BURST"] = int(os.getenv("RATE_LIMIT_BURST", 20))
+    app.config["RATE_LIMITS"] = {}
+    # header holding the client address when behind a trusted proxy
+    app.config["RATE_LIMIT_CLIENT_HEADER"] = os.getenv("RATE_LIMIT_CLIENT_HEADER")
+    app.config["RATE_LIMIT_MAX_CLIENTS"] = 100000
+    # requests slower than this are logged with their SQL; None turns it off
+    app.config["SLOW_REQUEST_MS"] = (
+        float(os.environ["SLOW_REQUEST_MS"]) if "SLOW_REQUEST_MS" in os.environ else None)
+    # sampling profiler: folded stacks and SQL spans are appended under
+    # PROFILE_DIR for a share of the requests to PROFILE_ENDPOINTS, and for
+    # requests sending PROFILE_TOKEN in an X-Profile header
+    app.config["PROFILE_DIR"] = os.getenv("PROFILE_DIR")
+    app.config["PROFILE_ENDPOINTS"] = [
+        name.strip() for name in os.getenv("PROFILE_ENDPOINTS", "").split(",") if name.strip()
+    ]
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.getenv("PROFILE_SAMPLE_RATE", 0.01))
+    app.config["PROFILE_TOKEN"] = os.getenv("PROFILE_TOKEN")
+    app.config["PROFILE_INTERVAL_MS"] = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+    if test_config is not None:
+        app.config.update(test_config)
+    make_storage(app.config).init_app(app)
+    ReplicaRouter(app.config["REPLICA_STICKY_SECONDS"]).init_app(app)
+    ensure_schema(app, lazy=app.config["LAZY_INIT"])
+    snapshot = app.config["QUESTION_SNAPSHOT"]
+    app.extensions["question_snapshot"] = SnapshotStore(
+        None if snapshot == "db" else snapshot,
+        app.config["QUESTION_SNAPSHOT_TTL"]) if snapshot else None
+    app.extensions["quiz_index"] = QuizIndex(app.config["QUIZ_INDEX_TTL"])
+    if app.config["QUIZ_SESSION_PATH"]:
+        app.extensions["quiz_sessions"] = DiskQuizSessions(
+            app.extensions["quiz_index"], app.config["QUIZ_SESSION_PATH"],
+            app.config["QUIZ_SESSION_TTL"], app.config["QUIZ_SESSION_LIMIT"],
+            app.config["QUIZ_SESSION_MAX_IDS"])
+    else:
+        app.extensions["quiz_sessions"] = QuizSessions(
+            app.extensions["quiz_index"],
+            app.config["QUIZ_SESSION_TTL"], app.config["QUIZ_SESSION_LIMIT"],
+            app.config["QUIZ_SESSION_MAX_IDS"])
+    app.extensions["category_cache"] = CategoryCache(
+        app.config["CATEGORY_CACHE_TTL"], app.config["CATEGORY_VERSION_FILE"])
+    app.extensions["change_seqs"] = ChangeSeqs(app.config["CHANGE_SEQ_TTL"])
+    app.extensions["question_search"] = QuestionSearch(app.config["SEARCH_INDEX_TTL"])
+    app.extensions["question_suggest"] = SuggestIndex(
+        app.config["SUGGEST_INDEX_TTL"], app.config["SUGGEST_CACHE_SIZE"])
+    app.extensions["question_stats"] = QuestionStats(app.config["STATS_RECONCILE_INTERVAL"])
+    app.extensions["response_cache"] = make_response_cache(app.config)
+    app.extensions["metrics"] = Metrics(app.config["SLOW_REQUEST_MS"])
+    app.extensions["metrics"].init_app(app)
+    app.extensions["single_flight"] = (
+        SingleFlight(app.config["COALESCE_TIMEOUT"]) if app.config["COALESCE_READS"] else None)
+    if app.config["PROFILE_DIR"] and (app.config["PROFILE_ENDPOINTS"] or app.config["PROFILE_TOKEN"]):
+        app.extensions["profiler"] = Profiler(
+            app.config["PROFILE_DIR"], app.config["PROFILE_ENDPOINTS"],
+            app.config["PROFILE_SAMPLE_RATE"], app.config["PROFILE_TOKEN"],
+            app.config["PROFILE_INTERVAL_MS"] / 1000)
+        app.extensions["profiler"].init_app(app)
+    if app.config["RATE_LIMIT_PER_SECOND"] or app.config["RATE_LIMITS"]:
+        app.extensions["rate_limiter"] = RateLimiter(
+            app.config["RATE_LIMIT_PER_SECOND"], app.config["RATE_LIMIT_BURST"],
+            app.config["RATE_LIMITS"], app.config["RATE_LIMIT_CLIENT_HEADER"],
+            app.config["RATE_LIMIT_MAX_CLIENTS"])
+        app.extensions["rate_limiter"].init_app(app)
+    app.cli.add_command(snapshot_command)
+    if app.extensions["question_snapshot"] is not None and not app.config["LAZY_INIT"]:
+        # opened before a pre-forking server forks, so workers share its pages
+        with app.app_context():
+            app.extensions["question_snapshot"].get()
+    if app.config["QUIZ_INDEX_WARM"] and not app.config["LAZY_INIT"]:
+        try:
+            with app.app_context():
+                app.extensions["quiz_index"].warm()
+        except SQLAlchemyError:
+            # the index is built on the first quiz instead
+            app.logger.warning("could not build the quiz index", exc_info=True)
     # CORS is a Python decorator which allows cross-origin HTTP requests.
     CORS(app,resources={r"/*": {"origins": "*"}})
     
@@ -38,45 +301,101 @@ def create_app(test_config=None):
         return response
        
 
+# Expose request and database metrics in Prometheus text format.
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(
+            app.extensions["metrics"].render(),
+            mimetype="text/plain; version=0.0.4")
+
+    # The ETag of a question listing: the change log seq its questions are
+    # at, from the snapshot when one serves listings, and the category map.
+    def listing_version(category_id=None):
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            seq = snapshot.seq
+        else:
+            seq = app.extensions["change_seqs"].latest(category_id)
+        _, categories_etag = app.extensions["category_cache"].get()
+        return "{}-{}".format(seq, categories_etag[:16])
+
 # GET requests for all available categories
     @app.route('/categories',methods=['GET'])
     def getCategories():
-        All_categories = Category.query.order_by(Category.id).all()
+        All_categories, etag = app.extensions["category_cache"].get()
         if len(All_categories)==0:
           abort(404)
-        return jsonify({
+        response = jsonify({
             "success":True,
-            "categories":{category.id:category.type for category in All_categories},
+            "categories":All_categories,
             "total_categories": len(All_categories)
 
         })
+        # browsers and the CDN revalidate with If-None-Match and get a 304
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+# GET question counts per category and difficulty, served from memory.
+    @app.route('/categories/stats', methods=['GET'])
+    def getCategoryStats():
+        All_categories, _ = app.extensions["category_cache"].get()
+        if len(All_categories) == 0:
+            abort(404)
+        counts = app.extensions["question_stats"].by_category()
+
+        categories = {}
+        for id, type in All_categories.items():
+            difficulties = counts.get(id, {})
+            categories[id] = {
+                "type": type,
+                "total_questions": sum(difficulties.values()),
+                "difficulties": {
+                    difficulty: count for difficulty, count in difficulties.items()
+                    if difficulty is not None
+                }
+            }
+        return jsonify({
+            "success": True,
+            "categories": categories,
+            "total_questions": sum(
+                sum(difficulties.values()) for difficulties in counts.values())
+        })
 
 #  Create an endpoint to handle GET requests for questions
 #  including pagination (every 10 questions)
 
     @app.route('/questions', methods = ['GET'])
+    @cached(lambda: "questions", listing_version)
     def getAllQuestions():
-        All_questions = Question.query.order_by(Question.id).all()
-        piginated_questions = paginate_questions(request, All_questions)
-        All_categories = Category.query.order_by(Category.id).all()
-        if len(All_questions)== 0:
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            piginated_questions, total_questions, next_cursor = paginate_snapshot(
+                request, snapshot)
+        else:
+            piginated_questions, total_questions, next_cursor = paginate_questions(
+                request, Question.query, app.extensions["question_stats"].total())
+        All_categories, _ = app.extensions["category_cache"].get()
+        if len(piginated_questions) == 0:
           abort(404)
-        return jsonify({
+        return json_response({
             "success":True,
-            "questions":[question.format() for question in piginated_questions],
-            "total_questions": len(All_questions),
-            "categories":{category.id:category.type for category in All_categories},
-            "current_category":None
+            "questions":piginated_questions,
+            "total_questions": total_questions,
+            "categories":All_categories,
+            "current_category":None,
+            "next_cursor": next_cursor
         })
     
  # Create an endpoint to DELETE question using a question ID.
-    @app.route('/questions/<int:question_id>',methods=['DELETE'])
+    @app.route('/questions/<id:question_id>',methods=['DELETE'])
     def deleteQuestion(question_id):
        question = Question.query.get_or_404(question_id)
        result = question.delete()
        if result:
         return jsonify({
-            "sucess": result,
+            "success": result,
             "deleted":question_id
         })
        else:
@@ -86,6 +405,8 @@ def create_app(test_config=None):
     @app.route("/questions", methods=["POST"])
     def addQuestion():
         body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
 
         question = body.get("question", None)
         answer = body.get("answer", None)
@@ -95,6 +416,18 @@ def create_app(test_config=None):
         if question is None:
             abort(400)
 
+        # the frontend sends the values of its selects as strings
+        try:
+            if category is not None:
+                category = int(category)
+            if difficulty is not None:
+                difficulty = int(difficulty)
+        except (TypeError, ValueError):
+            abort(400)
+        categories, _ = app.extensions["category_cache"].get()
+        if category is not None and category not in categories:
+            abort(422)
+
         question = Question(question, answer, category, difficulty)
         result = question.insert()
 
@@ -106,84 +439,324 @@ def create_app(test_config=None):
         else:
             abort(422)
 
+# Create an endpoint to insert, update and delete many questions in one transaction.
+    @app.route("/questions/batch", methods=["POST"])
+    def batchWriteQuestions():
+        body = request.get_json()
+
+        operations = body.get("operations", None) if isinstance(body, dict) else None
+        if not isinstance(operations, list) or len(operations) == 0:
+            abort(400)
+        if len(operations) > app.config["BATCH_MAX_ITEMS"]:
+            abort(400)
+
+        batch = QuestionBatch()
+        for operation in operations:
+            if not isinstance(operation, dict):
+                abort(400)
+            action = operation.get("op", None)
+            if action == "insert":
+                batch.insert(operation.get("question", None))
+            elif action == "update":
+                batch.update(operation.get("id", None), operation.get("question", None))
+            elif action == "delete":
+                batch.delete(operation.get("id", None))
+            else:
+                abort(400)
+
+        try:
+            result = batch.commit(atomic=bool(body.get("atomic", False)))
+        except SQLAlchemyError:
+            abort(422)
+
+        errors = [error.format() for error in result["errors"]]
+        if errors and not (result["created"] or result["updated"] or result["deleted"]):
+            # nothing was written; say why item by item
+            return jsonify({
+                "success": False,
+                "error": 422,
+                "message": "unprocessable",
+                "errors": errors
+            }), 422
+
+        return jsonify({
+            "success": True,
+            "created": result["created"],
+            "updated": result["updated"],
+            "deleted": result["deleted"],
+            "errors": errors
+        })
+
+# Create an endpoint to DELETE many questions by id in one transaction.
+    @app.route("/questions", methods=["DELETE"])
+    def deleteQuestions():
+        try:
+            ids = [int(id) for id in request.args.get("ids", "").split(",") if id.strip()]
+        except ValueError:
+            abort(400)
+        if any(id < 0 or id > MAX_ID for id in ids):
+            abort(400)
+        # repeated ids are deleted once
+        ids = list(dict.fromkeys(ids))
+        if len(ids) == 0 or len(ids) > app.config["BATCH_MAX_ITEMS"]:
+            abort(400)
+
+        batch = QuestionBatch()
+        for id in ids:
+            batch.delete(id)
+        try:
+            result = batch.commit()
+        except SQLAlchemyError:
+            abort(422)
+
+        if len(result["deleted"]) == 0:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "deleted": result["deleted"],
+            "errors": [error.format() for error in result["errors"]]
+        })
+
+# Create an endpoint to import many questions from an NDJSON or CSV stream.
+    @app.route("/questions/bulk", methods=["POST"])
+    def bulkImportQuestions():
+        parser = PARSERS.get(request.mimetype)
+        if parser is None:
+            abort(400)
+
+        categories, _ = app.extensions["category_cache"].get()
+        try:
+            created, errors, total_errors = import_questions(
+                parser(request.stream), categories, app.config["BULK_CHUNK_SIZE"])
+        except SQLAlchemyError:
+            abort(422)
+
+        if created == 0 and errors:
+            # nothing was imported; say why row by row
+            return jsonify({
+                "success": False,
+                "error": 422,
+                "message": "unprocessable",
+                "errors": errors,
+                "total_errors": total_errors
+            }), 422
+
+        return jsonify({
+            "success": True,
+            "created": created,
+            "errors": errors,
+            "total_errors": total_errors
+        })
+
+# Create an endpoint to export every question as an NDJSON or CSV stream.
+    @app.route("/questions/export", methods=["GET"])
+    def exportQuestions():
+        format = request.args.get("format", "ndjson")
+        if format not in EXPORTERS:
+            abort(400)
+
+        mimetype, exporter = EXPORTERS[format]
+        response = Response(
+            stream_with_context(exporter(iter_question_rows())), mimetype=mimetype)
+        response.headers["Content-Disposition"] = (
+            "attachment; filename=questions.{}".format(format))
+        return response
+
 #Create a POST endpoint to get questions based on a search term.
     @app.route("/questions/search", methods=["POST"])
+    @read_only
     def searchQuestion():
         body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
 
         search_term = body.get("search_term", None)
+        if search_term is not None and not isinstance(search_term, str):
+            abort(400)
 
-        All_questions = Question.query.filter(
-            Question.question.ilike("%{}%".format(search_term))).order_by( Question.id).all()
+        offset = page_offset(request)
+        if offset is None:
+            abort(404)
 
-        questions = paginate_questions(request, All_questions)
+        # ids of one page, best match first
+        ids, total_questions = app.extensions["question_search"].search(
+            search_term, offset, QUESTIONS_PER_PAGE)
+        questions = app.extensions["storage"].questions(ids)
 
         if len(questions) == 0:
             abort(404)
 
-        return jsonify({
+        next_cursor = None
+        if len(ids) == QUESTIONS_PER_PAGE:
+            next_cursor = encode_cursor(offset + QUESTIONS_PER_PAGE, "offset")
+
+        return json_response({
+            "success": True,
+            "questions": questions,
+            "total_questions": total_questions,
+            "current_category": None,
+            "next_cursor": next_cursor
+        })
+
+
+
+
+# Create a GET endpoint to suggest questions while the user types a search.
+    @app.route("/questions/suggest", methods=["GET"])
+    def suggestQuestions():
+        prefix = request.args.get("prefix", "", type=str)
+        limit = request.args.get("limit", SUGGESTIONS_PER_PREFIX, type=int)
+
+        if not tokenize(prefix):
+            abort(400)
+        if limit < 1 or limit > MAX_SUGGESTIONS:
+            abort(400)
+
+        suggestions, total = app.extensions["question_suggest"].suggest(prefix, limit)
+
+        return json_response({
             "success": True,
-            "questions": [question.format() for question in questions],
-            "total_questions": len(All_questions),
-            "current_category": None
+            "prefix": prefix,
+            "suggestions": suggestions,
+            "total_questions": total
         })
 
 
+# GET the question changes after a change log seq, oldest first, so clients
+# keep a local copy of the questions in sync.
+    @app.route("/questions/changes", methods=["GET"])
+    def questionChanges():
+        latest_seq = QuestionChange.latest()
+        if "since" not in request.args:
+            # where the log is now: clients load the listings, then poll from here
+            return jsonify({"success": True, "changes": [], "latest_seq": latest_seq})
+        since = request.args.get("since", None, type=int)
+        limit = request.args.get("limit", CHANGES_PER_PAGE, type=int)
+        if since is None or since < 0 or since > MAX_ID or limit < 1 or limit > MAX_CHANGES:
+            abort(400)
+        oldest = QuestionChange.oldest()
+        if oldest is not None and since < oldest - 1:
+            # changes after since were pruned; the client has to reload
+            abort(410)
+
+        rows = db.session.query(
+            QuestionChange.seq, QuestionChange.action,
+            QuestionChange.question_id, QuestionChange.category, *QUESTION_COLUMNS
+        ).outerjoin(Question, Question.id == QuestionChange.question_id).filter(
+            QuestionChange.seq > since
+        ).order_by(QuestionChange.seq).limit(limit + 1).all()
+
+        changes = []
+        for row in rows[:limit]:
+            latest_seq = max(latest_seq, row[0])
+            seq, action, question_id, category = row[:4]
+            # inserts carry the question as it is now; None once deleted
+            question = None
+            if action == "insert" and row[4 + ID_POSITION] is not None:
+                question = question_rows([row[4:]])[0]
+            changes.append({
+                "seq": seq,
+                "action": action,
+                "id": question_id,
+                "category": category,
+                "question": question
+            })
+        return json_response({
+            "success": True,
+            "changes": changes,
+            "latest_seq": latest_seq,
+            "has_more": len(rows) > limit
+        })
 
 
 #Create a GET endpoint to get questions based on category.
-    @app.route("/categories/<int:id>/questions", methods=["GET"])
+    @app.route("/categories/<id:id>/questions", methods=["GET"])
+    @cached(lambda id: category_scope(id), lambda id: listing_version(id))
     def questionsByCategory(id):
-        category = Category.query.get_or_404(id)
-        All_questions = Question.query.filter_by(category = id).order_by(Question.id).all()
-        questions = paginate_questions(request, All_questions)
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            categories, _ = app.extensions["category_cache"].get()
+            if id not in categories:
+                abort(404)
+            current_category = categories[id]
+            questions, total_questions, next_cursor = paginate_snapshot(
+                request, snapshot, id)
+        else:
+            current_category = Category.query.get_or_404(id).type
+            selection = Question.query.filter_by(category = id)
+            questions, total_questions, next_cursor = paginate_questions(
+                request, selection, app.extensions["question_stats"].total(id))
 
         if len(questions) == 0:
             abort(404)
-        return jsonify({
+        return json_response({
             "success": True,
-            "questions": [question.format() for question in questions],
-            "total_questions": len(All_questions),
-            "current_category": category.type
+            "questions": questions,
+            "total_questions": total_questions,
+            "current_category": current_category,
+            "next_cursor": next_cursor
         })
 
 
 # Create a POST endpoint to get questions to play the quiz.
+# Kept for clients that send previous_questions; new clients use quiz sessions.
     @app.route("/quizzes", methods=["POST"])
+    @read_only
     def quizzes():
         body = request.get_json()
+        categoryId = quiz_category_id(body)
+        previousQuestions = previous_question_ids(body)
 
-        previousQuestions = body.get("previous_questions", None)
-        quizCategory = body.get("quiz_category", None)
-
-        if (previousQuestions is None) or (quizCategory is None):
+        # "adaptive" aims each question at the player's recent answers
+        mode = body.get("mode", "random")
+        if mode not in ("random", "adaptive"):
             abort(400)
+        difficulty = None
+        if mode == "adaptive":
+            recentAnswers = body.get("recent_answers", [])
+            if not isinstance(recentAnswers, list):
+                abort(400)
+            difficulty = target_difficulty(recentAnswers)
 
-        categoryId = quizCategory.get("id")
+        question = app.extensions["quiz_index"].draw(
+            categoryId, previousQuestions, difficulty)
 
-        questions = None
-        if (categoryId == 0):
-            questions = Question.query.filter(
-                Question.id.notin_(previousQuestions)
-            ).order_by(
-                Question.id
-            ).all()
-        else:
-            questions = Question.query.filter_by(
-                category = categoryId
-            ).filter(
-                Question.id.notin_(previousQuestions)
-            ).order_by(
-                Question.id
-            ).all()
-
-        randomQuestion = None
-        if len(questions) > 0:
-            randomQuestion = random.choice(questions).format()
+        result = {
+            "success": True,
+            "question": question
+        }
+        if difficulty is not None:
+            result["target_difficulty"] = difficulty
+        return jsonify(result)
+
+# Create a POST endpoint to start a quiz whose progress is kept on the server.
+    @app.route("/quizzes/sessions", methods=["POST"])
+    @read_only
+    def createQuizSession():
+        categoryId = quiz_category_id(request.get_json())
+
+        sessionId, totalQuestions = app.extensions["quiz_sessions"].create(categoryId)
 
         return jsonify({
             "success": True,
-            "question": randomQuestion
+            "session_id": sessionId,
+            "total_questions": totalQuestions
+        })
+
+# Create a POST endpoint to draw the next question of a quiz session.
+    @app.route("/quizzes/sessions/<session_id>/next", methods=["POST"])
+    @read_only
+    def nextQuizQuestion(session_id):
+        try:
+            question, remaining = app.extensions["quiz_sessions"].draw(session_id)
+        except KeyError:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "question": question,
+            "remaining_questions": remaining
         })
 
 
@@ -193,6 +766,8 @@ def create_app(test_config=None):
 # 404: Resource Not Found
 # 405: Method Not Allowed
 # 422: Not Processable
+# 410: Gone
+# 429: Too Many Requests
 # 500: Internal Server Error
     @app.errorhandler(400)
     def badRequest(error):
@@ -221,6 +796,22 @@ def create_app(test_config=None):
             422
         )
 
+    @app.errorhandler(410)
+    def gone(error):
+        return (
+            jsonify({"success": False, "error": 410, "message": "gone"}),
+            410
+        )
+
+    @app.errorhandler(429)
+    def tooManyRequests(error):
+        return (
+            jsonify({"success": False, "error": 429, "message": "too many requests"}),
+            429,
+            {"Retry-After": str(error.retry_after)}
+            if getattr(error, "retry_after", None) else {}
+        )
+
     @app.errorhandler(500)
     def internalServerError(error):
         return (
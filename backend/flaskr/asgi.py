@@ -0,0 +1,498 @@
+"""
+Async (ASGI) serving mode for the trivia API.
+
+The read and quiz routes that carry most of the traffic run natively on an
+async driver pool (asyncpg for PostgreSQL, aiosqlite for SQLite), so one
+process can keep thousands of them in flight. Every other request, and every
+method a native route does not handle, is passed to the Flask app from
+create_app on a thread pool, so routes, payloads and error handlers stay the
+same in both modes. The two share the category cache, quiz index and question
+counts.
+
+Run it with `python -m flaskr.asgi` (needs uvicorn) or with any ASGI server
+pointed at `flaskr.asgi:create_asgi_app()`.
+"""
+import asyncio
+import json
+import math
+import os
+import re
+import sys
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from werkzeug.exceptions import BadRequest, HTTPException
+
+from . import (
+    MAX_ID, QUESTIONS_PER_PAGE, create_app, decode_cursor, encode_cursor,
+    previous_question_ids, quiz_category_id
+)
+from .quiz import target_difficulty
+from .serialize import QUESTION_KEYS, dumps
+
+
+# same payloads as the error handlers in create_app
+ERROR_MESSAGES = {
+    400: "bad request",
+    404: "resource not found",
+    405: "method not allowed",
+    422: "unprocessable",
+    429: "too many requests",
+    500: "internal server error",
+}
+# same headers as create_app's after_request hook
+CORS_HEADERS = [
+    (b"access-control-allow-headers", b"Content-Type, Authorization, true"),
+    (b"access-control-allow-methods", b"GET, PATCH, POST, DELETE, OPTIONS"),
+]
+QUESTION_SELECT = "SELECT {} FROM questions".format(", ".join(QUESTION_KEYS))
+
+
+class AsyncDatabase:
+    """Pool of async connections to the app's database.
+
+    Statements use PostgreSQL style $1 placeholders; SQLite reads them as
+    numbered ?1 parameters.
+    """
+
+    def __init__(self, url, min_size=1, max_size=20):
+        self.url = url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self.connections = None
+
+    async def connect(self):
+        if self.pool is not None or self.connections is not None:
+            return
+        if self.url.startswith("postgres"):
+            import asyncpg
+
+            dsn = re.sub(r"^postgres(ql)?(\+\w+)?://", "postgresql://", self.url)
+            self.pool = await asyncpg.create_pool(
+                dsn, min_size=self.min_size, max_size=self.max_size)
+        elif self.url.startswith("sqlite"):
+            import aiosqlite
+
+            path = self.url.split(":///", 1)[1] if ":///" in self.url else ":memory:"
+            self.connections = asyncio.Queue()
+            for _ in range(self.max_size):
+                self.connections.put_nowait(await aiosqlite.connect(path))
+        else:
+            raise RuntimeError("no async driver for {}".format(self.url))
+
+    async def fetch(self, sql, *args):
+        if self.pool is not None:
+            async with self.pool.acquire() as connection:
+                return [tuple(row) for row in await connection.fetch(sql, *args)]
+        connection = await self.connections.get()
+        try:
+            cursor = await connection.execute(sql.replace("$", "?"), args)
+            return await cursor.fetchall()
+        finally:
+            self.connections.put_nowait(connection)
+
+    async def fetchval(self, sql, *args):
+        rows = await self.fetch(sql, *args)
+        return rows[0][0] if rows else None
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        if self.connections is not None:
+            while not self.connections.empty():
+                await self.connections.get_nowait().close()
+            self.connections = None
+
+
+class AsyncTriviaApp:
+    """ASGI application serving the trivia API."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        config = flask_app.config
+        self.db = AsyncDatabase(
+            config["SQLALCHEMY_DATABASE_URI"],
+            config["ASYNC_POOL_MIN_SIZE"], config["ASYNC_POOL_MAX_SIZE"])
+        # endpoint names are those of the Flask views, for rate limits
+        self.routes = [
+            ("GET", re.compile(r"^/categories$"), self.categories, "getCategories"),
+            ("GET", re.compile(r"^/questions$"), self.questions, "getAllQuestions"),
+            ("GET", re.compile(r"^/categories/(\d+)/questions$"), self.category_questions,
+             "questionsByCategory"),
+            ("POST", re.compile(r"^/quizzes$"), self.quizzes, "quizzes"),
+        ]
+        if flask_app.extensions["storage"].name == "memory":
+            # the async drivers can not reach the worker's in-memory tables
+            self.routes = []
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        for method, pattern, handler, endpoint in self.routes:
+            match = pattern.match(scope["path"])
+            if match and scope["method"] == method:
+                wait = self.rate_limit(scope, endpoint)
+                if wait:
+                    status, headers, payload = self.error(429)
+                    headers.append((b"retry-after", str(wait).encode("ascii")))
+                    await self.respond(send, scope, status, headers, payload)
+                    return
+                await self.db.connect()
+                try:
+                    status, headers, payload = await handler(scope, body, *match.groups())
+                except HTTPException as error:
+                    status, headers, payload = self.error(error.code)
+                except Exception:
+                    self.flask_app.logger.exception("Exception on %s", scope["path"])
+                    status, headers, payload = self.error(500)
+                await self.respond(send, scope, status, headers, payload)
+                return
+
+        await self.call_wsgi(scope, body, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.db.connect()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.db.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def rate_limit(self, scope, endpoint):
+        # Returns 0, or the whole seconds to wait, as RateLimiter does for Flask.
+        limiter = self.flask_app.extensions.get("rate_limiter")
+        if limiter is None:
+            return 0
+        wait = limiter.take(client_address(scope, limiter.client_header), endpoint)
+        return max(1, math.ceil(wait)) if wait else 0
+
+    def error(self, code):
+        code = code if code in ERROR_MESSAGES else 500
+        return code, [], {"success": False, "error": code, "message": ERROR_MESSAGES[code]}
+
+    async def respond(self, send, scope, status, headers, payload):
+        body = b"" if payload is None else dumps(payload)
+        headers = list(headers) + CORS_HEADERS
+        # as Flask-CORS answers for origins "*": the request's origin, or *
+        origin = next((value for name, value in scope["headers"] if name == b"origin"), None)
+        if origin is None:
+            headers.append((b"access-control-allow-origin", b"*"))
+        else:
+            headers.append((b"access-control-allow-origin", origin))
+            headers.append((b"vary", b"Origin"))
+        if payload is not None:
+            headers.append((b"content-type", b"application/json"))
+            headers.append((b"content-length", str(len(body)).encode("ascii")))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    # Native routes, mirroring the Flask handlers of the same paths.
+
+    async def category_map(self):
+        cache = self.flask_app.extensions["category_cache"]
+        version = cache.counter.read()
+        if cache.stale(version):
+            rows = await self.db.fetch("SELECT id, type FROM categories ORDER BY id")
+            with cache.lock:
+                cache.fill(rows, version)
+        return cache.categories, cache.etag
+
+    async def change_seq(self, category_id=None):
+        # QuestionChange.latest(), through the app's ChangeSeqs
+        seqs = self.flask_app.extensions["change_seqs"]
+        seq, writes = seqs.cached(category_id)
+        if seq is not None:
+            return seq
+        if category_id is None:
+            seq = await self.db.fetchval("SELECT max(seq) FROM question_changes") or 0
+        else:
+            found = [
+                await self.db.fetchval(
+                    "SELECT max(seq) FROM question_changes WHERE category = $1", category_id),
+                await self.db.fetchval(
+                    "SELECT max(seq) FROM question_changes WHERE category IS NULL")
+            ]
+            seq = max((seq for seq in found if seq is not None), default=None)
+            if seq is None:
+                oldest = await self.db.fetchval("SELECT min(seq) FROM question_changes")
+                seq = oldest - 1 if oldest is not None else 0
+        seqs.store(category_id, seq, writes)
+        return seq
+
+    async def listing_version(self, category_id=None):
+        # the ETag listing_version() gives the Flask listing
+        _, categories_etag = await self.category_map()
+        return "{}-{}".format(await self.change_seq(category_id), categories_etag[:16])
+
+    async def question_total(self, category_id=None):
+        stats = self.flask_app.extensions["question_stats"]
+        if stats.stale():
+            rows = await self.db.fetch(
+                "SELECT category, difficulty, count(id) FROM questions "
+                "GROUP BY category, difficulty")
+            with stats.lock:
+                stats.fill(rows)
+        return stats.total(category_id)
+
+    async def page(self, scope, total, where="", args=()):
+        # Returns (questions, total_questions, next_cursor), as paginate_questions.
+        query = parse_qs(scope["query_string"].decode("latin-1"))
+
+        cursor = query.get("cursor", [None])[0]
+        if cursor:
+            args = args + (decode_cursor(cursor),)
+            condition = "{} id > ${}".format(" AND" if where else " WHERE", len(args))
+            sql = "{}{}{} ORDER BY id LIMIT {}".format(
+                QUESTION_SELECT, where, condition, QUESTIONS_PER_PAGE)
+        else:
+            try:
+                page = int(query.get("page", ["1"])[0])
+            except ValueError:
+                page = 1
+            if page < 1:
+                return [], total, None
+            if (page - 1) * QUESTIONS_PER_PAGE > MAX_ID:
+                raise BadRequest()
+            sql = "{}{} ORDER BY id LIMIT {} OFFSET {}".format(
+                QUESTION_SELECT, where, QUESTIONS_PER_PAGE, (page - 1) * QUESTIONS_PER_PAGE)
+
+        rows = await self.db.fetch(sql, *args)
+        next_cursor = None
+        if len(rows) == QUESTIONS_PER_PAGE:
+            next_cursor = encode_cursor(rows[-1][QUESTION_KEYS.index("id")])
+        return [dict(zip(QUESTION_KEYS, row)) for row in rows], total, next_cursor
+
+    async def categories(self, scope, body):
+        categories, etag = await self.category_map()
+        if len(categories) == 0:
+            return self.error(404)
+        headers, not_modified = revalidation(scope, etag)
+        if not_modified:
+            return 304, headers, None
+        return 200, headers, {
+            "success": True,
+            "categories": categories,
+            "total_categories": len(categories)
+        }
+
+    async def questions(self, scope, body):
+        headers, not_modified = revalidation(scope, await self.listing_version())
+        if not_modified:
+            return 304, headers, None
+        questions, total, next_cursor = await self.page(
+            scope, await self.question_total())
+        categories, _ = await self.category_map()
+        if len(questions) == 0:
+            return self.error(404)
+        return 200, headers, {
+            "success": True,
+            "questions": questions,
+            "total_questions": total,
+            "categories": categories,
+            "current_category": None,
+            "next_cursor": next_cursor
+        }
+
+    async def category_questions(self, scope, body, category_id):
+        category_id = int(category_id)
+        if category_id > MAX_ID:
+            return self.error(404)
+        headers, not_modified = revalidation(scope, await self.listing_version(category_id))
+        if not_modified:
+            return 304, headers, None
+        category_type = await self.db.fetchval(
+            "SELECT type FROM categories WHERE id = $1", category_id)
+        if category_type is None:
+            return self.error(404)
+        questions, total, next_cursor = await self.page(
+            scope, await self.question_total(category_id),
+            " WHERE category = $1", (category_id,))
+        if len(questions) == 0:
+            return self.error(404)
+        return 200, headers, {
+            "success": True,
+            "questions": questions,
+            "total_questions": total,
+            "current_category": category_type,
+            "next_cursor": next_cursor
+        }
+
+    async def quizzes(self, scope, body):
+        try:
+            data = json.loads(body.decode("utf-8"))
+        except ValueError:
+            return self.error(400)
+        category_id = quiz_category_id(data)
+        previous_questions = previous_question_ids(data)
+        mode = data.get("mode", "random")
+        if mode not in ("random", "adaptive"):
+            return self.error(400)
+        difficulty = None
+        if mode == "adaptive":
+            recent_answers = data.get("recent_answers", [])
+            if not isinstance(recent_answers, list):
+                return self.error(400)
+            difficulty = target_difficulty(recent_answers)
+
+        index = self.flask_app.extensions["quiz_index"]
+        excluded = set(previous_questions)
+        while True:
+            token = index.begin()
+            if token is not None:
+                rows = None
+                try:
+                    rows = await self.db.fetch("SELECT id, category, difficulty FROM questions")
+                finally:
+                    index.fill(token, rows)
+            with index.lock:
+                if index.buckets is None:
+                    continue
+                question_id = index.choose(category_id, excluded, difficulty)
+            if question_id is None:
+                question = None
+                break
+            rows = await self.db.fetch(
+                "SELECT answer, category, difficulty, id, question FROM questions "
+                "WHERE id = $1", question_id)
+            if rows:
+                question = dict(zip(QUESTION_KEYS, rows[0]))
+                break
+            index.remove(question_id)
+
+        payload = {"success": True, "question": question}
+        if difficulty is not None:
+            payload["target_difficulty"] = difficulty
+        return 200, [], payload
+
+    # Everything else runs on the Flask app.
+
+    async def call_wsgi(self, scope, body, send):
+        loop = asyncio.get_event_loop()
+        environ = wsgi_environ(scope, body)
+        # a small queue keeps streamed responses streamed, with backpressure
+        chunks = asyncio.Queue(maxsize=8)
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put((int(status.split(" ", 1)[0]), [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]))
+
+        def run():
+            # the whole response runs on one thread: Flask's request context,
+            # used by streamed responses, is bound to the thread
+            result = None
+            try:
+                result = self.flask_app(environ, start_response)
+                for chunk in result:
+                    if chunk:
+                        put(chunk)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+                put(None)
+
+        worker = loop.run_in_executor(None, run)
+        start = await chunks.get()
+        if start is None:
+            await worker  # raises what the app raised
+            return
+        status, headers = start
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        await worker
+
+
+def client_address(scope, header=None):
+    # the first address of the proxy header when one is set, as for Flask
+    if header:
+        name = header.lower().encode("latin-1")
+        for key, value in scope["headers"]:
+            if key == name:
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else None
+
+
+def revalidation(scope, etag):
+    # (ETag and Cache-Control headers, whether If-None-Match holds the ETag),
+    # as revalidated() sets them on Flask responses
+    quoted = '"{}"'.format(etag)
+    headers = [(b"etag", quoted.encode("ascii")), (b"cache-control", b"public, no-cache")]
+    for name, value in scope["headers"]:
+        if name == b"if-none-match" and quoted in value.decode("latin-1"):
+            return headers, True
+    return headers, False
+
+
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def create_asgi_app(test_config=None):
+    config = {
+        "ASYNC_POOL_MIN_SIZE": int(os.getenv("ASYNC_POOL_MIN_SIZE", 1)),
+        "ASYNC_POOL_MAX_SIZE": int(os.getenv("ASYNC_POOL_MAX_SIZE", 20)),
+    }
+    config.update(test_config or {})
+    return AsyncTriviaApp(create_app(config))
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        create_asgi_app(),
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", 5000)),
+        log_level="info")
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from flask import current_app, has_app_context
+
+from models import Category, on_category_write
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+class VersionCounter:
+    """Category version shared by every worker through a small file.
+
+    Without a path the counter only lives in this process.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.local = 0
+
+    def read(self):
+        if self.path is None:
+            return self.local
+        try:
+            with open(self.path) as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self):
+        if self.path is None:
+            self.local += 1
+            return self.local
+        with open(self.path, "a+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                version = int(f.read() or 0) + 1
+            except ValueError:
+                version = 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(version))
+            f.flush()
+            os.fsync(f.fileno())
+        return version
+
+
+class CategoryCache:
+    """Serves the {id: type} category map from memory.
+
+    The map is reloaded when it is older than `ttl` seconds or when the
+    shared version counter moved, i.e. a category was written by any worker.
+    """
+
+    def __init__(self, ttl=300, version_file=None):
+        self.ttl = ttl
+        self.counter = VersionCounter(version_file)
+        self.lock = threading.Lock()
+        self.categories = None
+        self.etag = None
+        self.version = None
+        self.loaded_at = 0
+
+    def stale(self, version):
+        expired = time.monotonic() - self.loaded_at > self.ttl
+        return self.categories is None or expired or version != self.version
+
+    def fill(self, rows, version):
+        # rows are (id, type) pairs ordered by id
+        categories = {category_id: type for category_id, type in rows}
+        payload = json.dumps(sorted(categories.items()), sort_keys=True)
+        self.categories = categories
+        self.etag = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def get(self):
+        # Returns (categories, etag).
+        version = self.counter.read()
+        with self.lock:
+            if self.stale(version):
+                self.fill(
+                    Category.query.order_by(Category.id).with_entities(
+                        Category.id, Category.type),
+                    version)
+            return self.categories, self.etag
+
+    def invalidate(self):
+        self.counter.bump()
+        with self.lock:
+            self.categories = None
+
+
+@on_category_write
+def invalidate_category_cache(action, category):
+    if not has_app_context():
+        return
+    cache = current_app.extensions.get("category_cache")
+    if cache is not None:
+        cache.invalidate()
@@ -0,0 +1,64 @@
+import threading
+import time
+from flask import current_app, has_app_context
+
+from models import QuestionChange, on_question_write
+
+
+class ChangeSeqs:
+    """The change log seq of each question listing, kept in memory.
+
+    latest() answers what QuestionChange.latest() does without a query on
+    every request: a seq is read from the database once and kept for `ttl`
+    seconds. A write made by this worker drops the seqs it may have moved,
+    so they are read again on the next request; writes made by other workers
+    are seen within `ttl` seconds.
+    """
+
+    def __init__(self, ttl=1):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # category id, or None for all questions: (seq, loaded_at)
+        self.seqs = {}
+        # bumped by every write, so a read that raced one is not kept
+        self.writes = 0
+
+    def cached(self, category_id=None):
+        # Returns (seq or None when it has to be read, token for store()).
+        with self.lock:
+            entry = self.seqs.get(category_id)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                return entry[0], self.writes
+            return None, self.writes
+
+    def store(self, category_id, seq, writes):
+        with self.lock:
+            if writes == self.writes:
+                self.seqs[category_id] = (seq, time.monotonic())
+
+    def latest(self, category_id=None):
+        seq, writes = self.cached(category_id)
+        if seq is None:
+            seq = QuestionChange.latest(category_id)
+            self.store(category_id, seq, writes)
+        return seq
+
+    def drop(self, category_id):
+        with self.lock:
+            self.writes += 1
+            self.seqs.pop(None, None)
+            if category_id is None:
+                # a change without a category counts for every category
+                self.seqs.clear()
+            else:
+                self.seqs.pop(category_id, None)
+
+
+@on_question_write
+def drop_change_seqs(action, question):
+    if not has_app_context():
+        return
+    seqs = current_app.extensions.get("change_seqs")
+    if seqs is None:
+        return
+    seqs.drop(None if action == "reload" else question["category"])
@@ -0,0 +1,51 @@
+import threading
+
+
+class Call:
+    """One run of a coalesced function, awaited by every caller of its key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one call per key at a time.
+
+    Callers that arrive while a call for their key is running wait for it
+    and get its result, or its exception, instead of running their own. A
+    caller that waits longer than `timeout` seconds runs the function itself.
+    """
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        # Returns (result, shared) where shared tells a waiter from the caller
+        # that ran fn.
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            if not call.done.wait(self.timeout):
+                return fn(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
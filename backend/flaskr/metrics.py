@@ -0,0 +1,133 @@
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+class Histogram:
+    """Prometheus histogram with one series per label set."""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0, 0]
+        counts = series[0]
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[position] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            label_text = ",".join('{}="{}"'.format(key, value) for key, value in labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, label_text, bound, cumulative))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label_text, count))
+            lines.append("{}_sum{{{}}} {}".format(self.name, label_text, total))
+            lines.append("{}_count{{{}}} {}".format(self.name, label_text, count))
+        return lines
+
+
+class Metrics:
+    """Per-endpoint request latency and database work.
+
+    Rows fetched are taken from the driver's row count, which psycopg2
+    reports for SELECT statements and SQLite does not.
+    """
+
+    def __init__(self, slow_request_ms=None):
+        self.slow_request_ms = slow_request_ms
+        self.lock = threading.Lock()
+        self.latency = Histogram(
+            "trivia_request_duration_seconds",
+            "Request latency by endpoint.", LATENCY_BUCKETS)
+        self.queries = Histogram(
+            "trivia_request_db_queries",
+            "Database round-trips per request.", QUERY_BUCKETS)
+        self.rows = Histogram(
+            "trivia_request_db_rows",
+            "Rows fetched from the database per request.", ROW_BUCKETS)
+        self.responses = {}
+
+    def init_app(self, app):
+        @app.before_request
+        def start_timer():
+            g.request_started = time.perf_counter()
+            g.db_queries = 0
+            g.db_rows = 0
+            # statements are only kept when they may be logged
+            g.db_statements = [] if self.slow_request_ms is not None else None
+
+        @app.after_request
+        def record_request(response):
+            started = g.get("request_started")
+            if started is None:
+                return response
+            duration = time.perf_counter() - started
+            labels = (("endpoint", request.endpoint or "unknown"), ("method", request.method))
+            with self.lock:
+                self.latency.observe(labels, duration)
+                self.queries.observe(labels, g.db_queries)
+                self.rows.observe(labels, g.db_rows)
+                key = labels + (("status", str(response.status_code)),)
+                self.responses[key] = self.responses.get(key, 0) + 1
+            if self.slow_request_ms is not None and duration * 1000 >= self.slow_request_ms:
+                app.logger.warning(
+                    "slow request %s %s took %.1fms with %d queries:\n%s",
+                    request.method, request.full_path, duration * 1000, g.db_queries,
+                    "\n".join("  %.1fms %s" % statement for statement in g.db_statements))
+            return response
+
+    def render(self):
+        lines = [
+            "# HELP trivia_responses_total Responses by endpoint and status.",
+            "# TYPE trivia_responses_total counter",
+        ]
+        with self.lock:
+            for labels, count in sorted(self.responses.items()):
+                lines.append("trivia_responses_total{{{}}} {}".format(
+                    ",".join('{}="{}"'.format(key, value) for key, value in labels), count))
+            lines.extend(self.latency.render())
+            lines.extend(self.queries.render())
+            lines.extend(self.rows.render())
+        return "\n".join(lines) + "\n"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "db_queries" in g:
+        context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(connection, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or "db_queries" not in g:
+        return
+    g.db_queries += 1
+    if cursor.rowcount is not None and cursor.rowcount > 0 and cursor.description:
+        g.db_rows += cursor.rowcount
+    if g.db_statements is not None:
+        started = getattr(context, "_query_started", None)
+        elapsed = 0 if started is None else (time.perf_counter() - started) * 1000
+        g.db_statements.append((elapsed, statement))
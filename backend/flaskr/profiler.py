@@ -0,0 +1,220 @@
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# runs of bound parameters, as in IN (?, ?, ?), are folded into one
+PARAMETERS_RE = re.compile(r"(\?|%\(\w+\)s)(,\s*(\?|%\(\w+\)s))+")
+SQL_LABEL_LENGTH = 80
+
+
+# label of each code object seen, shared by every profiler
+LABELS = {}
+
+
+def stack(endpoint, frame):
+    # collapsed stack of frame, outermost first, under the endpoint
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        label = LABELS.get(code)
+        if label is None:
+            filename = code.co_filename
+            label = LABELS[code] = "{} ({}/{}:{})".format(
+                code.co_name, os.path.basename(os.path.dirname(filename)),
+                os.path.basename(filename), code.co_firstlineno)
+        names.append(label)
+        frame = frame.f_back
+    names.append(endpoint)
+    return ";".join(reversed(names))
+
+
+def sql_label(statement):
+    # one flamegraph frame per statement shape
+    text = PARAMETERS_RE.sub("...", " ".join(statement.split()))
+    return "SQL " + text[:SQL_LABEL_LENGTH].replace(";", ",")
+
+
+class Trace:
+    """One profiled request: time per stack and its SQL spans, in microseconds.
+
+    Python time is sampled; SQL time is measured around every statement and
+    charged to the stack that ran it, so short queries are not missed.
+    """
+
+    def __init__(self, endpoint, thread_id):
+        self.endpoint = endpoint
+        self.thread_id = thread_id
+        self.started = self.sampled_at = time.perf_counter()
+        self.stacks = {}
+        # (start, duration, statement) with start from the request start
+        self.spans = []
+        self.sql = None
+        # the sampler and the request's SQL spans both add time
+        self.lock = threading.Lock()
+
+    def add(self, stack, microseconds):
+        with self.lock:
+            self.stacks[stack] = self.stacks.get(stack, 0) + microseconds
+
+
+class Profiler:
+    """Sampling profiler for a share of an endpoint's requests.
+
+    Requests to `endpoints` are profiled with probability `sample_rate`,
+    and any request whose `header` holds `token`. While one is running, a
+    thread samples its stack every `interval` seconds; other requests pay
+    for one random draw. Each profiled request appends its stacks to
+    <directory>/<endpoint>.folded, in the collapsed format flamegraph
+    tools read, weighted by microseconds, and its SQL statements to
+    <endpoint>.sql.tsv. It also gets a Server-Timing header.
+    """
+
+    def __init__(self, directory, endpoints=(), sample_rate=0.01, token=None,
+                 interval=0.005, header="X-Profile"):
+        self.directory = directory
+        self.endpoints = set(endpoints)
+        self.sample_rate = sample_rate
+        self.token = token
+        self.interval = interval
+        self.header = header
+        self.lock = threading.Lock()
+        self.traces = {}
+        self.running = threading.Event()
+        self.sampler = None
+
+    def init_app(self, app):
+        os.makedirs(self.directory, exist_ok=True)
+        for name, listener in SQL_LISTENERS:
+            if not event.contains(Engine, name, listener):
+                event.listen(Engine, name, listener)
+
+        @app.before_request
+        def start_profile():
+            if self.wanted():
+                g.profile = self.start(request.endpoint or "unknown")
+
+        @app.after_request
+        def finish_profile(response):
+            trace = g.pop("profile", None)
+            if trace is not None:
+                self.stop(trace)
+                self.write(trace)
+                total = (time.perf_counter() - trace.started) * 1000
+                sql = sum(duration for start, duration, statement in trace.spans) / 1000
+                response.headers["Server-Timing"] = (
+                    'total;dur={:.1f}, sql;dur={:.1f};desc="{} statements"'.format(
+                        total, sql, len(trace.spans)))
+            return response
+
+        @app.teardown_request
+        def drop_profile(exception=None):
+            # a request that failed before after_request is not written
+            trace = g.pop("profile", None)
+            if trace is not None:
+                self.stop(trace)
+
+    def wanted(self):
+        if self.token:
+            sent = request.headers.get(self.header)
+            if sent and hmac.compare_digest(sent, self.token):
+                return True
+        return request.endpoint in self.endpoints and random.random() < self.sample_rate
+
+    def start(self, endpoint):
+        trace = Trace(endpoint, threading.get_ident())
+        with self.lock:
+            self.traces[trace.thread_id] = trace
+            if self.sampler is None or not self.sampler.is_alive():
+                self.sampler = threading.Thread(
+                    target=self.sample, name="profiler", daemon=True)
+                self.sampler.start()
+            self.running.set()
+        return trace
+
+    def stop(self, trace):
+        with self.lock:
+            if self.traces.get(trace.thread_id) is trace:
+                del self.traces[trace.thread_id]
+            if not self.traces:
+                self.running.clear()
+
+    def sample(self):
+        while True:
+            self.running.wait()
+            time.sleep(self.interval)
+            with self.lock:
+                frames = sys._current_frames()
+                now = time.perf_counter()
+                for trace in self.traces.values():
+                    frame = frames.get(trace.thread_id)
+                    elapsed = now - trace.sampled_at
+                    trace.sampled_at = now
+                    # time spent in SQL is charged when the statement ends
+                    if frame is not None and trace.sql is None:
+                        trace.add(stack(trace.endpoint, frame), int(elapsed * 1e6))
+
+    def write(self, trace):
+        path = os.path.join(self.directory, trace.endpoint)
+        stacks = "".join(
+            "{} {}\n".format(folded, microseconds)
+            for folded, microseconds in trace.stacks.items() if microseconds > 0)
+        spans = "".join(
+            "{}\t{}\t{:.3f}\t{:.3f}\t{}\n".format(
+                trace.endpoint, os.getpid(), start / 1000, duration / 1000, statement)
+            for start, duration, statement in trace.spans)
+        # one append per file, so workers writing at once do not interleave
+        for suffix, text in ((".folded", stacks), (".sql.tsv", spans)):
+            if text:
+                descriptor = os.open(path + suffix, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                try:
+                    os.write(descriptor, text.encode("utf-8"))
+                finally:
+                    os.close(descriptor)
+
+
+def current_trace():
+    return g.get("profile") if has_request_context() else None
+
+
+def start_sql_span(connection, cursor, statement, parameters, context, executemany):
+    trace = current_trace()
+    if trace is not None and trace.thread_id == threading.get_ident():
+        trace.sql = (time.perf_counter(), stack(trace.endpoint, sys._getframe(1)), statement)
+
+
+def end_sql_span(connection, cursor, statement, parameters, context, executemany):
+    finish_sql_span()
+
+
+def fail_sql_span(context):
+    finish_sql_span()
+
+
+def finish_sql_span():
+    trace = current_trace()
+    if trace is None or trace.sql is None:
+        return
+    started, caller, statement = trace.sql
+    trace.sql = None
+    now = time.perf_counter()
+    duration = int((now - started) * 1e6)
+    label = sql_label(statement)
+    trace.add("{};{}".format(caller, label), duration)
+    trace.spans.append((int((started - trace.started) * 1e6), duration, label[4:]))
+    # the sampler starts counting Python time again from here
+    trace.sampled_at = now
+
+
+SQL_LISTENERS = (
+    ("before_cursor_execute", start_sql_span),
+    ("after_cursor_execute", end_sql_span),
+    ("handle_error", fail_sql_span),
+)
@@ -0,0 +1,436 @@
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from flask import current_app, has_app_context
+
+from models import db, Question, on_question_write
+from .snapshot import current_snapshot
+
+
+# ALL_CATEGORIES is the quiz_category id the frontend sends for "All".
+ALL_CATEGORIES = 0
+# Random draws tried before falling back to a scan of the remaining ids.
+MAX_DRAWS = 8
+# Adaptive quizzes aim at START_DIFFICULTY, one level up for every correct
+# answer and one down for every wrong one among the last ADAPTIVE_WINDOW.
+START_DIFFICULTY = 3
+ADAPTIVE_WINDOW = 4
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+# Draw weight of a difficulty by its distance from the target; never zero, so
+# a quiz goes on with other difficulties once the target's are used up.
+DIFFICULTY_WEIGHTS = (8, 4, 2, 1, 1)
+
+
+def target_difficulty(recent_answers):
+    # recent_answers are booleans, most recent last
+    recent = recent_answers[-ADAPTIVE_WINDOW:] if ADAPTIVE_WINDOW else []
+    target = START_DIFFICULTY + sum(1 if correct else -1 for correct in recent)
+    return min(MAX_DIFFICULTY, max(MIN_DIFFICULTY, target))
+
+
+class IdBucket:
+    """A set of question ids with O(1) add, remove and random draw."""
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, question_id):
+        return question_id in self.positions
+
+    def add(self, question_id):
+        if question_id in self.positions:
+            return
+        self.positions[question_id] = len(self.ids)
+        self.ids.append(question_id)
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if last != question_id:
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def draw(self, excluded):
+        # excluded is a set of ids; count how many of them live in this bucket
+        remaining = len(self.ids) - sum(1 for i in excluded if i in self.positions)
+        if remaining <= 0:
+            return None
+        # rejection sampling is O(1) while most of the bucket is still eligible
+        if remaining * MAX_DRAWS >= len(self.ids):
+            for _ in range(MAX_DRAWS):
+                question_id = random.choice(self.ids)
+                if question_id not in excluded:
+                    return question_id
+        # late in a quiz only a few ids are left, so pick the n-th eligible one
+        target = random.randrange(remaining)
+        for question_id in self.ids:
+            if question_id in excluded:
+                continue
+            if target == 0:
+                return question_id
+            target -= 1
+        return None
+
+
+def place(buckets, levels, question_id, category, difficulty):
+    categories = [ALL_CATEGORIES]
+    if category is not None:
+        categories.append(int(category))
+    for category_id in categories:
+        buckets.setdefault(category_id, IdBucket()).add(question_id)
+        if difficulty is not None:
+            levels.setdefault((category_id, int(difficulty)), IdBucket()).add(question_id)
+
+
+def unplace(buckets, levels, question_id):
+    for bucket in buckets.values():
+        bucket.remove(question_id)
+    for bucket in levels.values():
+        bucket.remove(question_id)
+
+
+class QuizIndex:
+    """Per-category id index used to draw quiz questions.
+
+    Only ids are kept in memory, bucketed by category and by (category,
+    difficulty) for adaptive quizzes; the full row of the drawn question is
+    read by id from the app's storage backend. The index is rebuilt after
+    `ttl` seconds so writes made by other workers are picked up. A rebuild
+    reads and buckets the rows without the lock, while other threads draw
+    from the old buckets, and the writes made meanwhile are replayed on the
+    new ones before they are swapped in.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.buckets = None
+        self.levels = None
+        self.loaded_at = 0
+        # rebuilds in progress, and the writes they have to replay
+        self.building = 0
+        self.writes = []
+        # bumped by every reset, so a rebuild that raced one is discarded
+        self.generation = 0
+
+    def stale(self):
+        return self.buckets is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def begin(self):
+        # Returns a token for fill(), or None when there is nothing to
+        # rebuild: the index is fresh, or another thread is rebuilding it and
+        # the old buckets can be used until then.
+        with self.lock:
+            if not self.stale() or (self.building and self.buckets is not None):
+                return None
+            self.building += 1
+            return self.generation, len(self.writes)
+
+    def fill(self, token, rows):
+        # rows are (id, category, difficulty) triples, or None when reading
+        # them failed; the buckets are built without the lock
+        built = None
+        try:
+            if rows is not None:
+                buckets, levels = {ALL_CATEGORIES: IdBucket()}, {}
+                for question_id, category, difficulty in rows:
+                    place(buckets, levels, question_id, category, difficulty)
+                built = buckets, levels
+        finally:
+            self.swap(token, built)
+
+    def swap(self, token, built):
+        generation, start = token
+        with self.lock:
+            self.building -= 1
+            if built is not None and generation == self.generation:
+                buckets, levels = built
+                for action, question in self.writes[start:]:
+                    if action == "insert":
+                        place(buckets, levels, question["id"], question["category"],
+                              question["difficulty"])
+                    else:
+                        unplace(buckets, levels, question["id"])
+                self.buckets, self.levels = buckets, levels
+                self.loaded_at = time.monotonic()
+            if not self.building:
+                self.writes = []
+
+    def load(self):
+        token = self.begin()
+        if token is None:
+            return
+        rows = None
+        try:
+            snapshot = current_snapshot()
+            if snapshot is not None:
+                rows = snapshot.quiz_rows()
+            else:
+                rows = db.session.query(
+                    Question.id, Question.category, Question.difficulty).all()
+        finally:
+            self.fill(token, rows)
+
+    def warm(self):
+        self.load()
+
+    def bucket(self, category_id):
+        self.load()
+        with self.lock:
+            return self.buckets.get(category_id) if self.buckets is not None else None
+
+    def add(self, question):
+        with self.lock:
+            if self.building:
+                self.writes.append(("insert", question))
+            if self.buckets is None:
+                return
+            place(self.buckets, self.levels, question["id"], question["category"],
+                  question["difficulty"])
+
+    def reset(self):
+        with self.lock:
+            self.generation += 1
+            self.buckets = None
+            self.levels = None
+
+    def remove(self, question_id):
+        with self.lock:
+            if self.building:
+                self.writes.append(("delete", {"id": question_id}))
+            if self.buckets is None:
+                return
+            unplace(self.buckets, self.levels, question_id)
+
+    def choose(self, category_id, excluded, difficulty=None):
+        # Returns an id of the category not in excluded, or None; call with
+        # the lock held. With a target difficulty the level is drawn first,
+        # weighted by its distance from the target: O(1) in the bank size.
+        if difficulty is None:
+            bucket = self.buckets.get(category_id)
+            return bucket.draw(excluded) if bucket is not None else None
+        levels = [level for category, level in self.levels if category == category_id]
+        while levels:
+            weights = [
+                DIFFICULTY_WEIGHTS[min(abs(level - difficulty), len(DIFFICULTY_WEIGHTS) - 1)]
+                for level in levels
+            ]
+            level = random.choices(levels, weights)[0]
+            question_id = self.levels[(category_id, level)].draw(excluded)
+            if question_id is not None:
+                return question_id
+            levels.remove(level)
+        return None
+
+    def ids(self, category_id):
+        # a shuffled copy of the category's ids, 4 bytes per question
+        bucket = self.bucket(category_id)
+        with self.lock:
+            ids = array("i", bucket.ids if bucket is not None else ())
+        random.shuffle(ids)
+        return ids
+
+    def draw(self, category_id, previous_questions, difficulty=None):
+        # Returns a random question of the category not in previous_questions,
+        # near the target difficulty when one is given, or None once the
+        # category is exhausted.
+        excluded = set(previous_questions)
+        while True:
+            self.load()
+            with self.lock:
+                if self.buckets is None:
+                    # reset since it was loaded
+                    continue
+                question_id = self.choose(category_id, excluded, difficulty)
+            if question_id is None:
+                return None
+            question = current_app.extensions["storage"].question(question_id)
+            if question is not None:
+                return question
+            # deleted by another worker since the index was loaded
+            self.remove(question_id)
+
+
+class QuizSessions:
+    """Server-side quiz sessions holding the ids a player has not seen yet.
+
+    Each session is a shuffled array of the category's ids taken when the
+    quiz starts; drawing pops from its end. Sessions expire `ttl` seconds
+    after their last draw. At most `limit` are kept, holding at most
+    `max_ids` ids between them, least recently used first out; the newest
+    session is always kept. They live in the worker's memory; use
+    DiskQuizSessions when several workers serve the same players.
+    """
+
+    def __init__(self, index, ttl=3600, limit=10000, max_ids=50000000):
+        self.index = index
+        self.ttl = ttl
+        self.limit = limit
+        self.max_ids = max_ids
+        self.lock = threading.Lock()
+        # session id: [remaining ids, expiry, ids at creation]
+        self.sessions = OrderedDict()
+        # ids held by the sessions, counted as they were created
+        self.held = 0
+
+    def create(self, category_id):
+        # Returns (session id, number of questions in the quiz).
+        remaining = self.index.ids(category_id)
+        session_id = secrets.token_urlsafe(16)
+        with self.lock:
+            self.expire()
+            self.sessions[session_id] = [remaining, time.monotonic() + self.ttl, len(remaining)]
+            self.held += len(remaining)
+            while len(self.sessions) > 1 and (
+                    len(self.sessions) > self.limit or self.held > self.max_ids):
+                self.evict()
+        return session_id, len(remaining)
+
+    def evict(self):
+        # drops the least recently used session; call with the lock held
+        session_id, session = self.sessions.popitem(last=False)
+        self.held -= session[2]
+
+    def expire(self):
+        now = time.monotonic()
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session[1] > now:
+                break
+            self.evict()
+
+    def draw(self, session_id):
+        """Returns (formatted question or None when the quiz is over, ids left).
+
+        Raises KeyError for an unknown or expired session.
+        """
+        while True:
+            with self.lock:
+                self.expire()
+                session = self.sessions[session_id]
+                session[1] = time.monotonic() + self.ttl
+                self.sessions.move_to_end(session_id)
+                remaining = session[0]
+                if not remaining:
+                    return None, 0
+                question_id = remaining.pop()
+            question = current_app.extensions["storage"].question(question_id)
+            if question is not None:
+                return question, len(remaining)
+            # deleted since the quiz started
+
+
+class DiskQuizSessions:
+    """Quiz sessions in a SQLite file shared by every worker.
+
+    Works like QuizSessions, so a player's draws can land on any worker.
+    Each session is a row holding its shuffled ids as a blob and the number
+    not drawn yet; a draw decrements that number and reads the id at its
+    position, in one write transaction.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS quiz_sessions ("
+        "id TEXT PRIMARY KEY, ids BLOB, remaining INTEGER, size INTEGER, expires REAL)"
+    )
+
+    def __init__(self, index, path, ttl=3600, limit=10000, max_ids=50000000):
+        self.index = index
+        self.path = path
+        self.ttl = ttl
+        self.limit = limit
+        self.max_ids = max_ids
+        self.local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(self.SCHEMA)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS quiz_sessions_expires ON quiz_sessions (expires)")
+
+    def connect(self):
+        # sqlite3 connections can not be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self.local.connection = connection
+        return connection
+
+    def create(self, category_id):
+        # Returns (session id, number of questions in the quiz).
+        remaining = self.index.ids(category_id)
+        session_id = secrets.token_urlsafe(16)
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute("DELETE FROM quiz_sessions WHERE expires <= ?", (now,))
+            connection.execute(
+                "INSERT INTO quiz_sessions VALUES (?, ?, ?, ?, ?)",
+                (session_id, remaining.tobytes(), len(remaining), len(remaining),
+                 now + self.ttl))
+            # the least recently used go first; the newest is always kept
+            connection.execute(
+                "DELETE FROM quiz_sessions WHERE id IN ("
+                "SELECT id FROM (SELECT id,"
+                " row_number() OVER recent AS sessions, sum(size) OVER recent AS held"
+                " FROM quiz_sessions WINDOW recent AS (ORDER BY expires DESC, rowid DESC))"
+                " WHERE sessions > 1 AND (sessions > ? OR held > ?))",
+                (self.limit, self.max_ids))
+        return session_id, len(remaining)
+
+    def draw(self, session_id):
+        """Returns (formatted question or None when the quiz is over, ids left).
+
+        Raises KeyError for an unknown or expired session.
+        """
+        while True:
+            now = time.time()
+            with self.connect() as connection:
+                cursor = connection.execute(
+                    "UPDATE quiz_sessions SET remaining = remaining - 1, expires = ?"
+                    " WHERE id = ? AND expires > ? AND remaining > 0",
+                    (now + self.ttl, session_id, now))
+                if cursor.rowcount == 0:
+                    # over, or unknown
+                    cursor = connection.execute(
+                        "UPDATE quiz_sessions SET expires = ? WHERE id = ? AND expires > ?",
+                        (now + self.ttl, session_id, now))
+                    if cursor.rowcount == 0:
+                        raise KeyError(session_id)
+                    return None, 0
+                # the id just past the new count, as QuizSessions pops its last
+                remaining, ids = connection.execute(
+                    "SELECT remaining, substr(ids, remaining * 4 + 1, 4)"
+                    " FROM quiz_sessions WHERE id = ?", (session_id,)).fetchone()
+            question_id = array("i", ids)[0]
+            question = current_app.extensions["storage"].question(question_id)
+            if question is not None:
+                return question, remaining
+            # deleted since the quiz started
+
+
+@on_question_write
+def update_quiz_index(action, question):
+    if not has_app_context():
+        return
+    index = current_app.extensions.get("quiz_index")
+    if index is None:
+        return
+    if action == "insert":
+        index.add(question)
+    elif action == "delete":
+        index.remove(question["id"])
+    elif action == "reload":
+        index.reset()
@@ -0,0 +1,74 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+
+
+class RateLimited(TooManyRequests):
+    # Werkzeug's TooManyRequests takes no retry_after before 1.0
+    def __init__(self, retry_after):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token bucket per client and endpoint.
+
+    A bucket holds up to `burst` tokens and refills at `rate` tokens per
+    second; each request takes one, and a request that finds the bucket
+    empty is answered 429 with a Retry-After header. `limits` maps endpoint
+    names to their own (rate, burst), where a rate of 0 exempts the
+    endpoint. At most `max_clients` buckets are kept, least recently used
+    first out; an evicted client starts again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, limits=None, client_header=None, max_clients=100000):
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits or {}
+        self.client_header = client_header
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def init_app(self, app):
+        @app.before_request
+        def limit_request():
+            # CORS preflights are answered without touching the app
+            if request.method == "OPTIONS":
+                return
+            wait = self.take(self.client(), request.endpoint or "unknown")
+            if wait:
+                raise RateLimited(max(1, math.ceil(wait)))
+
+    def client(self):
+        # the first address of the header set by a trusted proxy, if any
+        if self.client_header:
+            forwarded = request.headers.get(self.client_header)
+            if forwarded:
+                return forwarded.split(",")[0].strip()
+        return request.remote_addr
+
+    def take(self, client, endpoint):
+        # Takes a token; returns 0, or the seconds until one is available.
+        rate, burst = self.limits.get(endpoint, (self.rate, self.burst))
+        if not rate:
+            return 0
+        key = (client, endpoint)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+                while len(self.buckets) > self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
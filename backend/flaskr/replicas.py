@@ -0,0 +1,75 @@
+import random
+import time
+from flask import current_app, g, has_request_context, request
+
+from models import on_category_write, on_question_write
+
+
+# methods whose handlers only read; other methods need read_only to say so
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def read_only(view):
+    """Marks a view that does not write, so it may read from a replica."""
+    view.read_only = True
+    return view
+
+
+class ReplicaRouter:
+    """Sends the reads of read-only requests to a replica.
+
+    Each such request picks one of the app's replica binds at random and
+    every statement it runs goes there; writes and the requests around them
+    use the primary. A request that writes sets a cookie, and the client's
+    reads go to the primary for `sticky` seconds after it, so it reads its
+    own writes while the replicas catch up.
+    """
+
+    COOKIE = "primary_until"
+
+    def __init__(self, sticky=5):
+        self.sticky = sticky
+
+    def init_app(self, app):
+        binds = sorted(app.config.get("SQLALCHEMY_BINDS") or ())
+        self.binds = [bind for bind in binds if bind.startswith("replica_")]
+
+        @app.before_request
+        def choose_bind():
+            g.db_read_bind = None
+            g.db_wrote = False
+            if not self.binds or not self.reads_only() or self.pinned():
+                return
+            g.db_read_bind = random.choice(self.binds)
+
+        @app.after_request
+        def pin_to_primary(response):
+            if g.get("db_wrote") and self.sticky:
+                response.set_cookie(
+                    self.COOKIE, str(int(time.time() + self.sticky)),
+                    max_age=self.sticky, httponly=True, samesite="Lax")
+            return response
+
+    def reads_only(self):
+        if request.method in READ_METHODS:
+            return True
+        view = current_app.view_functions.get(request.endpoint)
+        return getattr(view, "read_only", False)
+
+    def pinned(self):
+        try:
+            until = int(request.cookies.get(self.COOKIE, 0))
+        except ValueError:
+            return False
+        return until > time.time()
+
+
+def note_write(action, data):
+    # the rest of the request, and the client's next reads, use the primary
+    if has_request_context() and "db_wrote" in g:
+        g.db_wrote = True
+        g.db_read_bind = None
+
+
+on_question_write(note_write)
+on_category_write(note_write)
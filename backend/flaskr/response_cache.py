@@ -0,0 +1,230 @@
+import functools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, has_app_context, request
+
+from models import on_question_write, on_category_write
+
+
+class MemoryCache:
+    """LRU of serialized responses bounded by entry count and age."""
+
+    def __init__(self, max_entries=1024, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.scopes = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            scope, body, expires = entry
+            if expires < time.monotonic():
+                self.discard(key)
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def set(self, scope, key, body):
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (scope, body, time.monotonic() + self.ttl)
+            self.scopes.setdefault(scope, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            keys = self.scopes.get(entry[0])
+            keys.discard(key)
+            if not keys:
+                del self.scopes[entry[0]]
+
+    def invalidate(self, scope):
+        with self.lock:
+            for key in list(self.scopes.get(scope, ())):
+                self.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.scopes.clear()
+
+
+class DiskCache:
+    """Serialized responses in a SQLite file shared by every worker.
+
+    Invalidations made by one worker are seen by all of them.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "key TEXT PRIMARY KEY, scope TEXT, body BLOB, expires REAL)"
+    )
+    # sets between two purges of expired and excess entries
+    PURGE_EVERY = 100
+
+    def __init__(self, path, max_entries=1024, ttl=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        self.sets = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(self.SCHEMA)
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope)")
+
+    def connect(self):
+        # sqlite3 connections can not be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self.connect().execute(
+            "SELECT body FROM responses WHERE key = ? AND expires > ?",
+            (key, time.time())).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def set(self, scope, key, body):
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, scope, body, time.time() + self.ttl))
+            self.sets += 1
+            if self.sets % self.PURGE_EVERY == 0:
+                connection.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+                connection.execute(
+                    "DELETE FROM responses WHERE key NOT IN ("
+                    "SELECT key FROM responses ORDER BY expires DESC LIMIT ?)",
+                    (self.max_entries,))
+
+    def invalidate(self, scope):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM responses WHERE scope = ?", (scope,))
+
+    def clear(self):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM responses")
+
+
+def make_response_cache(config):
+    # Returns the cache configured for the app, or None when disabled.
+    max_entries = config["RESPONSE_CACHE_SIZE"]
+    if not max_entries:
+        return None
+    if config["RESPONSE_CACHE_PATH"]:
+        return DiskCache(
+            config["RESPONSE_CACHE_PATH"], max_entries, config["RESPONSE_CACHE_TTL"])
+    return MemoryCache(max_entries, config["RESPONSE_CACHE_TTL"])
+
+
+def category_scope(category_id):
+    return "category:{}".format(int(category_id))
+
+
+def cached(scope, version=None):
+    """Caches successful responses of a GET view by route and query args.
+
+    scope is called with the view arguments and names the group of entries
+    that a write invalidates together. Concurrent misses of the same key
+    run the view once when the app has a single_flight extension, and the
+    others get a copy of its status and body.
+
+    version, when given, is called first with the view arguments and names
+    the state of the data the response is built from. It is part of the
+    key, so a cached response is never older than it, and it is sent as a
+    strong ETag: a request whose If-None-Match holds it gets a 304 without
+    running the view.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            etag = version(**kwargs) if version is not None else None
+            if etag is not None and request.if_none_match.contains(etag):
+                return revalidated(current_app.response_class(status=304), etag)
+            response = respond(view, kwargs, etag)
+            if etag is not None and response.status_code == 200:
+                revalidated(response, etag)
+            return response
+
+        def respond(view, kwargs, etag):
+            cache = current_app.extensions.get("response_cache")
+            flight = current_app.extensions.get("single_flight")
+            if cache is None and flight is None:
+                return current_app.make_response(view(**kwargs))
+            key = "{}?{}".format(request.path, "&".join(
+                "{}={}".format(name, value)
+                for name, value in sorted(request.args.items(multi=True))))
+            if etag is not None:
+                key = "{}#{}".format(key, etag)
+            if cache is not None:
+                body = cache.get(key)
+                if body is not None:
+                    return current_app.response_class(body, mimetype="application/json")
+
+            def render():
+                response = current_app.make_response(view(**kwargs))
+                if response.status_code == 200 and cache is not None:
+                    cache.set(scope(**kwargs), key, response.get_data())
+                return response.status_code, response.get_data(), response.mimetype
+
+            if flight is None:
+                status, body, mimetype = render()
+            else:
+                # requests reading from the primary do not share a replica's page
+                (status, body, mimetype), _ = flight.do(
+                    (key, g.get("db_read_bind") is None), render)
+            return current_app.response_class(body, status=status, mimetype=mimetype)
+
+        return wrapper
+    return decorator
+
+
+def revalidated(response, etag):
+    # clients keep the response and revalidate it with If-None-Match
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@on_question_write
+def invalidate_question_responses(action, question):
+    if not has_app_context():
+        return
+    cache = current_app.extensions.get("response_cache")
+    if cache is None:
+        return
+    if action == "reload":
+        cache.clear()
+        return
+    # total_questions changes on every page of the listing and of the
+    # question's category; other categories stay cached
+    cache.invalidate("questions")
+    if question["category"] is not None:
+        cache.invalidate(category_scope(question["category"]))
+
+
+@on_category_write
+def invalidate_category_responses(action, category):
+    if not has_app_context():
+        return
+    cache = current_app.extensions.get("response_cache")
+    if cache is None:
+        return
+    # /questions embeds the category map, category listings the type
+    cache.invalidate("questions")
+    cache.invalidate(category_scope(category["id"]))
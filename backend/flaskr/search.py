@@ -0,0 +1,186 @@
+import bisect
+import re
+import threading
+import time
+from flask import current_app, has_app_context
+from sqlalchemy import func, literal_column
+
+from models import db, Question, on_question_write
+
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+# Question text counts more than answer text when ranking.
+QUESTION_WEIGHT = 2
+ANSWER_WEIGHT = 1
+
+# Must match the expression of questions_search_idx (see migrations.py) for
+# PostgreSQL to use the index. Question words get weight A, answer words B.
+DOCUMENT_SQL = (
+    "(setweight(to_tsvector('english', coalesce(questions.question, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(questions.answer, '')), 'B'))"
+)
+# ts_rank weights for D, C, B and A, in the ratio of the in-process index
+RANK_WEIGHTS_SQL = "'{{0, 0, {}, 1}}'::float4[]".format(ANSWER_WEIGHT / QUESTION_WEIGHT)
+
+
+def tokenize(value):
+    return TOKEN_RE.findall((value or "").lower())
+
+
+class PostgresSearch:
+    """Prefix full-text search on a tsvector GIN index, ranked by ts_rank."""
+
+    def search(self, term, offset, limit):
+        tokens = tokenize(term)
+        if not tokens:
+            total = db.session.query(func.count(Question.id)).scalar()
+            ids = db.session.query(Question.id).order_by(Question.id)
+            return [row[0] for row in ids.offset(offset).limit(limit)], total
+
+        document = literal_column(DOCUMENT_SQL)
+        query = func.to_tsquery(
+            "english", " & ".join(token + ":*" for token in tokens))
+        match = document.op("@@")(query)
+
+        total = db.session.query(func.count(Question.id)).filter(match).scalar()
+        ids = db.session.query(Question.id).filter(match).order_by(
+            func.ts_rank(literal_column(RANK_WEIGHTS_SQL), document, query).desc(),
+            Question.id)
+        return [row[0] for row in ids.offset(offset).limit(limit)], total
+
+    def apply(self, action, question):
+        # the GIN index is maintained by PostgreSQL itself
+        pass
+
+
+class InvertedIndex:
+    """In-process inverted index over question and answer text.
+
+    Used for SQLite and tests. Query tokens match indexed tokens by prefix,
+    so partially typed words still find results; every query token must
+    match. The index is reloaded after `ttl` seconds to pick up writes
+    made by other workers.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.postings = None
+        self.loaded_at = 0
+
+    def load(self):
+        self.postings = {}
+        self.tokens = []
+        self.documents = {}
+        # tokens are appended unsorted while loading and sorted once at the end
+        self.loaded_at = 0
+        rows = db.session.query(Question.id, Question.question, Question.answer)
+        for question_id, question, answer in rows:
+            self.add(question_id, question, answer)
+        self.tokens.sort()
+        self.loaded_at = time.monotonic()
+
+    def add(self, question_id, question, answer):
+        weights = {}
+        for token in tokenize(question):
+            weights[token] = weights.get(token, 0) + QUESTION_WEIGHT
+        for token in tokenize(answer):
+            weights[token] = weights.get(token, 0) + ANSWER_WEIGHT
+        self.documents[question_id] = list(weights)
+        for token, weight in weights.items():
+            if token not in self.postings:
+                self.postings[token] = {}
+                if self.loaded_at:
+                    bisect.insort(self.tokens, token)
+                else:
+                    self.tokens.append(token)
+            self.postings[token][question_id] = weight
+
+    def remove(self, question_id):
+        for token in self.documents.pop(question_id, ()):
+            posting = self.postings[token]
+            posting.pop(question_id, None)
+            if not posting:
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+    def match(self, prefix):
+        # scores of every document containing a token starting with prefix
+        scores = {}
+        position = bisect.bisect_left(self.tokens, prefix)
+        while position < len(self.tokens) and self.tokens[position].startswith(prefix):
+            for question_id, weight in self.postings[self.tokens[position]].items():
+                scores[question_id] = scores.get(question_id, 0) + weight
+            position += 1
+        return scores
+
+    def search(self, term, offset, limit):
+        tokens = tokenize(term)
+        with self.lock:
+            if self.postings is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.load()
+            if not tokens:
+                ids = sorted(self.documents)
+                return ids[offset:offset + limit], len(ids)
+
+            scores = None
+            for token in tokens:
+                matches = self.match(token)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {
+                        question_id: score + matches[question_id]
+                        for question_id, score in scores.items()
+                        if question_id in matches
+                    }
+                if not scores:
+                    return [], 0
+
+        ranked = sorted(scores, key=lambda question_id: (-scores[question_id], question_id))
+        return ranked[offset:offset + limit], len(ranked)
+
+    def apply(self, action, question):
+        with self.lock:
+            if self.postings is None:
+                return
+            if action == "insert":
+                self.add(question["id"], question["question"], question["answer"])
+            elif action == "delete":
+                self.remove(question["id"])
+            elif action == "reload":
+                self.postings = None
+
+
+class QuestionSearch:
+    """Picks the search backend for the bound database on first use."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.backend = None
+
+    def choose(self):
+        if self.backend is None:
+            if db.engine.dialect.name == "postgresql":
+                self.backend = PostgresSearch()
+            else:
+                self.backend = InvertedIndex(self.ttl)
+        return self.backend
+
+    def search(self, term, offset, limit):
+        # Returns (ids of one page in rank order, total number of matches).
+        return self.choose().search(term, offset, limit)
+
+    def warm(self):
+        # loads the in-process index now instead of on the first search
+        if isinstance(self.choose(), InvertedIndex):
+            self.backend.search("", 0, 0)
+
+
+@on_question_write
+def update_search_index(action, question):
+    if not has_app_context():
+        return
+    search = current_app.extensions.get("question_search")
+    if search is not None and search.backend is not None:
+        search.backend.apply(action, question)
@@ -0,0 +1,74 @@
+import json
+from flask import current_app, jsonify
+
+from models import Question
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Question columns in the key order jsonify writes them (sorted), so rows
+# can be built straight from query tuples without building ORM objects.
+QUESTION_KEYS = ("answer", "category", "difficulty", "id", "question")
+QUESTION_COLUMNS = tuple(getattr(Question, key) for key in QUESTION_KEYS)
+ID_POSITION = QUESTION_KEYS.index("id")
+
+
+def question_rows(rows):
+    # rows are tuples selected with QUESTION_COLUMNS
+    return [dict(zip(QUESTION_KEYS, row)) for row in rows]
+
+
+def ordered(value):
+    # Orders dict keys the way json.dumps(sort_keys=True) does: sorted on the
+    # original keys, which are then turned into JSON strings. Floats raise
+    # TypeError, as orjson writes some of them differently: 1e-7 for 1e-07,
+    # null for NaN and Infinity.
+    if isinstance(value, float):
+        raise TypeError("float")
+    if isinstance(value, dict):
+        return {
+            json_key(key): ordered(item) for key, item in sorted(value.items())
+        }
+    if isinstance(value, (list, tuple)):
+        return [ordered(item) for item in value]
+    return value
+
+
+def json_key(key):
+    if isinstance(key, str):
+        return key
+    return json.dumps(key).strip('"')
+
+
+def dumps(payload):
+    """Serializes payload to the exact bytes jsonify would produce.
+
+    Uses orjson when it is installed. Its output differs from the standard
+    library for non-ASCII text, which jsonify escapes, for floats, and for
+    values it can not encode; all of them fall back to the standard encoder.
+    """
+    if orjson is not None:
+        try:
+            body = orjson.dumps(ordered(payload))
+        except TypeError:
+            body = None
+        if body is not None and body.isascii():
+            return body + b"\n"
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return body.encode("ascii") + b"\n"
+
+
+def json_response(payload):
+    # jsonify(payload) for the default JSON settings, through dumps()
+    config = current_app.config
+    if (
+        not config["JSON_SORT_KEYS"]
+        or not config["JSON_AS_ASCII"]
+        or config["JSONIFY_PRETTYPRINT_REGULAR"]
+        or current_app.debug
+    ):
+        return jsonify(payload)
+    return current_app.response_class(dumps(payload), mimetype=config["JSONIFY_MIMETYPE"])
@@ -0,0 +1,135 @@
+"""
+Pre-fork production server for the trivia API.
+
+The master process builds the app once, fills its caches and closes its
+database connections, then forks WORKERS processes that serve the same
+socket. Every worker starts with the master's category map, quiz index,
+search and suggest indexes, question counts and question snapshot, shared
+copy-on-write until a worker changes them, and opens its own connections.
+
+Run it with `python -m flaskr.server` (needs gunicorn). HOST, PORT,
+WORKERS (one per CPU), THREADS (4 per worker) and TIMEOUT (30 seconds)
+are read from the environment; the app reads the rest as usual. More than
+one worker needs QUIZ_SESSION_PATH, so quiz sessions are shared.
+"""
+import gc
+import os
+import threading
+
+from flask import current_app
+from sqlalchemy import event, exc
+
+from models import db
+from . import create_app
+from .quiz import DiskQuizSessions
+from .response_cache import DiskCache
+
+
+def warm(app):
+    # fills every in-process cache the first requests would fill
+    with app.app_context():
+        current_app.extensions["category_cache"].get()
+        current_app.extensions["question_stats"].reconcile()
+        current_app.extensions["quiz_index"].warm()
+        current_app.extensions["question_search"].warm()
+        current_app.extensions["question_suggest"].warm()
+        if current_app.extensions["question_snapshot"] is not None:
+            current_app.extensions["question_snapshot"].get()
+
+
+def engines(app):
+    with app.app_context():
+        binds = [None] + sorted(app.config.get("SQLALCHEMY_BINDS") or ())
+        return [db.get_engine(app, bind=bind) for bind in binds]
+
+
+def record_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection opened by another process is dropped, never shared
+    pid = connection_record.info.get("pid")
+    if pid != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "connection opened by process {}, used in {}".format(pid, os.getpid()))
+
+
+def prepare_fork(app):
+    """Leaves the master with nothing a worker must not inherit."""
+    if app.extensions["storage"].name == "memory":
+        raise RuntimeError("the memory storage backend can not be shared by forked workers")
+    for engine in engines(app):
+        if not event.contains(engine, "checkout", check_pid):
+            event.listen(engine, "connect", record_pid)
+            event.listen(engine, "checkout", check_pid)
+        # workers open their own connections; none are inherited
+        engine.dispose()
+    # objects built so far are never collected, so the collector does not
+    # write to their pages and the workers keep sharing them
+    gc.collect()
+    gc.freeze()
+
+
+def check_workers(app, workers):
+    """Refuses to run several workers that would not share quiz sessions."""
+    if workers > 1 and not isinstance(app.extensions["quiz_sessions"], DiskQuizSessions):
+        raise RuntimeError(
+            "quiz sessions live in one worker's memory; set QUIZ_SESSION_PATH to a "
+            "file the {} workers share, or run one worker".format(workers))
+
+
+def after_fork(app):
+    """Runs in each worker before it serves."""
+    # SQLite connections can not cross a fork
+    for store in (app.extensions["response_cache"], app.extensions["quiz_sessions"]):
+        if isinstance(store, (DiskCache, DiskQuizSessions)):
+            store.local = threading.local()
+
+
+def create_server_app(test_config=None):
+    """The app, built and warmed for forking."""
+    config = {"LAZY_INIT": False}
+    config.update(test_config or {})
+    app = create_app(config)
+    warm(app)
+    prepare_fork(app)
+    return app
+
+
+def serve(app=None):
+    from gunicorn.app.base import BaseApplication
+
+    class PreforkServer(BaseApplication):
+
+        def __init__(self, app, options):
+            self.application = app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    app = app or create_server_app()
+    threads = int(os.getenv("THREADS", 4))
+    workers = int(os.getenv("WORKERS", os.cpu_count() or 1))
+    check_workers(app, workers)
+    PreforkServer(app, {
+        "bind": "{}:{}".format(os.getenv("HOST", "127.0.0.1"), os.getenv("PORT", 5000)),
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread" if threads > 1 else "sync",
+        "timeout": int(os.getenv("TIMEOUT", 30)),
+        # the app is already built; workers are forked from it
+        "preload_app": True,
+        "post_fork": lambda server, worker: after_fork(app),
+    }).run()
+
+
+if __name__ == "__main__":
+    serve()
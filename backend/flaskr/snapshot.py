@@ -0,0 +1,297 @@
+"""
+Read-only columnar snapshot of the questions table.
+
+Build a snapshot file for workers to share with
+
+    flask snapshot /var/lib/trivia/questions.snapshot
+
+and point QUESTION_SNAPSHOT at it. The file is replaced atomically:
+workers that mapped the previous one keep reading it until they notice
+the new file on their next read.
+"""
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+import click
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+
+from models import db, Question, QuestionChange, on_question_write
+
+
+MAGIC = b"TRIVIAQ2"
+# magic, byte order, change log seq, rows, distinct texts, text bytes
+HEADER = struct.Struct("<8s8sQQQQ")
+# columns in file order; each starts on an 8 byte boundary
+ROW_COLUMNS = (("ids", "i"), ("categories", "i"), ("difficulties", "h"),
+               ("question_texts", "i"), ("answer_texts", "i"))
+# stored in place of NULL in every column
+NULL = -1
+
+
+def padding(size):
+    return -size % 8
+
+
+class QuestionSnapshot:
+    """Questions as typed arrays, in id order.
+
+    ids, categories and difficulties are arrays of machine integers. Question
+    and answer texts are numbers into a table of distinct strings kept end to
+    end in one UTF-8 buffer, so an answer shared by many questions is stored
+    once. Rows are formatted as the listing routes return them, straight from
+    the arrays, without building ORM objects. `seq` is the change log seq the
+    snapshot is at.
+    """
+
+    def __init__(self, ids, categories, difficulties, question_texts, answer_texts,
+                 offsets, text, seq=0):
+        self.seq = seq
+        self.ids = ids
+        self.categories = categories
+        self.difficulties = difficulties
+        self.question_texts = question_texts
+        self.answer_texts = answer_texts
+        # text number n is text[offsets[n]:offsets[n + 1]]
+        self.offsets = offsets
+        self.text = text
+        # row positions of each category, in id order
+        self.by_category = {}
+        for position, category in enumerate(categories):
+            self.by_category.setdefault(category, array("i")).append(position)
+
+    @classmethod
+    def build(cls, rows, seq=0):
+        # rows are (id, question, answer, category, difficulty) tuples in id order
+        columns = [array(typecode) for name, typecode in ROW_COLUMNS]
+        ids, categories, difficulties, question_texts, answer_texts = columns
+        offsets = array("q", [0])
+        text = bytearray()
+        numbers = {}
+
+        def intern(value):
+            if value is None:
+                return NULL
+            number = numbers.get(value)
+            if number is None:
+                number = numbers[value] = len(offsets) - 1
+                text.extend(value.encode("utf-8"))
+                offsets.append(len(text))
+            return number
+
+        for question_id, question, answer, category, difficulty in rows:
+            ids.append(question_id)
+            categories.append(NULL if category is None else category)
+            difficulties.append(NULL if difficulty is None else difficulty)
+            question_texts.append(intern(question))
+            answer_texts.append(intern(answer))
+        return cls(*columns, offsets, bytes(text), seq)
+
+    @classmethod
+    def from_database(cls):
+        # the seq is read first, so the rows are at least as new as it
+        seq = QuestionChange.latest()
+        return cls.build(
+            db.session.query(
+                Question.id, Question.question, Question.answer,
+                Question.category, Question.difficulty
+            ).order_by(Question.id).yield_per(10000), seq)
+
+    @classmethod
+    def open(cls, path):
+        """Maps a file written by save(); the arrays are views of its pages."""
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, seq, count, texts, size = HEADER.unpack_from(buffer)
+        if magic != MAGIC or byteorder.rstrip(b"\0").decode("ascii") != sys.byteorder:
+            raise ValueError("{} is not a question snapshot for this machine".format(path))
+        view = memoryview(buffer)
+        position = HEADER.size
+        columns = []
+        lengths = [count] * len(ROW_COLUMNS) + [texts + 1]
+        typecodes = [typecode for name, typecode in ROW_COLUMNS] + ["q"]
+        for typecode, length in zip(typecodes, lengths):
+            end = position + length * array(typecode).itemsize
+            columns.append(view[position:end].cast(typecode))
+            position = end + padding(end)
+        return cls(*columns, view[position:position + size], seq)
+
+    def save(self, path):
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as f:
+            f.write(HEADER.pack(
+                MAGIC, sys.byteorder.encode("ascii"), self.seq, len(self.ids),
+                len(self.offsets) - 1, len(self.text)))
+            for column in (self.ids, self.categories, self.difficulties,
+                           self.question_texts, self.answer_texts, self.offsets):
+                data = memoryview(column).cast("B")
+                f.write(data)
+                f.write(b"\0" * padding(len(data)))
+            f.write(self.text)
+        os.replace(temporary, path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def string(self, number):
+        if number == NULL:
+            return None
+        return str(self.text[self.offsets[number]:self.offsets[number + 1]], "utf-8")
+
+    def row(self, position):
+        category = self.categories[position]
+        difficulty = self.difficulties[position]
+        # keys in the order of serialize.QUESTION_KEYS
+        return {
+            "answer": self.string(self.answer_texts[position]),
+            "category": None if category == NULL else category,
+            "difficulty": None if difficulty == NULL else difficulty,
+            "id": self.ids[position],
+            "question": self.string(self.question_texts[position]),
+        }
+
+    def questions(self, ids):
+        # formatted questions of ids that exist, in the order of ids
+        rows = []
+        for question_id in ids:
+            position = bisect_left(self.ids, question_id)
+            if position < len(self.ids) and self.ids[position] == question_id:
+                rows.append(self.row(position))
+        return rows
+
+    def positions(self, category_id=None):
+        if category_id is None:
+            return range(len(self.ids))
+        return self.by_category.get(category_id, ())
+
+    def page(self, category_id=None, after=None, offset=0, limit=10):
+        """Returns (rows, total) of one page of the questions, or of a category.
+
+        Rows follow id `after` when it is given, else skip `offset` rows.
+        """
+        positions = self.positions(category_id)
+        start = offset
+        if after is not None:
+            low, high = 0, len(positions)
+            while low < high:
+                middle = (low + high) // 2
+                if self.ids[positions[middle]] <= after:
+                    low = middle + 1
+                else:
+                    high = middle
+            start = low
+        return [self.row(position) for position in positions[start:start + limit]], len(positions)
+
+    def quiz_rows(self):
+        # (id, category, difficulty) triples, as QuizIndex.fill takes them
+        for question_id, category, difficulty in zip(
+                self.ids, self.categories, self.difficulties):
+            yield (question_id,
+                   None if category == NULL else category,
+                   None if difficulty == NULL else difficulty)
+
+
+class SnapshotStore:
+    """The app's current QuestionSnapshot.
+
+    With a `path`, the file is mapped on first use and mapped again when it
+    is replaced, which is checked with a stat on every read. Without one,
+    the snapshot is built from the database, and rebuilt once it is older
+    than `ttl` seconds; 0 keeps it until the next write. One thread
+    rebuilds while the others keep the old snapshot.
+
+    A question write made by this worker drops the snapshot, and reads use
+    SQL until it is loaded again: built anew on the next read, or, for a
+    file, once the file is replaced or `ttl` seconds have passed.
+    """
+
+    def __init__(self, path=None, ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.loaded_at = None
+        # inode and mtime of the mapped file
+        self.file = None
+        self.dropped_at = None
+        # bumped by every drop, so a load that raced one is discarded
+        self.generation = 0
+        self.building = False
+
+    def get(self):
+        # Returns the snapshot, or None while reads should use SQL.
+        return self.get_file() if self.path else self.get_built()
+
+    def get_file(self):
+        stat = os.stat(self.path)
+        version = (stat.st_ino, stat.st_mtime_ns)
+        now = time.monotonic()
+        with self.lock:
+            if version == self.file and (self.snapshot is not None or not self.ttl
+                                         or now - self.dropped_at <= self.ttl):
+                return self.snapshot
+            generation = self.generation
+        snapshot = QuestionSnapshot.open(self.path)
+        with self.lock:
+            if generation == self.generation:
+                self.snapshot, self.file, self.loaded_at = snapshot, version, now
+            return self.snapshot
+
+    def get_built(self):
+        now = time.monotonic()
+        with self.lock:
+            fresh = self.loaded_at is not None and not (
+                self.ttl and now - self.loaded_at > self.ttl)
+            if fresh or self.building:
+                return self.snapshot
+            self.building = True
+            generation = self.generation
+        try:
+            snapshot = QuestionSnapshot.from_database()
+        except Exception:
+            with self.lock:
+                self.building = False
+            raise
+        with self.lock:
+            self.building = False
+            if generation == self.generation:
+                self.snapshot, self.loaded_at = snapshot, now
+            return self.snapshot
+
+    def drop(self):
+        with self.lock:
+            self.snapshot = None
+            self.loaded_at = None
+            self.dropped_at = time.monotonic()
+            self.generation += 1
+
+
+def current_snapshot():
+    # the app's snapshot, or None when it has none or it was dropped
+    store = current_app.extensions.get("question_snapshot")
+    return store.get() if store is not None else None
+
+
+@on_question_write
+def drop_question_snapshot(action, question):
+    if not has_app_context():
+        return
+    store = current_app.extensions.get("question_snapshot")
+    if store is not None:
+        store.drop()
+
+
+
+@click.command("snapshot")
+@click.argument("path")
+@with_appcontext
+def snapshot_command(path):
+    """Writes a snapshot of the questions table to PATH."""
+    snapshot = QuestionSnapshot.from_database()
+    snapshot.save(path)
+    click.echo("wrote {} questions to {}".format(len(snapshot), path))
@@ -0,0 +1,85 @@
+import threading
+import time
+from flask import current_app, has_app_context
+from sqlalchemy import func
+
+from models import db, Question, on_question_write
+
+
+class QuestionStats:
+    """Question counts per (category, difficulty), kept in memory.
+
+    Inserts and deletes made by this worker move the counts as they happen.
+    Every `interval` seconds they are reconciled with one GROUP BY query,
+    which picks up writes made by other workers and corrects any drift.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = None
+        self.loaded_at = 0
+
+    def stale(self):
+        return self.counts is None or time.monotonic() - self.loaded_at > self.interval
+
+    def fill(self, rows):
+        # rows are (category, difficulty, count) triples
+        self.counts = {
+            (category, difficulty): count for category, difficulty, count in rows if count
+        }
+        self.loaded_at = time.monotonic()
+
+    def reconcile(self):
+        # Returns the counts, reloading them when they are due.
+        with self.lock:
+            if self.stale():
+                self.fill(db.session.query(
+                    Question.category, Question.difficulty, func.count(Question.id)
+                ).group_by(Question.category, Question.difficulty))
+            return self.counts
+
+    def total(self, category_id=None):
+        counts = self.reconcile()
+        if category_id is None:
+            return sum(counts.values())
+        return sum(
+            count for (category, difficulty), count in counts.items()
+            if category == category_id)
+
+    def by_category(self):
+        # Returns {category: {difficulty: count}}.
+        categories = {}
+        for (category, difficulty), count in self.reconcile().items():
+            categories.setdefault(category, {})[difficulty] = count
+        return categories
+
+    def add(self, question, delta):
+        with self.lock:
+            if self.counts is None:
+                return
+            key = (question["category"], question["difficulty"])
+            count = self.counts.get(key, 0) + delta
+            if count > 0:
+                self.counts[key] = count
+            else:
+                self.counts.pop(key, None)
+
+    def reset(self):
+        with self.lock:
+            self.counts = None
+
+
+@on_question_write
+def update_question_stats(action, question):
+    if not has_app_context():
+        return
+    stats = current_app.extensions.get("question_stats")
+    if stats is None:
+        return
+    if action == "insert":
+        stats.add(question, 1)
+    elif action == "delete":
+        stats.add(question, -1)
+    elif action == "reload":
+        stats.reset()
@@ -0,0 +1,209 @@
+import os
+import sqlite3
+import threading
+import uuid
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+from models import (
+    DATABASE_PATH, DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_POOL_TIMEOUT, basedir, db, engine_options, on_question_write, setup_db, Question)
+from .serialize import QUESTION_COLUMNS, question_rows
+from .snapshot import current_snapshot
+
+
+# database file of the "sqlite" backend when DATABASE_URL is not a SQLite URI
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(basedir, "trivia.db"))
+# milliseconds a SQLite connection waits for another writer before failing
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+
+
+class PostgresStorage:
+    """Questions and categories in PostgreSQL, the default backend.
+
+    Every backend binds `db` to its database, so routes, migrations and
+    listeners run the same SQL whichever one is configured; a backend only
+    decides the URI, the engine settings and how questions are read by id.
+    """
+
+    name = "postgresql"
+
+    def database_uri(self, config):
+        return config.get("DATABASE_URL") or DATABASE_PATH
+
+    def engine_options(self, config, uri):
+        return engine_options(config, uri)
+
+    def init_app(self, app):
+        uri = self.database_uri(app.config)
+        setup_db(app, uri, self.engine_options(app.config, uri))
+        app.extensions["storage"] = self
+
+    def questions(self, ids):
+        # formatted questions of ids that exist, in the order of ids
+        if not ids:
+            return []
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            return snapshot.questions(ids)
+        rows = db.session.query(*QUESTION_COLUMNS).filter(Question.id.in_(ids))
+        found = {question["id"]: question for question in question_rows(rows)}
+        return [found[id] for id in ids if id in found]
+
+    def question(self, id):
+        questions = self.questions([id])
+        return questions[0] if questions else None
+
+
+class SQLiteStorage(PostgresStorage):
+    """Questions and categories in a SQLite file, for single-node deployments.
+
+    Connections run in WAL mode, so reads go on while a write commits, and
+    wait up to SQLITE_BUSY_TIMEOUT for a concurrent writer.
+    """
+
+    name = "sqlite"
+
+    def database_uri(self, config):
+        uri = config.get("DATABASE_URL") or DATABASE_PATH
+        if uri.startswith("sqlite"):
+            return uri
+        return "sqlite:///" + config.get("SQLITE_PATH", SQLITE_PATH)
+
+    def init_app(self, app):
+        super().init_app(app)
+        # creating the engine does not connect
+        engine = db.get_engine(app)
+        in_memory = engine.url.database in (None, "", ":memory:")
+        busy_timeout = app.config.get("SQLITE_BUSY_TIMEOUT", SQLITE_BUSY_TIMEOUT)
+
+        @event.listens_for(engine, "connect")
+        def configure_connection(connection, record):
+            cursor = connection.cursor()
+            if not in_memory:
+                cursor.execute("PRAGMA journal_mode=WAL")
+                # WAL keeps commits durable against crashes without fsync per commit
+                cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA busy_timeout={:d}".format(busy_timeout))
+            # off by default in SQLite
+            cursor.execute("PRAGMA foreign_keys=ON")
+            cursor.close()
+
+
+class MemoryStorage(PostgresStorage):
+    """Questions and categories held in the worker's memory.
+
+    The tables live in a SQLite database in memory that every pooled
+    connection opens by name (the memdb VFS, SQLite 3.36 and later), so
+    writes, listings and searches work as on the other backends. Rows are
+    also kept in a dict by id, so quiz draws and search pages, which read
+    questions by id, run no SQL. Nothing is persisted: the data is lost when
+    the worker exits, which suits tests and read-only replicas filled with
+    `benchmarks/seed.py` or `POST /questions/bulk`.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = None
+        # bumped by every write, so a load that raced one is not kept
+        self.writes = 0
+        self.path = "file:/trivia-{}?vfs=memdb".format(uuid.uuid4().hex)
+        # the database is dropped when its last connection closes
+        self.anchor = None
+        self.busy_timeout = SQLITE_BUSY_TIMEOUT
+
+    def database_uri(self, config):
+        return "sqlite://"
+
+    def connect(self):
+        connection = sqlite3.connect(
+            self.path, uri=True, check_same_thread=False,
+            timeout=self.busy_timeout / 1000)
+        connection.execute("PRAGMA foreign_keys=ON")
+        return connection
+
+    def engine_options(self, config, uri):
+        return {
+            "poolclass": QueuePool,
+            "pool_size": config.get("DB_POOL_SIZE", DB_POOL_SIZE),
+            "max_overflow": config.get("DB_MAX_OVERFLOW", DB_MAX_OVERFLOW),
+            "pool_timeout": config.get("DB_POOL_TIMEOUT", DB_POOL_TIMEOUT),
+            "creator": self.connect,
+        }
+
+    def init_app(self, app):
+        if sqlite3.sqlite_version_info < (3, 36):
+            raise RuntimeError(
+                "STORAGE=memory needs SQLite 3.36 or later, found {}".format(
+                    sqlite3.sqlite_version))
+        self.busy_timeout = app.config.get("SQLITE_BUSY_TIMEOUT", SQLITE_BUSY_TIMEOUT)
+        self.anchor = self.connect()
+        # every worker holds its own copy, there is nothing to replicate
+        app.config["DATABASE_REPLICA_URLS"] = []
+        super().init_app(app)
+
+    def questions(self, ids):
+        with self.lock:
+            rows, writes = self.rows, self.writes
+        if rows is None:
+            # read without the lock, so a writer holding the database is not
+            # waiting on a reader that waits on the lock
+            rows = {
+                question["id"]: question
+                for question in question_rows(db.session.query(*QUESTION_COLUMNS))
+            }
+            with self.lock:
+                if self.rows is None and self.writes == writes:
+                    self.rows = rows
+        return [dict(rows[id]) for id in ids if id in rows]
+
+    def add(self, question):
+        with self.lock:
+            self.writes += 1
+            if self.rows is not None:
+                self.rows[question["id"]] = dict(question)
+
+    def remove(self, question_id):
+        with self.lock:
+            self.writes += 1
+            if self.rows is not None:
+                self.rows.pop(question_id, None)
+
+    def reset(self):
+        with self.lock:
+            self.writes += 1
+            self.rows = None
+
+
+STORAGES = {
+    storage.name: storage for storage in (PostgresStorage, SQLiteStorage, MemoryStorage)
+}
+
+
+def make_storage(config):
+    # STORAGE names the backend; without it the DATABASE_URL scheme decides
+    name = config.get("STORAGE")
+    if not name:
+        uri = config.get("DATABASE_URL") or DATABASE_PATH
+        name = "sqlite" if uri.startswith("sqlite") else "postgresql"
+    if name not in STORAGES:
+        raise ValueError("unknown STORAGE {!r}, expected one of {}".format(
+            name, ", ".join(sorted(STORAGES))))
+    return STORAGES[name]()
+
+
+@on_question_write
+def update_memory_storage(action, question):
+    if not has_app_context():
+        return
+    storage = current_app.extensions.get("storage")
+    if not isinstance(storage, MemoryStorage):
+        return
+    if action == "insert":
+        storage.add(question)
+    elif action == "delete":
+        storage.remove(question["id"])
+    elif action == "reload":
+        storage.reset()
@@ -0,0 +1,196 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+
+from models import db, Question, on_question_write
+from .search import tokenize
+
+
+class SuggestIndex:
+    """Search-as-you-type over question text.
+
+    The distinct tokens of every question are kept sorted, so the questions
+    with a token starting with a prefix are found by bisection; each token
+    typed must start a token of the question. Results are cached per
+    normalized prefix, least recently used first out. A prefix that extends
+    a cached one checks the questions of that result against the tokens it
+    changed, so it costs in proportion to the cached matches, not to the
+    index. Inserts and deletes update the index and the cached results in
+    place; the index is reloaded after `ttl` seconds to pick up writes made
+    by other workers.
+    """
+
+    def __init__(self, ttl=300, cache_size=1024):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.tokens = None
+        self.postings = {}
+        self.documents = {}
+        self.results = OrderedDict()
+        self.loaded_at = 0
+        # bumped by every write, so a reload that raced one is read again
+        self.writes = 0
+
+    def stale(self):
+        return self.tokens is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def fill(self, rows):
+        # rows are (id, question) pairs
+        self.tokens = []
+        self.postings = {}
+        self.documents = {}
+        self.results.clear()
+        for question_id, text in rows:
+            self.place(question_id, text, sort=False)
+        self.tokens.sort()
+        self.loaded_at = time.monotonic()
+
+    def place(self, question_id, text, sort=True):
+        tokens = set(tokenize(text))
+        # " tok1 tok2": a token starts with p where " " + p is found
+        self.documents[question_id] = (text, " " + " ".join(tokens))
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                if sort:
+                    bisect.insort(self.tokens, token)
+                else:
+                    self.tokens.append(token)
+            self.postings[token].add(question_id)
+
+    def discard(self, question_id):
+        text, words = self.documents.pop(question_id, (None, ""))
+        for token in words.split():
+            posting = self.postings[token]
+            posting.discard(question_id)
+            if not posting:
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+    def matches(self, question_id, prefixes):
+        words = self.documents[question_id][1]
+        return all(" " + prefix in words for prefix in prefixes)
+
+    def expand(self, prefix):
+        # the indexed tokens starting with prefix
+        tokens = set()
+        position = bisect.bisect_left(self.tokens, prefix)
+        while position < len(self.tokens) and self.tokens[position].startswith(prefix):
+            tokens.add(self.tokens[position])
+            position += 1
+        return tokens
+
+    def lookup(self, prefixes):
+        # set of ids of the questions matching every prefix, from the index
+        ids = None
+        for prefix in prefixes:
+            found = set()
+            for token in self.expand(prefix):
+                found.update(self.postings[token])
+            ids = found if ids is None else ids & found
+            if not ids:
+                break
+        return ids or set()
+
+    def result(self, key):
+        # call with the lock held; key is the prefix tokens joined by spaces
+        ids = self.results.get(key)
+        if ids is not None:
+            self.results.move_to_end(key)
+            return ids
+        prefixes = key.split(" ")
+        # every match of "van go" is a match of "van g", so filter the
+        # matches of the longest cached prefix of the key when there is one,
+        # without the index; only its last token and the tokens after it
+        # need checking
+        for end in range(len(key) - 1, 0, -1):
+            cached = self.results.get(key[:end])
+            if cached is not None:
+                ids = cached
+                for prefix in prefixes[key[:end].count(" "):]:
+                    # matches(), one prefix at a time, inlined for speed
+                    needle = " " + prefix
+                    ids = [id for id in ids if needle in self.documents[id][1]]
+                break
+        else:
+            ids = sorted(self.lookup(prefixes))
+        self.results[key] = ids
+        while len(self.results) > self.cache_size:
+            self.results.popitem(last=False)
+        return ids
+
+    def suggest(self, prefix, limit):
+        # Returns ([{"id", "question"}] of the first `limit` matches by id,
+        # total number of matches).
+        key = " ".join(tokenize(prefix))
+        retried = False
+        while True:
+            with self.lock:
+                if not self.stale():
+                    ids = self.result(key) if key else []
+                    return [
+                        {"id": id, "question": self.documents[id][0]} for id in ids[:limit]
+                    ], len(ids)
+                writes = self.writes
+            # read without the lock, as a writer may be waiting on it
+            rows = db.session.query(Question.id, Question.question).all()
+            with self.lock:
+                # a write raced the read: read once more, then take what came
+                if self.writes == writes or retried:
+                    self.fill(rows)
+            retried = True
+
+    def warm(self):
+        # loads the index now instead of on the first suggestion
+        self.suggest("", 0)
+
+    def add(self, question):
+        with self.lock:
+            self.writes += 1
+            if self.tokens is None:
+                return
+            self.unlist(question["id"])
+            self.discard(question["id"])
+            self.place(question["id"], question["question"])
+            for key, ids in self.results.items():
+                if self.matches(question["id"], key.split(" ")):
+                    bisect.insort(ids, question["id"])
+
+    def remove(self, question_id):
+        with self.lock:
+            self.writes += 1
+            if self.tokens is None:
+                return
+            self.unlist(question_id)
+            self.discard(question_id)
+
+    def unlist(self, question_id):
+        # drops the id from the cached results; call with the lock held
+        for ids in self.results.values():
+            position = bisect.bisect_left(ids, question_id)
+            if position < len(ids) and ids[position] == question_id:
+                del ids[position]
+
+    def reset(self):
+        with self.lock:
+            self.writes += 1
+            self.tokens = None
+            self.results.clear()
+
+
+@on_question_write
+def update_suggest_index(action, question):
+    if not has_app_context():
+        return
+    index = current_app.extensions.get("question_suggest")
+    if index is None:
+        return
+    if action == "insert":
+        index.add(question)
+    elif action == "delete":
+        index.remove(question["id"])
+    elif action == "reload":
+        index.reset()
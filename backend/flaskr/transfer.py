@@ -0,0 +1,183 @@
+import csv
+import io
+import json
+
+from models import db, Question
+
+
+FIELDS = ["id", "question", "answer", "category", "difficulty"]
+# Errors reported by an import; the rest are only counted.
+MAX_REPORTED_ERRORS = 100
+# Rows read per export query; memory use does not depend on the table size.
+EXPORT_BATCH_SIZE = 1000
+
+
+class RowError(ValueError):
+    """Raised for a row that can not be imported, with its line number."""
+
+    def __init__(self, line, message):
+        super().__init__(message)
+        self.line = line
+        self.message = message
+
+
+class DecodedLines:
+    """The raw lines of request.stream, decoded one at a time.
+
+    A line that is not valid UTF-8 is decoded with replacement characters
+    and counted in `invalid`, so the parser reports the row it belongs to.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.invalid = 0
+
+    def __iter__(self):
+        for raw in self.stream:
+            try:
+                yield raw.decode("utf-8")
+            except UnicodeDecodeError:
+                self.invalid += 1
+                yield raw.decode("utf-8", "replace")
+
+
+def parse_ndjson(stream):
+    lines = DecodedLines(stream)
+    invalid = 0
+    for line_number, line in enumerate(lines, 1):
+        if lines.invalid != invalid:
+            invalid = lines.invalid
+            yield line_number, RowError(line_number, "invalid utf-8")
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, RowError(line_number, "invalid json")
+            continue
+        yield line_number, row
+
+
+def parse_csv(stream):
+    lines = DecodedLines(stream)
+    reader = csv.DictReader(lines)
+    invalid = 0
+    for row in reader:
+        # a row can span lines; any invalid one spoils it
+        if lines.invalid != invalid:
+            invalid = lines.invalid
+            yield reader.line_num, RowError(reader.line_num, "invalid utf-8")
+            continue
+        yield reader.line_num, row
+
+
+PARSERS = {
+    "application/x-ndjson": parse_ndjson,
+    "application/json": parse_ndjson,
+    "text/csv": parse_csv,
+}
+
+
+def validate(line_number, row, categories):
+    # Returns the row as column values for Question, or raises RowError.
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError(line_number, "expected an object")
+    question = row.get("question")
+    answer = row.get("answer")
+    if not isinstance(question, str) or not question.strip():
+        raise RowError(line_number, "question is required")
+    if not isinstance(answer, str) or not answer.strip():
+        raise RowError(line_number, "answer is required")
+    try:
+        category = int(row.get("category"))
+        difficulty = int(row.get("difficulty"))
+    except (TypeError, ValueError):
+        raise RowError(line_number, "category and difficulty must be integers")
+    if category not in categories:
+        raise RowError(line_number, "unknown category {}".format(category))
+    return {
+        "question": question,
+        "answer": answer,
+        "category": category,
+        "difficulty": difficulty,
+    }
+
+
+def import_questions(rows, categories, chunk_size):
+    """Validates parsed rows and writes the valid ones chunk by chunk.
+
+    rows yields (line_number, row) pairs. Each chunk is its own multi-row
+    INSERT and transaction, so a large import never holds one giant
+    transaction or more than chunk_size rows in memory.
+    Returns (number of rows created, the first MAX_REPORTED_ERRORS errors,
+    number of errors).
+    """
+    created = 0
+    errors = []
+    total_errors = 0
+    chunk = []
+    for line_number, row in rows:
+        try:
+            chunk.append(validate(line_number, row, categories))
+        except RowError as error:
+            total_errors += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line": error.line, "message": error.message})
+            continue
+        if len(chunk) >= chunk_size:
+            created += Question.insert_many(chunk)
+            chunk = []
+    created += Question.insert_many(chunk)
+    return created, errors, total_errors
+
+
+def iter_question_rows(batch_size=EXPORT_BATCH_SIZE):
+    # keyset batches over column tuples; no ORM objects are built
+    columns = [getattr(Question, field) for field in FIELDS]
+    last_id = 0
+    while True:
+        batch = db.session.query(*columns).filter(
+            Question.id > last_id).order_by(Question.id).limit(batch_size).all()
+        if not batch:
+            return
+        for row in batch:
+            yield row
+        last_id = batch[-1][0]
+
+
+# Bytes buffered before a chunk is sent to the client.
+CHUNK_SIZE = 64 * 1024
+
+
+def export_ndjson(rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(json.dumps(dict(zip(FIELDS, row))))
+        buffer.write("\n")
+        if buffer.tell() > CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+EXPORTERS = {
+    "ndjson": ("application/x-ndjson", export_ndjson),
+    "csv": ("text/csv", export_csv),
+}
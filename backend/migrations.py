@@ -0,0 +1,257 @@
+import sys
+import threading
+from sqlalchemy import text
+
+from models import db, Question, QuestionChange, DB_SCHEMA
+
+
+"""
+MIGRATIONS
+    ordered schema changes, each registered with @migration(version, description)
+    and called as fn(connection, dialect_name). The applied versions are
+    recorded in the schema_version table. Every migration must be safe to
+    re-run, since a worker may be interrupted between a change and its record.
+"""
+MIGRATIONS = []
+
+# arbitrary key for pg_advisory_lock, so only one worker migrates at a time
+LOCK_KEY = 5873201
+# rows per UPDATE when a migration fills a new column
+BACKFILL_BATCH_SIZE = 10000
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return fn
+    return register
+
+
+@migration(1, "create the categories and questions tables")
+def create_tables(connection, dialect):
+    db.metadata.create_all(bind=connection, checkfirst=True)
+
+
+@migration(2, "store questions.category as an integer foreign key")
+def normalize_category(connection, dialect):
+    if dialect == "postgresql":
+        column_type = connection.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = 'questions' AND column_name = 'category'")).scalar()
+        if column_type != "integer":
+            retype_category(connection)
+        exists = connection.execute(text(
+            "SELECT 1 FROM pg_constraint WHERE conname = 'questions_category_fkey'")).scalar()
+        if not exists:
+            # NOT VALID adds the constraint without scanning the table; the
+            # VALIDATE step scans it without blocking reads or writes
+            connection.execute(text(
+                "ALTER TABLE questions ADD CONSTRAINT questions_category_fkey "
+                "FOREIGN KEY (category) REFERENCES categories (id) NOT VALID"))
+            connection.execute(text(
+                "ALTER TABLE questions VALIDATE CONSTRAINT questions_category_fkey"))
+    else:
+        # SQLite can not change a column type in place: rebuild the table
+        columns = connection.execute(text("PRAGMA table_info(questions)")).fetchall()
+        column_types = {column[1]: column[2] for column in columns}
+        if column_types.get("category", "").upper() == "INTEGER":
+            return
+        with connection.begin():
+            connection.execute(text("ALTER TABLE questions RENAME TO questions_old"))
+            for index in Question.__table__.indexes:
+                connection.execute(text("DROP INDEX IF EXISTS {}".format(index.name)))
+            Question.__table__.create(bind=connection)
+            connection.execute(text(
+                "INSERT INTO questions (id, question, answer, category, difficulty) "
+                "SELECT id, question, answer, CAST(category AS INTEGER), difficulty "
+                "FROM questions_old"))
+            connection.execute(text("DROP TABLE questions_old"))
+
+
+def retype_category(connection):
+    # ALTER COLUMN ... TYPE would rewrite the table under an exclusive lock.
+    # Instead an integer copy of the column is filled in batches while the
+    # app keeps writing, with a trigger keeping rows written meanwhile in
+    # step, and then swapped in by a change to the catalog only.
+    connection.execute(text(
+        "ALTER TABLE questions ADD COLUMN IF NOT EXISTS category_new integer"))
+    connection.execute(text(
+        "CREATE OR REPLACE FUNCTION questions_category_new() RETURNS trigger AS $$ "
+        "BEGIN NEW.category_new := NEW.category::integer; RETURN NEW; END "
+        "$$ LANGUAGE plpgsql"))
+    connection.execute(text("DROP TRIGGER IF EXISTS questions_category_new ON questions"))
+    connection.execute(text(
+        "CREATE TRIGGER questions_category_new BEFORE INSERT OR UPDATE ON questions "
+        "FOR EACH ROW EXECUTE PROCEDURE questions_category_new()"))
+    # each batch commits on its own, so row locks are held briefly
+    last_id = connection.execute(text("SELECT coalesce(max(id), 0) FROM questions")).scalar()
+    for start in range(0, last_id, BACKFILL_BATCH_SIZE):
+        connection.execute(text(
+            "UPDATE questions SET category_new = category::integer "
+            "WHERE id > :start AND id <= :end "
+            "AND category_new IS DISTINCT FROM category::integer"),
+            start=start, end=start + BACKFILL_BATCH_SIZE)
+    # the connection is in autocommit mode, so the swap opens its own
+    # transaction; lock_timeout keeps it from queueing writes behind a long
+    # read, and the migration can simply be run again if it gives up
+    connection.execute(text("BEGIN"))
+    try:
+        connection.execute(text("SET LOCAL lock_timeout = '5s'"))
+        connection.execute(text("LOCK TABLE questions IN ACCESS EXCLUSIVE MODE"))
+        connection.execute(text("DROP TRIGGER questions_category_new ON questions"))
+        # drops the old column's foreign key too; it is added again below
+        connection.execute(text("ALTER TABLE questions DROP COLUMN category"))
+        connection.execute(text(
+            "ALTER TABLE questions RENAME COLUMN category_new TO category"))
+        connection.execute(text("COMMIT"))
+    except Exception:
+        connection.execute(text("ROLLBACK"))
+        raise
+    connection.execute(text("DROP FUNCTION IF EXISTS questions_category_new()"))
+
+
+@migration(3, "index questions by (category, id) and by difficulty")
+def create_indexes(connection, dialect):
+    # CONCURRENTLY builds the index without locking out writes
+    concurrently = "CONCURRENTLY " if dialect == "postgresql" else ""
+    connection.execute(text(
+        "CREATE INDEX {}IF NOT EXISTS questions_category_id_idx "
+        "ON questions (category, id)".format(concurrently)))
+    connection.execute(text(
+        "CREATE INDEX {}IF NOT EXISTS questions_difficulty_idx "
+        "ON questions (difficulty)".format(concurrently)))
+
+
+# the expression must match flaskr.search.DOCUMENT_SQL
+SEARCH_DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(question, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(answer, '')), 'B')"
+)
+
+
+@migration(4, "full-text search index on question and answer text")
+def create_search_index(connection, dialect):
+    if dialect != "postgresql":
+        return
+    connection.execute(text(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS questions_search_idx ON questions "
+        "USING GIN (({}))".format(SEARCH_DOCUMENT)))
+
+
+@migration(5, "question change log")
+def create_change_log(connection, dialect):
+    QuestionChange.__table__.create(bind=connection, checkfirst=True)
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS question_changes_category_seq_idx "
+        "ON question_changes (category, seq)"))
+
+
+@migration(6, "weight question words over answer words in the search index")
+def weight_search_index(connection, dialect):
+    if dialect != "postgresql":
+        return
+    definition = connection.execute(text(
+        "SELECT indexdef FROM pg_indexes WHERE indexname = 'questions_search_idx'")).scalar()
+    if definition is not None and "setweight" in definition:
+        return
+    # built next to the unweighted index, so searches keep an index meanwhile;
+    # a half built one left by an interrupted run is dropped first
+    connection.execute(text("DROP INDEX CONCURRENTLY IF EXISTS questions_search_weighted_idx"))
+    connection.execute(text(
+        "CREATE INDEX CONCURRENTLY questions_search_weighted_idx ON questions "
+        "USING GIN (({}))".format(SEARCH_DOCUMENT)))
+    connection.execute(text("DROP INDEX CONCURRENTLY IF EXISTS questions_search_idx"))
+    connection.execute(text(
+        "ALTER INDEX questions_search_weighted_idx RENAME TO questions_search_idx"))
+
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    return connection.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+
+
+def upgrade(engine):
+    # Applies every pending migration and returns the new version.
+    dialect = engine.dialect.name
+    with engine.connect() as connection:
+        if dialect == "postgresql":
+            # CREATE INDEX CONCURRENTLY can not run inside a transaction
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), key=LOCK_KEY)
+        try:
+            version = current_version(connection)
+            for target, description, fn in MIGRATIONS:
+                if target <= version:
+                    continue
+                fn(connection, dialect)
+                connection.execute(
+                    text("INSERT INTO schema_version (version) VALUES (:version)"),
+                    version=target)
+                version = target
+        finally:
+            if dialect == "postgresql":
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), key=LOCK_KEY)
+    return version
+
+
+def ensure_schema(app, lazy=False):
+    """Checks the schema version when the app is created.
+
+    DB_SCHEMA "migrate" applies pending migrations, "check" raises if any
+    are pending and "skip" does not touch the database. With lazy the work
+    is done before the first request instead, so the app builds without
+    connecting.
+    """
+    mode = app.config.get("DB_SCHEMA", DB_SCHEMA)
+    if mode == "skip":
+        return
+    if not lazy:
+        with app.app_context():
+            apply_schema_mode(mode)
+        return
+
+    lock = threading.Lock()
+    done = []
+
+    @app.before_request
+    def ensure_schema_once():
+        if done:
+            return
+        with lock:
+            if not done:
+                apply_schema_mode(mode)
+                done.append(True)
+
+
+def apply_schema_mode(mode):
+    # call inside an app context
+    if mode == "migrate":
+        upgrade(db.engine)
+        return
+    with db.engine.connect() as connection:
+        version = current_version(connection)
+    if version < LATEST_VERSION:
+        raise RuntimeError(
+            "database schema is at version {}, expected {}; "
+            "run python migrations.py".format(version, LATEST_VERSION))
+
+
+if __name__ == "__main__":
+    # python migrations.py [--status]
+    from flaskr import create_app
+
+    app = create_app({"DB_SCHEMA": "skip"})
+    with app.app_context():
+        if "--status" in sys.argv[1:]:
+            with db.engine.connect() as connection:
+                version = current_version(connection)
+            for target, description, fn in MIGRATIONS:
+                state = "applied" if target <= version else "pending"
+                print("{:>3} {:8} {}".format(target, state, description))
+        else:
+            print("schema at version {}".format(upgrade(db.engine)))
@@ -1,6 +1,10 @@
+import logging
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine, func
+from sqlalchemy import orm
+from sqlalchemy.exc import SQLAlchemyError
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 import json
 SECRET_KEY = os.urandom(32)
 # Grabs the folder where the script runs.
@@ -10,23 +14,152 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 DB_HOST = os.getenv('DB_HOST', 'localhost')
 DB_PORT=  os.getenv('DB_PORT',5432)
 DB_USER = os.getenv('DB_USER', 'postgres')
-DB_PASSWORD = os.getenv('DB_PASSWORD', '7y8a1h64')
+DB_PASSWORD = os.getenv('DB_PASSWORD', '')
 DB_NAME = os.getenv('DB_NAME', 'trivia')
 
-DATABASE_PATH = "postgresql://{}:{}@{}:{}/{}".format(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME)
+DATABASE_PATH = os.getenv('DATABASE_URL', "postgresql://{}:{}@{}:{}/{}".format(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME))
 
-db = SQLAlchemy()
+# Connection pool settings, overridable per app through app.config.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+# seconds before a connection is replaced; keep it below the server's idle timeout
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+# milliseconds, PostgreSQL only; 0 disables the timeout
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+# what create_app does about the schema version: "migrate", "check" or "skip"
+DB_SCHEMA = os.getenv('DB_SCHEMA', 'migrate')
+# question changes kept in the change log; 0 keeps them all
+CHANGE_LOG_SIZE = int(os.getenv('CHANGE_LOG_SIZE', 100000))
+# the log is pruned when its sequence crosses a multiple of this
+CHANGE_LOG_PRUNE_EVERY = 1000
+# Ids above this do not fit the 64-bit integers SQL compares with.
+MAX_ID = 2 ** 63 - 1
+# comma separated URIs of read replicas of DATABASE_URL
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+]
 
 """
-setup_db(app)
-    binds a flask application and a SQLAlchemy service
+RoutingSession
+    a session that sends statements to the bind named in g.db_read_bind
+    when the request set one, and to the primary otherwise. Flushes always
+    go to the primary, so ORM writes never reach a replica
 """
-def setup_db(app, DATABASE_PATH=DATABASE_PATH):
-    app.config["SQLALCHEMY_DATABASE_URI"] =DATABASE_PATH
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and not self._flushing:
+            bind_key = g.get("db_read_bind")
+            if bind_key is not None:
+                return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+
+"""
+engine_options(config, database_path)
+    SQLAlchemy engine keyword arguments for the pool settings above
+"""
+def engine_options(config, database_path):
+    if database_path.startswith("sqlite"):
+        # SQLite connections are cheap and not pooled by size
+        return {}
+    options = {
+        "pool_size": config.get("DB_POOL_SIZE", DB_POOL_SIZE),
+        "max_overflow": config.get("DB_MAX_OVERFLOW", DB_MAX_OVERFLOW),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT", DB_POOL_TIMEOUT),
+        "pool_recycle": config.get("DB_POOL_RECYCLE", DB_POOL_RECYCLE),
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", DB_POOL_PRE_PING),
+    }
+    statement_timeout = config.get("DB_STATEMENT_TIMEOUT", DB_STATEMENT_TIMEOUT)
+    if statement_timeout and database_path.startswith("postgres"):
+        options["connect_args"] = {
+            "options": "-c statement_timeout={}".format(statement_timeout)
+        }
+    return options
+
+"""
+setup_db(app, database_path=None, options=None)
+    binds a flask application and a SQLAlchemy service; no connection is
+    made until the database is first used. options replaces the engine
+    keyword arguments built by engine_options(). Each URI in the app's
+    DATABASE_REPLICA_URLS becomes a bind named replica_<n>
+"""
+def setup_db(app, database_path=None, options=None):
+    # an explicit path wins over the app's DATABASE_URL, then the environment
+    database_path = database_path or app.config.get("DATABASE_URL") or DATABASE_PATH
+    if options is None:
+        options = engine_options(app.config, database_path)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    replicas = app.config.get("DATABASE_REPLICA_URLS", DATABASE_REPLICA_URLS)
+    if isinstance(replicas, str):
+        replicas = [url.strip() for url in replicas.split(",") if url.strip()]
+    app.config["SQLALCHEMY_BINDS"] = {
+        "replica_{}".format(number): url for number, url in enumerate(replicas)
+    } or None
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+    # one session per request; removing it rolls back anything left
+    # uncommitted and returns its connection to the pool
+    @app.teardown_appcontext
+    def remove_session(exception=None):
+        db.session.remove()
+
+"""
+question_listeners
+    callbacks run after a question write has been committed,
+    called as listener(action, question) where action is "insert" or "delete"
+    and question is the formatted row, or action is "reload" and question is
+    None after a bulk write that listeners should re-read from the database
+"""
+question_listeners = []
+
+def on_question_write(listener):
+    if listener not in question_listeners:
+        question_listeners.append(listener)
+    return listener
+
+def notify_question_listeners(action, question):
+    for listener in question_listeners:
+        if not call_listener(listener, action, question) and action != "reload":
+            # drop what the listener holds, so it reads the database again
+            call_listener(listener, "reload", None)
+
+def call_listener(listener, action, data):
+    # the write is committed by now, so a listener that fails is logged
+    # instead of failing the request; returns whether it succeeded
+    try:
+        listener(action, data)
+        return True
+    except Exception:
+        logging.getLogger(__name__).exception(
+            "%s failed on %s", getattr(listener, "__name__", listener), action)
+        return False
+
+"""
+category_listeners
+    same as question_listeners, for writes to the categories table
+"""
+category_listeners = []
+
+def on_category_write(listener):
+    if listener not in category_listeners:
+        category_listeners.append(listener)
+    return listener
+
+def notify_category_listeners(action, category):
+    for listener in category_listeners:
+        call_listener(listener, action, category)
 
 """
 Question
@@ -34,11 +167,16 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    # kept in step with migrations.py
+    __table_args__ = (
+        Index('questions_category_id_idx', 'category', 'id'),
+        Index('questions_difficulty_idx', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -52,28 +190,64 @@ class Question(db.Model):
         id = None
         try:
             db.session.add(self)
+            db.session.flush()
+            record_question_changes([("insert", self.id, self.category)])
             db.session.commit()
             id = self.id
-        except:
+            data = self.format()
+        except SQLAlchemyError:
             db.session.rollback()
             status = False
-        finally:
-            db.session.close()
+        if status:
+            notify_question_listeners("insert", data)
         return {"status": status, "id": id}
 
+    """
+    insert_many(rows)
+        inserts a list of question dicts with one multi-row INSERT and
+        commits it; returns the number of rows written
+    """
+    @staticmethod
+    def insert_many(rows):
+        if not rows:
+            return 0
+        table = Question.__table__
+        try:
+            # no other writer commits in between, so the log holds each row once
+            lock_change_log()
+            if db.session.get_bind().dialect.name == "postgresql":
+                inserted = db.session.execute(
+                    table.insert().values(rows).returning(table.c.id, table.c.category)).fetchall()
+            else:
+                db.session.execute(table.insert().values(rows))
+                # SQLite numbers the rows of one INSERT on from the largest id,
+                # and the write lock the INSERT took is held until commit
+                last_id = db.session.query(func.max(Question.id)).scalar()
+                inserted = [(last_id - len(rows) + position, row["category"])
+                            for position, row in enumerate(rows, 1)]
+            record_question_changes([("insert", id, category) for id, category in inserted])
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        notify_question_listeners("reload", None)
+        return len(rows)
+
     def update(self):
         db.session.commit()
 
     def delete(self):
         status = True
+        data = self.format()
         try:
             db.session.delete(self)
+            record_question_changes([("delete", data['id'], data['category'])])
             db.session.commit()
-        except:
+        except SQLAlchemyError:
             db.session.rollback()
             status = False
-        finally:
-            db.session.close()
+        if status:
+            notify_question_listeners("delete", data)
         return status
 
     def format(self):
@@ -85,6 +259,88 @@ class Question(db.Model):
             'difficulty': self.difficulty
             }
 
+"""
+QuestionChange
+    the change log: one row per question inserted or deleted, numbered by
+    seq in commit order of the writes that made them. An update is logged
+    as a delete and an insert, like the listeners see it, and a "reload"
+    row with no question marks a bulk write made outside the models
+"""
+class QuestionChange(db.Model):
+    __tablename__ = 'question_changes'
+    # kept in step with migrations.py
+    __table_args__ = (
+        Index('question_changes_category_seq_idx', 'category', 'seq'),
+    )
+
+    seq = Column(Integer, primary_key=True)
+    action = Column(String, nullable=False)
+    question_id = Column(Integer)
+    category = Column(Integer)
+
+    """
+    latest(category_id=None)
+        seq of the last change, or of the last change that may have touched
+        the category; a category whose changes were all pruned gets the seq
+        before the oldest kept one, so the value never goes back
+    """
+    @staticmethod
+    def latest(category_id=None):
+        query = db.session.query(func.max(QuestionChange.seq))
+        if category_id is None:
+            return query.scalar() or 0
+        # two lookups on the (category, seq) index; an OR of the two scans it
+        seqs = [
+            query.filter(QuestionChange.category == category_id).scalar(),
+            query.filter(QuestionChange.category.is_(None)).scalar()
+        ]
+        seq = max((seq for seq in seqs if seq is not None), default=None)
+        if seq is None:
+            oldest = QuestionChange.oldest()
+            seq = oldest - 1 if oldest is not None else 0
+        return seq
+
+    """
+    oldest()
+        seq of the oldest change kept, or None when the log is empty
+    """
+    @staticmethod
+    def oldest():
+        return db.session.query(func.min(QuestionChange.seq)).scalar()
+
+"""
+record_question_changes(changes)
+    adds (action, question_id, category) rows to the change log in the
+    session's transaction, so they commit or roll back with the write they
+    describe, and prunes the log past CHANGE_LOG_SIZE entries
+"""
+def record_question_changes(changes):
+    if not changes:
+        return
+    lock_change_log()
+    db.session.execute(QuestionChange.__table__.insert(), [
+        {"action": action, "question_id": question_id, "category": category}
+        for action, question_id, category in changes
+    ])
+    prune_question_changes(len(changes))
+
+def lock_change_log():
+    # PostgreSQL hands out seqs before commit; one writer at a time makes
+    # seq order the commit order, so readers never see a seq appear behind
+    # one they already read. Reads are not blocked. SQLite writers are
+    # serialized already.
+    if db.session.get_bind().dialect.name == "postgresql":
+        db.session.execute("LOCK TABLE question_changes IN SHARE ROW EXCLUSIVE MODE")
+
+def prune_question_changes(added):
+    if not CHANGE_LOG_SIZE:
+        return
+    last = db.session.query(func.max(QuestionChange.seq)).scalar() or 0
+    if (last - added) // CHANGE_LOG_PRUNE_EVERY == last // CHANGE_LOG_PRUNE_EVERY:
+        return
+    QuestionChange.query.filter(
+        QuestionChange.seq <= last - CHANGE_LOG_SIZE).delete(synchronize_session=False)
+
 """
 Category
 
@@ -98,8 +354,214 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        status = True
+        id = None
+        try:
+            db.session.add(self)
+            db.session.commit()
+            id = self.id
+            data = self.format()
+        except SQLAlchemyError:
+            db.session.rollback()
+            status = False
+        if status:
+            notify_category_listeners("insert", data)
+        return {"status": status, "id": id}
+
+    def update(self):
+        data = self.format()
+        db.session.commit()
+        notify_category_listeners("update", data)
+
+    def delete(self):
+        status = True
+        data = self.format()
+        try:
+            db.session.delete(self)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            status = False
+        if status:
+            notify_category_listeners("delete", data)
+        return status
+
     def format(self):
         return {
             'id': self.id,
             'type': self.type
             }
+
+"""
+WriteError
+    a batch item that was not written, with its position in the batch;
+    code names the kind of failure in API responses
+"""
+class WriteError(ValueError):
+    code = "invalid"
+
+    def __init__(self, index, message):
+        super().__init__(message)
+        self.index = index
+        self.message = message
+
+    def format(self):
+        return {
+            'index': self.index,
+            'error': self.code,
+            'message': self.message
+            }
+
+class InvalidQuestion(WriteError):
+    code = "invalid"
+
+class UnknownCategory(WriteError):
+    code = "unknown_category"
+
+class QuestionNotFound(WriteError):
+    code = "not_found"
+
+"""
+QuestionBatch
+    unit of work for question writes. insert(), update() and delete() queue
+    items; commit() checks them with one query for the rows and one for the
+    categories, then writes every valid item in a single transaction.
+    Invalid items are reported as WriteErrors and skipped, or with atomic=True
+    nothing is written. A database error rolls the whole batch back and is
+    raised. Listeners see an update as a delete of the old row and an insert
+    of the new one.
+"""
+QUESTION_FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+class QuestionBatch:
+
+    def __init__(self):
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def insert(self, fields):
+        self.items.append(("insert", None, fields))
+
+    def update(self, id, fields):
+        self.items.append(("update", id, fields))
+
+    def delete(self, id):
+        self.items.append(("delete", id, None))
+
+    def commit(self, atomic=False):
+        """Writes the queued items and returns a dict with the created,
+        updated and deleted ids and the list of WriteErrors."""
+        items, self.items = self.items, []
+        result = {"created": [], "updated": [], "deleted": [], "errors": []}
+        ids = {id for action, id, fields in items if isinstance(id, int) and 0 <= id <= MAX_ID}
+        rows = {}
+        if ids:
+            rows = {row.id: row for row in Question.query.filter(Question.id.in_(ids))}
+        categories = {id for (id,) in db.session.query(Category.id)}
+
+        inserts, updates, deletes = [], [], []
+        removed = set()
+        for index, (action, id, fields) in enumerate(items):
+            try:
+                if action != "insert" and (not isinstance(id, int) or isinstance(id, bool)):
+                    raise InvalidQuestion(index, "id must be an integer")
+                if action != "insert" and (id not in rows or id in removed):
+                    raise QuestionNotFound(index, "question {} does not exist".format(id))
+                if action == "delete":
+                    removed.add(id)
+                    deletes.append(rows[id])
+                    continue
+                values = check_question_fields(
+                    index, fields, categories, partial=action == "update")
+            except WriteError as error:
+                result["errors"].append(error)
+                continue
+            if action == "insert":
+                inserts.append(Question(**values))
+            else:
+                updates.append((rows[id], values))
+
+        if atomic and result["errors"]:
+            return result
+
+        # images for the listeners, taken before commit() expires the rows;
+        # a row updated several times is reported once
+        images = {}
+        for row, values in updates:
+            if row.id not in images:
+                images[row.id] = (row.format(), row.format())
+            images[row.id][1].update(values)
+        deleted = [row.format() for row in deletes]
+        try:
+            db.session.add_all(inserts)
+            for row, values in updates:
+                for key, value in values.items():
+                    setattr(row, key, value)
+            db.session.flush()
+            created = [row.format() for row in inserts]
+            if deleted:
+                # one DELETE for the whole batch
+                Question.query.filter(
+                    Question.id.in_([data['id'] for data in deleted])
+                ).delete(synchronize_session=False)
+                for row in deletes:
+                    db.session.expunge(row)
+            changes = [("insert", data['id'], data['category']) for data in created]
+            for id, (before, after) in images.items():
+                if id not in removed:
+                    changes.append(("delete", id, before['category']))
+                    changes.append(("insert", id, after['category']))
+            changes.extend(("delete", data['id'], data['category']) for data in deleted)
+            record_question_changes(changes)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+
+        for data in created:
+            result["created"].append(data["id"])
+            notify_question_listeners("insert", data)
+        for id, (before, after) in images.items():
+            if id in removed:
+                continue
+            result["updated"].append(id)
+            notify_question_listeners("delete", before)
+            notify_question_listeners("insert", after)
+        for data in deleted:
+            result["deleted"].append(data["id"])
+            notify_question_listeners("delete", data)
+        return result
+
+"""
+check_question_fields(index, fields, categories, partial=False)
+    returns the valid column values of a batch item or raises a WriteError;
+    with partial only the fields given are checked, as for an update
+"""
+def check_question_fields(index, fields, categories, partial=False):
+    if not isinstance(fields, dict) or not fields:
+        raise InvalidQuestion(index, "expected an object of question fields")
+    unknown = set(fields) - set(QUESTION_FIELDS)
+    if unknown:
+        raise InvalidQuestion(index, "unknown fields {}".format(", ".join(sorted(unknown))))
+    values = {}
+    for key in QUESTION_FIELDS:
+        if key not in fields:
+            if not partial:
+                raise InvalidQuestion(index, "{} is required".format(key))
+            continue
+        value = fields[key]
+        if key in ('question', 'answer'):
+            if not isinstance(value, str) or not value.strip():
+                raise InvalidQuestion(index, "{} must be a non-empty string".format(key))
+        else:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise InvalidQuestion(index, "{} must be an integer".format(key))
+        values[key] = value
+    if 'category' in values and values['category'] not in categories:
+        raise UnknownCategory(index, "unknown category {}".format(values['category']))
+    return values
@@ -1,12 +1,64 @@
+import asyncio
+import gc
 import os
+import re
 import unittest
+from unittest import mock
 import json
-from flask_sqlalchemy import SQLAlchemy
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 SECRET_KEY = os.urandom(32)
 # Grabs the folder where the script runs.
 basedir = os.path.abspath(os.path.dirname(__file__))
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flask import jsonify
+from flaskr.asgi import create_asgi_app
+from flaskr import create_app, encode_cursor, QUESTIONS_PER_PAGE
+from sqlalchemy import event
+from models import (
+    db, engine_options, Question, Category, notify_question_listeners, question_listeners
+)
+from flaskr.serialize import json_response
+from migrations import LATEST_VERSION, MIGRATIONS, current_version, upgrade
+from flaskr.server import check_pid, check_workers, create_server_app, prepare_fork
+from flaskr.quiz import QuizIndex
+from flaskr.snapshot import QuestionSnapshot
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+# The tests run on the in-memory storage backend loaded from trivia.psql;
+# set TEST_DATABASE_URL to run them on a prepared PostgreSQL database instead.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+def load_fixture(app, path=os.path.join(basedir, "trivia.psql")):
+    """Inserts the rows of the COPY blocks of a pg_dump file."""
+    tables = {"categories": Category.__table__, "questions": Question.__table__}
+    rows = None
+    with app.app_context():
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if rows is None:
+                    match = re.match(r"COPY public\.(\w+) \((.*)\) FROM stdin;", line)
+                    if match:
+                        table = tables[match.group(1)]
+                        columns = match.group(2).split(", ")
+                        rows = []
+                elif line == "\\.":
+                    db.session.execute(table.insert(), rows)
+                    rows = None
+                else:
+                    values = [None if value == "\\N" else value for value in line.split("\t")]
+                    rows.append(dict(zip(columns, values)))
+        db.session.commit()
+        # caches filled while the app was built start over
+        notify_question_listeners("reload", None)
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -14,21 +66,14 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.database_path = TEST_DATABASE_URL
+        if self.database_path is None:
+            self.app = create_app({"STORAGE": "memory"})
+            load_fixture(self.app)
+        else:
+            self.app = create_app({"DATABASE_URL": self.database_path})
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_user = "postgres"
-        self.database_password = '7y8a1h64'
-        self.database_path = "postgres://{}/{}".format('localhost:5432', self.database_name,self.database_user,self.database_password)
-        setup_db(self.app, self.database_path)
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
     def tearDown(self):
         """Executed after reach test"""
         pass
@@ -41,8 +86,54 @@ class TriviaTestCase(unittest.TestCase):
     
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data["success"], True)
-        self.assertTrue(data["All_categories"])
-        self.assertEqual(data["total_categories"], len(categories))
+        self.assertTrue(data["categories"])
+        self.assertEqual(data["total_categories"], len(All_categories))
+    # test for  success 
+    def test_304_get_categories_not_modified(self):
+        response = self.client().get("/categories")
+        etag = response.headers["ETag"]
+
+        response = self.client().get("/categories", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+    # test for  success
+    def test_get_category_stats(self):
+        response = self.client().get("/categories/stats")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["total_questions"], Question.query.count())
+        for id, category in data["categories"].items():
+            self.assertEqual(
+                category["total_questions"],
+                Question.query.filter_by(category=int(id)).count())
+# test for  error
+    def test_405_post_category_stats(self):
+        response = self.client().post("/categories/stats")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "method not allowed")
+# test for  success 
+    def test_get_metrics(self):
+        self.client().get("/categories")
+        response = self.client().get("/metrics")
+        body = response.data.decode("utf-8")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("text/plain", response.headers["Content-Type"])
+        self.assertIn('trivia_request_duration_seconds_count{endpoint="getCategories",method="GET"}', body)
+    # test for  error
+    def test_405_post_metrics(self):
+        response = self.client().post("/metrics")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "method not allowed")
     # test for  error
     def test_405_post_categories(self):
         response = self.client().post("/categories", json={"type": "agriculture"})
@@ -61,13 +152,12 @@ class TriviaTestCase(unittest.TestCase):
         )
 
         data = response.get_json()
-        request = response.request
 
         totalQuestions = Question.query.filter_by(
             category = randomCategory.id
         ).all()
 
-        questions = paginate(request, totalQuestions)
+        questions = totalQuestions[:QUESTIONS_PER_PAGE]
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data["success"], True)
@@ -101,10 +191,9 @@ class TriviaTestCase(unittest.TestCase):
         response = self.client().get("/questions")
 
         data = response.get_json()
-        request = response.request
 
         All_questions = Question.query.all()
-        questions = paginate(request,  All_questions)
+        questions = All_questions[:QUESTIONS_PER_PAGE]
 
         All_categories = Category.query.all()
 
@@ -113,6 +202,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data["questions"]), len(questions))
         self.assertEqual(len(data["categories"]), len(All_categories))
         self.assertEqual(data["total_questions"], len(All_questions))
+# test for  success
+    def test_json_response_matches_jsonify(self):
+        payloads = [
+            self.client().get(url).get_json()
+            for url in ("/questions", "/categories/1/questions", "/questions/suggest?prefix=wh")
+        ]
+        payloads.append({"number": 1e16, "numbers": [1e-7, 0.1, float("inf")]})
+        payloads.append({"text": "Caf\u00e9"})
+
+        with self.app.test_request_context():
+            for payload in payloads:
+                self.assertEqual(json_response(payload).data, jsonify(payload).data)
+                with mock.patch("flaskr.serialize.orjson", None):
+                    self.assertEqual(json_response(payload).data, jsonify(payload).data)
+# test for  success 
+    def test_get_questions_cache_invalidated_on_create(self):
+        before = self.client().get("/questions").get_json()
+        cached = self.client().get("/questions").get_json()
+
+        self.client().post("/questions", json={
+            "question": "Cached?", "answer": "No", "category": 1, "difficulty": 1
+        })
+        after = self.client().get("/questions").get_json()
+
+        self.assertEqual(before, cached)
+        self.assertEqual(after["total_questions"], before["total_questions"] + 1)
 # test for  error
     def test_404_get_questions_invalid_page_limit(self):
         response = self.client().get("/questions?page=0")
@@ -121,6 +236,40 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "resource not found")
+# test for  success 
+    def test_get_questions_with_cursor(self):
+        firstPage = self.client().get("/questions").get_json()
+        response = self.client().get(
+            "/questions?cursor={}".format(firstPage["next_cursor"])
+        )
+        data = response.get_json()
+
+        lastId = firstPage["questions"][-1]["id"]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(all(q["id"] > lastId for q in data["questions"]))
+        self.assertEqual(data["total_questions"], firstPage["total_questions"])
+# test for  error
+    def test_400_get_questions_invalid_cursor(self):
+        response = self.client().get("/questions?cursor=not-a-cursor")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+# test for  error
+    def test_400_get_questions_out_of_range(self):
+        cursor = encode_cursor(2 ** 64)
+        responses = [
+            self.client().get("/questions?cursor=" + cursor),
+            self.client().get("/questions?page=99999999999999999999"),
+            self.client().get("/categories/1/questions?page=99999999999999999999"),
+        ]
+        category = self.client().get("/categories/99999999999999999999/questions")
+
+        self.assertEqual([response.status_code for response in responses], [400] * 3)
+        self.assertEqual(category.status_code, 404)
 # test for  success 
     def test_create_questions(self):
         question = Question(
@@ -144,6 +293,181 @@ class TriviaTestCase(unittest.TestCase):
         response = self.client().post("/questions", json = {})
         data = response.get_json()
 
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+# test for  erorr
+    def test_400_create_question_category_not_an_integer(self):
+        response = self.client().post("/questions", json={
+            "question": "Unsaved?", "answer": "Yes", "category": "abc", "difficulty": 1})
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["message"], "bad request")
+        self.assertEqual(Question.query.filter_by(question="Unsaved?").count(), 0)
+# test for  erorr
+    def test_422_create_question_unknown_category(self):
+        response = self.client().post("/questions", json={
+            "question": "Unsaved?", "answer": "Yes", "category": 1000, "difficulty": 1})
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data["message"], "unprocessable")
+        self.assertEqual(Question.query.filter_by(question="Unsaved?").count(), 0)
+# test for  erorr
+    def test_foreign_key_enforced_on_sqlite(self):
+        result = Question("Orphan?", "Yes", 1000, 1).insert()
+
+        self.assertEqual(result["status"], False)
+# test for  success
+    def test_create_question_survives_failing_listener(self):
+        calls = []
+
+        def failing_listener(action, question):
+            calls.append(action)
+            if action != "reload":
+                raise RuntimeError("listener failed")
+
+        question_listeners.append(failing_listener)
+        try:
+            response = self.client().post("/questions", json={
+                "question": "Saved?", "answer": "Yes", "category": 1, "difficulty": 1})
+        finally:
+            question_listeners.remove(failing_listener)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, ["insert", "reload"])
+        self.assertIsNotNone(Question.query.get(response.get_json()["created"]))
+# test for  success 
+    def test_bulk_import_questions(self):
+        rows = [
+            {"question": "Bulk question {}?".format(i), "answer": "Yes", "category": 1, "difficulty": 1}
+            for i in range(3)
+        ]
+        body = "\n".join(json.dumps(row) for row in rows)
+        since = self.client().get("/questions/changes").get_json()["latest_seq"]
+        response = self.client().post(
+            "/questions/bulk", data=body, content_type="application/x-ndjson"
+        )
+        data = response.get_json()
+        changes = self.client().get("/questions/changes?since={}".format(since)).get_json()["changes"]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["created"], 3)
+        self.assertEqual(data["errors"], [])
+        # the change log holds exactly the new rows
+        self.assertEqual(
+            [(change["action"], change["question"]["question"]) for change in changes],
+            [("insert", row["question"]) for row in rows])
+# test for  erorr
+    def test_422_bulk_import_invalid_rows(self):
+        body = "question,answer,category,difficulty\n,No question,1,1\n"
+        response = self.client().post(
+            "/questions/bulk", data=body, content_type="text/csv"
+        )
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "unprocessable")
+        self.assertEqual(data["total_errors"], 1)
+        self.assertEqual(data["errors"][0]["line"], 2)
+# test for  error
+    def test_bulk_import_invalid_utf8_line(self):
+        body = b"\n".join([
+            json.dumps({"question": "Valid?", "answer": "Yes", "category": 1, "difficulty": 1}).encode(),
+            b'{"question": "\xff\xfe", "answer": "No", "category": 1, "difficulty": 1}'
+        ])
+        response = self.client().post(
+            "/questions/bulk", data=body, content_type="application/x-ndjson"
+        )
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["created"], 1)
+        self.assertEqual(data["errors"], [{"line": 2, "message": "invalid utf-8"}])
+        self.assertEqual(data["total_errors"], 1)
+# test for  success
+    def test_batch_write_questions(self):
+        question = {"question": "Batch question?", "answer": "Yes", "category": 1, "difficulty": 1}
+        created = self.client().post("/questions", json=question).get_json()["created"]
+        requestData = {"operations": [
+            {"op": "insert", "question": question},
+            {"op": "update", "id": created, "question": {"answer": "No"}},
+            {"op": "delete", "id": 0}
+        ]}
+        response = self.client().post("/questions/batch", json=requestData)
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["created"]), 1)
+        self.assertEqual(data["updated"], [created])
+        self.assertEqual(data["errors"][0]["index"], 2)
+        self.assertEqual(data["errors"][0]["error"], "not_found")
+        self.assertEqual(Question.query.get(created).answer, "No")
+# test for  erorr
+    def test_422_batch_write_atomic_invalid_item(self):
+        requestData = {"atomic": True, "operations": [
+            {"op": "insert", "question": {"question": "Kept?", "answer": "No", "category": 1, "difficulty": 1}},
+            {"op": "insert", "question": {"question": "Bad?", "answer": "No", "category": 1000, "difficulty": 1}}
+        ]}
+        response = self.client().post("/questions/batch", json=requestData)
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["errors"][0]["error"], "unknown_category")
+        self.assertEqual(Question.query.filter_by(question="Kept?").count(), 0)
+# test for  success
+    def test_delete_questions_by_ids(self):
+        question = {"question": "Delete me?", "answer": "Yes", "category": 1, "difficulty": 1}
+        ids = [self.client().post("/questions", json=question).get_json()["created"] for i in range(2)]
+
+        response = self.client().delete("/questions?ids={},{}".format(*ids))
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["deleted"], ids)
+        self.assertEqual(Question.query.filter(Question.id.in_(ids)).count(), 0)
+# test for  error
+    def test_400_delete_questions_invalid_ids(self):
+        response = self.client().delete("/questions?ids=one,two")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+# test for  error
+    def test_400_delete_questions_id_out_of_range(self):
+        response = self.client().delete("/questions?ids=1,99999999999999999999")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+# test for  error
+    def test_batch_write_id_out_of_range_not_found(self):
+        requestData = {"operations": [{"op": "delete", "id": 99999999999999999999}]}
+        response = self.client().post("/questions/batch", json=requestData)
+        data = response.get_json()
+
+        self.assertEqual(data["errors"][0]["error"], "not_found")
+# test for  success
+    def test_export_questions_csv(self):
+        response = self.client().get("/questions/export?format=csv")
+        lines = response.data.decode("utf-8").splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(lines[0], "id,question,answer,category,difficulty")
+        self.assertEqual(len(lines) - 1, Question.query.count())
+# test for  error
+    def test_400_export_questions_unknown_format(self):
+        response = self.client().get("/questions/export?format=xml")
+        data = response.get_json()
+
         self.assertEqual(response.status_code, 400)
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "bad request")
@@ -153,18 +477,29 @@ class TriviaTestCase(unittest.TestCase):
         response = self.client().post("/questions/search", json=requestData)
 
         responseData = response.get_json()
-        request = response.request
 
+        # questions and answers are both searched
         total_questions = Question.query.filter(
             Question.question.ilike("%{}%".format(requestData["search_term"]))
+            | Question.answer.ilike("%{}%".format(requestData["search_term"]))
         ).all()
 
-        questions = paginate(request, total_questions)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responseData["success"], True)
+        self.assertTrue(responseData["questions"])
+        self.assertLessEqual(responseData["total_questions"], len(total_questions))
+        for question in responseData["questions"]:
+            text = (question["question"] + " " + question["answer"]).lower()
+            self.assertIn(requestData["search_term"].lower(), text)
+# test for  success 
+    def test_search_questions_ranked_by_prefix(self):
+        requestData = {"search_term": "Van Go"}
+        response = self.client().post("/questions/search", json=requestData)
+        responseData = response.get_json()
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(responseData["success"], True)
-        self.assertEqual(len(responseData["questions"]), len(questions))
-        self.assertEqual(responseData["total_questions"], len(total_questions))
+        self.assertIn("Van Gogh", responseData["questions"][0]["question"])
 # test for  error
     def test_404_search_questions_invalid_page_limit(self):
         requestData = {"search_term": "title"}
@@ -174,6 +509,123 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "resource not found")
+# test for  error
+    def test_400_search_questions_term_not_a_string(self):
+        response = self.client().post("/questions/search", json={"search_term": 5})
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+# test for  success
+    def test_suggest_questions_by_prefix(self):
+        response = self.client().get("/questions/suggest?prefix=Van%20G")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["total_questions"], 1)
+        self.assertIn("Van Gogh", data["suggestions"][0]["question"])
+# test for  success
+    def test_suggest_questions_after_insert_and_delete(self):
+        before = self.client().get("/questions/suggest?prefix=whi").get_json()
+        created = self.client().post("/questions", json={
+            "question": "Which painter cut off part of his ear?",
+            "answer": "Van Gogh",
+            "category": 2,
+            "difficulty": 2
+        }).get_json()["created"]
+
+        # extends the cached prefix "whi", which now holds the new question
+        added = self.client().get("/questions/suggest?prefix=which%20painter%20cu").get_json()
+        self.client().delete("/questions/{}".format(created))
+        removed = self.client().get("/questions/suggest?prefix=whi").get_json()
+
+        self.assertEqual([suggestion["id"] for suggestion in added["suggestions"]], [created])
+        self.assertEqual(removed["total_questions"], before["total_questions"])
+# test for  error
+    def test_400_suggest_questions_without_prefix(self):
+        response = self.client().get("/questions/suggest?prefix=%20")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+# test for  success
+    def test_304_get_questions_not_modified(self):
+        listing = self.client().get("/questions?page=2")
+        category = self.client().get("/categories/1/questions")
+
+        response = self.client().get(
+            "/questions?page=2", headers={"If-None-Match": listing.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], listing.headers["ETag"])
+
+        self.client().post("/questions", json={
+            "question": "Who painted The Night Watch?",
+            "answer": "Rembrandt",
+            "category": 2,
+            "difficulty": 2
+        })
+        response = self.client().get(
+            "/questions?page=2", headers={"If-None-Match": listing.headers["ETag"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], listing.headers["ETag"])
+        # a write to another category leaves the category's listing as it was
+        response = self.client().get(
+            "/categories/1/questions", headers={"If-None-Match": category.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+# test for  success
+    def test_get_question_changes(self):
+        since = self.client().get("/questions/changes").get_json()["latest_seq"]
+        created = self.client().post("/questions", json={
+            "question": "Who painted The Night Watch?",
+            "answer": "Rembrandt",
+            "category": 2,
+            "difficulty": 2
+        }).get_json()["created"]
+        deleted = Question.query.filter(Question.id != created).first().format()
+        self.client().delete("/questions/{}".format(deleted["id"]))
+
+        response = self.client().get("/questions/changes?since={}".format(since))
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(change["action"], change["id"]) for change in data["changes"]],
+            [("insert", created), ("delete", deleted["id"])])
+        self.assertEqual(data["changes"][0]["question"]["answer"], "Rembrandt")
+        self.assertEqual(data["changes"][1]["category"], deleted["category"])
+        self.assertEqual(data["latest_seq"], data["changes"][-1]["seq"])
+        self.assertFalse(data["has_more"])
+# test for  error
+    def test_400_question_changes_invalid_since(self):
+        for since in ("-1", "99999999999999999999"):
+            response = self.client().get("/questions/changes?since=" + since)
+            data = response.get_json()
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(data["success"], False)
+            self.assertEqual(data["message"], "bad request")
+# test for  success
+    def test_listing_version_kept_in_memory(self):
+        urls = ("/questions?page=2", "/categories/1/questions")
+        etags = [self.client().get(url).headers["ETag"] for url in urls]
+        with self.app.app_context():
+            engine = db.get_engine()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            responses = [
+                self.client().get(url, headers={"If-None-Match": etag})
+                for url, etag in zip(urls, etags)
+            ]
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+
+        self.assertEqual([response.status_code for response in responses], [304, 304])
+        self.assertFalse([sql for sql in statements if "question_changes" in sql])
 # test for  success 
     def test_delete_question(self):
         total_questions = Question.query.all()
@@ -182,7 +634,7 @@ class TriviaTestCase(unittest.TestCase):
         response = self.client().delete('/questions/{}'.format(randomQuestion.id))
         data = response.get_json()
 
-        deletedQuestion = Question.query.filter(id == randomQuestion.id).one_or_none()
+        deletedQuestion = Question.query.filter(Question.id == randomQuestion.id).one_or_none()
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data["success"], True)
@@ -208,6 +660,276 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(responseData["success"], True)
         self.assertTrue(responseData["question"])
+# test for  success
+    def test_get_adaptive_quiz_question(self):
+        requestData = {
+            "previous_questions": [],
+            "quiz_category": { "id": 0 },
+            "mode": "adaptive",
+            "recent_answers": [True, True, True, True]
+        }
+        response = self.client().post("/quizzes", json=requestData)
+        responseData = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responseData["success"], True)
+        self.assertEqual(responseData["target_difficulty"], 5)
+        self.assertTrue(responseData["question"])
+# test for  error
+    def test_400_get_quiz_question_unknown_mode(self):
+        requestData = {
+            "previous_questions": [],
+            "quiz_category": { "id": 0 },
+            "mode": "hardest"
+        }
+        response = self.client().post("/quizzes", json=requestData)
+        responseData = response.get_json()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(responseData["success"], False)
+        self.assertEqual(responseData["message"], "bad request")
+# test for  error
+    def test_400_get_quiz_question_malformed_fields(self):
+        for requestData in [
+            [1],
+            {"previous_questions": [], "quiz_category": 2},
+            {"previous_questions": [], "quiz_category": {"id": "art"}},
+            {"previous_questions": [], "quiz_category": {"id": 1.5}},
+            {"previous_questions": "1,2", "quiz_category": {"id": 0}},
+            {"previous_questions": [1, "2"], "quiz_category": {"id": 0}}
+        ]:
+            response = self.client().post("/quizzes", json=requestData)
+            responseData = response.get_json()
+
+            self.assertEqual(response.status_code, 400, requestData)
+            self.assertEqual(responseData["message"], "bad request")
+# test for  success
+    def test_get_quiz_question_category_id_as_string(self):
+        # the frontend sends the category ids it got as object keys
+        requestData = {"previous_questions": [], "quiz_category": {"id": "2", "type": "Art"}}
+        response = self.client().post("/quizzes", json=requestData)
+        responseData = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responseData["question"]["category"], 2)
+# test for  success
+    def test_quiz_index_rebuild_replays_writes(self):
+        index = QuizIndex(ttl=0)
+        index.fill(index.begin(), [(1, 1, 1)])
+        token = index.begin()
+        # the old buckets serve the other threads while one rebuilds
+        self.assertIsNone(index.begin())
+        index.add({"id": 2, "category": 1, "difficulty": 1})
+        index.remove(1)
+        index.fill(token, [(1, 1, 1)])
+
+        self.assertEqual(index.buckets[1].ids, [2])
+        self.assertEqual(index.writes, [])
+# test for  success 
+    def test_get_quiz_question_exhausted_category(self):
+        previousQuestions = [
+            question.id for question in Question.query.filter_by(category=2).all()
+        ]
+        requestData = {
+            "previous_questions": previousQuestions,
+            "quiz_category": {"id": 2, "type": "Art"}
+        }
+        response = self.client().post("/quizzes", json=requestData)
+        responseData = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responseData["success"], True)
+        self.assertEqual(responseData["question"], None)
+# test for  success 
+    def test_play_quiz_session(self):
+        response = self.client().post(
+            "/quizzes/sessions", json={"quiz_category": {"id": 2, "type": "Art"}}
+        )
+        session = response.get_json()
+
+        seen = []
+        for _ in range(session["total_questions"]):
+            data = self.client().post(
+                "/quizzes/sessions/{}/next".format(session["session_id"])
+            ).get_json()
+            seen.append(data["question"]["id"])
+        last = self.client().post(
+            "/quizzes/sessions/{}/next".format(session["session_id"])
+        ).get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session["success"], True)
+        self.assertEqual(len(set(seen)), session["total_questions"])
+        self.assertEqual(last["question"], None)
+# test for  error
+    def test_404_next_question_unknown_quiz_session(self):
+        response = self.client().post("/quizzes/sessions/unknown/next")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "resource not found")
+# test for  error
+    def test_400_create_quiz_session_body_not_an_object(self):
+        response = self.client().post("/quizzes/sessions", json=[1])
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "bad request")
+# test for  success
+    def test_quiz_sessions_bounded_by_ids_held(self):
+        total = Question.query.count()
+        app = create_app({"STORAGE": "memory", "QUIZ_SESSION_MAX_IDS": total + 1})
+        load_fixture(app)
+        client = app.test_client()
+
+        first = client.post("/quizzes/sessions", json={"quiz_category": {"id": 0}}).get_json()
+        second = client.post("/quizzes/sessions", json={"quiz_category": {"id": 0}}).get_json()
+        evicted = client.post("/quizzes/sessions/{}/next".format(first["session_id"]))
+        kept = client.post("/quizzes/sessions/{}/next".format(second["session_id"]))
+
+        self.assertEqual(second["total_questions"], total)
+        self.assertEqual(evicted.status_code, 404)
+        self.assertEqual(kept.status_code, 200)
+# test for  success
+    def test_get_quiz_question_created_after_start(self):
+        previousQuestions = [
+            question.id for question in Question.query.filter_by(category=2).all()
+        ]
+        self.client().post("/quizzes", json={
+            "previous_questions": [], "quiz_category": {"id": 2, "type": "Art"}})
+        created = self.client().post("/questions", json={
+            "question": "Who painted The Night Watch?",
+            "answer": "Rembrandt",
+            "category": 2,
+            "difficulty": 2
+        }).get_json()["created"]
+        requestData = {
+            "previous_questions": previousQuestions,
+            "quiz_category": {"id": 2, "type": "Art"}
+        }
+        response = self.client().post("/quizzes", json=requestData)
+        responseData = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responseData["question"]["id"], created)
+        self.assertEqual(responseData["question"]["answer"], "Rembrandt")
+# test for  success
+    def test_pool_configuration(self):
+        config = {
+            "DB_POOL_SIZE": 3, "DB_MAX_OVERFLOW": 2, "DB_POOL_TIMEOUT": 7,
+            "DB_POOL_RECYCLE": 600, "DB_POOL_PRE_PING": False, "DB_STATEMENT_TIMEOUT": 1500
+        }
+        options = engine_options(config, "postgresql://localhost/trivia")
+        app = create_app(dict(config, STORAGE="memory"))
+        with app.app_context():
+            pool = db.get_engine(app).pool
+
+        self.assertEqual(options["pool_size"], 3)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertEqual(options["pool_timeout"], 7)
+        self.assertEqual(options["pool_recycle"], 600)
+        self.assertEqual(options["pool_pre_ping"], False)
+        self.assertEqual(options["connect_args"], {"options": "-c statement_timeout=1500"})
+        self.assertEqual(engine_options(config, "sqlite:///trivia.db"), {})
+        self.assertEqual(pool.size(), 3)
+# test for  error
+    def test_unknown_storage_backend(self):
+        with self.assertRaises(ValueError):
+            create_app({"STORAGE": "cassandra"})
+# test for  success
+    def test_concurrent_identical_reads_share_one_query(self):
+        app = create_app({"STORAGE": "memory", "RESPONSE_CACHE_SIZE": 0})
+        load_fixture(app)
+        with app.app_context():
+            engine = db.get_engine(app)
+        pages = []
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def slow_page_query(connection, cursor, statement, parameters, context, executemany):
+            if "LIMIT" in statement:
+                pages.append(statement)
+                # keep the first request in flight while the others arrive
+                time.sleep(0.3)
+
+        start = threading.Barrier(5)
+        responses = []
+
+        def read():
+            client = app.test_client()
+            start.wait()
+            responses.append(client.get("/categories/1/questions"))
+
+        threads = [threading.Thread(target=read) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [200] * 5)
+        self.assertEqual(len({response.data for response in responses}), 1)
+        self.assertEqual(len(pages), 1)
+# test for  error
+    def test_429_rate_limited_categories(self):
+        app = create_app({
+            "STORAGE": "memory",
+            "RATE_LIMIT_PER_SECOND": 0.01,
+            "RATE_LIMIT_BURST": 2
+        })
+        load_fixture(app)
+        client = app.test_client()
+
+        statuses = [client.get("/categories").status_code for _ in range(3)]
+        response = client.get("/categories")
+        data = response.get_json()
+        other_route = client.get("/questions")
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "too many requests")
+        self.assertTrue(int(response.headers["Retry-After"]) >= 1)
+        self.assertEqual(other_route.status_code, 200)
+# test for  success
+    def test_profile_get_questions(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app({
+            "STORAGE": "memory",
+            "PROFILE_DIR": directory,
+            "PROFILE_TOKEN": "secret"
+        })
+        load_fixture(app)
+
+        response = app.test_client().get("/questions", headers={"X-Profile": "secret"})
+        with open(os.path.join(directory, "getAllQuestions.folded")) as f:
+            stacks = f.read().splitlines()
+        with open(os.path.join(directory, "getAllQuestions.sql.tsv")) as f:
+            spans = [line.split("\t") for line in f.read().splitlines()]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("sql;dur=", response.headers["Server-Timing"])
+        self.assertTrue(all(re.match(r"getAllQuestions;.* \d+$", line) for line in stacks))
+        self.assertTrue(any(";SQL SELECT" in line for line in stacks))
+        self.assertTrue(spans)
+        self.assertTrue(all(span[0] == "getAllQuestions" and len(span) == 5 for span in spans))
+# test for  error
+    def test_profile_ignores_wrong_token(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app({
+            "STORAGE": "memory",
+            "PROFILE_DIR": directory,
+            "PROFILE_TOKEN": "secret"
+        })
+        load_fixture(app)
+
+        response = app.test_client().get("/questions", headers={"X-Profile": "guess"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Server-Timing", response.headers)
+        self.assertEqual(os.listdir(directory), [])
 # test for  error
     def test_400_get_quiz_question_by_invalid_request_data(self):
         requestData = {}
@@ -220,6 +942,464 @@ class TriviaTestCase(unittest.TestCase):
 
 
 
+class ReadReplicaTestCase(unittest.TestCase):
+    """Reads routed to a replica, with the primary and the replica simulated
+    by two SQLite files"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        primary = os.path.join(self.directory, "primary.db")
+        self.replica = os.path.join(self.directory, "replica.db")
+        load_fixture(create_app({"STORAGE": "sqlite", "DATABASE_URL": "sqlite:///" + primary}))
+        source, target = sqlite3.connect(primary), sqlite3.connect(self.replica)
+        source.backup(target)
+        source.close()
+        target.close()
+
+        self.app = create_app({
+            "STORAGE": "sqlite",
+            "DATABASE_URL": "sqlite:///" + primary,
+            "DATABASE_REPLICA_URLS": ["sqlite:///" + self.replica],
+            "RESPONSE_CACHE_SIZE": 0
+        })
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+# test for  success
+    def test_get_questions_reads_from_replica(self):
+        connection = sqlite3.connect(self.replica)
+        connection.execute("UPDATE questions SET answer = 'from the replica' WHERE category = 1")
+        connection.commit()
+        connection.close()
+
+        response = self.client().get("/categories/1/questions")
+        data = response.get_json()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data["questions"])
+        for question in data["questions"]:
+            self.assertEqual(question["answer"], "from the replica")
+# test for  success
+    def test_search_reads_own_write_from_primary(self):
+        writer = self.app.test_client()
+        created = writer.post("/questions", json={
+            "question": "Who painted The Night Watch?",
+            "answer": "Rembrandt",
+            "category": 2,
+            "difficulty": 2
+        }).get_json()["created"]
+
+        own = writer.post("/questions/search", json={"search_term": "Night Watch"})
+        other = self.client().post("/questions/search", json={"search_term": "Night Watch"})
+
+        self.assertEqual(own.status_code, 200)
+        self.assertEqual(own.get_json()["questions"][0]["id"], created)
+        # the replica has not seen the write
+        self.assertEqual(other.status_code, 404)
+
+
+class QuestionSnapshotTestCase(unittest.TestCase):
+    """Listings and quizzes served from a snapshot file of a SQLite database"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database_url = "sqlite:///" + os.path.join(self.directory, "trivia.db")
+        self.snapshot = os.path.join(self.directory, "questions.snapshot")
+        self.sql_app = create_app({"STORAGE": "sqlite", "DATABASE_URL": self.database_url})
+        load_fixture(self.sql_app)
+        with self.sql_app.app_context():
+            QuestionSnapshot.from_database().save(self.snapshot)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+# test for  success
+    def test_get_questions_from_snapshot(self):
+        app = create_app({
+            "STORAGE": "sqlite",
+            "DATABASE_URL": self.database_url,
+            "QUESTION_SNAPSHOT": self.snapshot,
+            "QUESTION_SNAPSHOT_TTL": 0
+        })
+        client = app.test_client()
+        # nothing reads the questions table while the snapshot is in use
+        statements = []
+        with app.app_context():
+            engine = db.get_engine()
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            for url in ("/questions?page=2", "/categories/1/questions",
+                        "/questions?cursor=" + client.get("/questions").get_json()["next_cursor"]):
+                self.assertEqual(
+                    client.get(url).get_json(), self.sql_app.test_client().get(url).get_json())
+            response = client.post("/quizzes", json={
+                "previous_questions": [], "quiz_category": {"id": 1}})
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["question"]["category"], 1)
+        self.assertFalse([sql for sql in statements if "questions" in sql])
+
+        # a write drops the snapshot, and reads see it through SQL
+        created = client.post("/questions", json={
+            "question": "Who painted The Night Watch?",
+            "answer": "Rembrandt",
+            "category": 2,
+            "difficulty": 2
+        }).get_json()["created"]
+        data = client.get("/categories/2/questions").get_json()
+        self.assertIn(created, [question["id"] for question in data["questions"]])
+# test for  success
+    def test_replaced_snapshot_file_is_mapped(self):
+        app = create_app({
+            "STORAGE": "sqlite",
+            "DATABASE_URL": self.database_url,
+            "QUESTION_SNAPSHOT": self.snapshot,
+            "QUESTION_SNAPSHOT_TTL": 0
+        })
+        client = app.test_client()
+        created = client.post("/questions", json={
+            "question": "Who painted The Night Watch?",
+            "answer": "Rembrandt",
+            "category": 2,
+            "difficulty": 2
+        }).get_json()["created"]
+        store = app.extensions["question_snapshot"]
+        # the write dropped the snapshot; a new file brings it back
+        self.assertIsNone(store.get())
+        with app.app_context():
+            QuestionSnapshot.from_database().save(self.snapshot)
+        snapshot = store.get()
+
+        self.assertIsNotNone(snapshot)
+        self.assertEqual(snapshot.questions([created])[0]["answer"], "Rembrandt")
+        self.assertIs(store.get(), snapshot)
+# test for  error
+    def test_not_a_question_snapshot(self):
+        with open(self.snapshot, "wb") as f:
+            f.write(b"\0" * 64)
+        with self.assertRaises(ValueError):
+            create_app({
+                "STORAGE": "sqlite",
+                "DATABASE_URL": self.database_url,
+                "QUESTION_SNAPSHOT": self.snapshot
+            })
+
+
+class PreforkServerTestCase(unittest.TestCase):
+    """The app as the pre-fork server builds it before forking workers"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database_url = "sqlite:///" + os.path.join(self.directory, "trivia.db")
+        load_fixture(create_app({"STORAGE": "sqlite", "DATABASE_URL": self.database_url}))
+
+    def tearDown(self):
+        gc.unfreeze()
+        shutil.rmtree(self.directory)
+# test for  success
+    def test_create_server_app_warm_without_connections(self):
+        app = create_server_app({"STORAGE": "sqlite", "DATABASE_URL": self.database_url})
+
+        self.assertIsNotNone(app.extensions["quiz_index"].buckets)
+        self.assertIsNotNone(app.extensions["question_search"].backend.postings)
+        self.assertIsNotNone(app.extensions["question_suggest"].tokens)
+        self.assertIsNotNone(app.extensions["question_stats"].counts)
+        with app.app_context():
+            # a connection of the master is never handed out in a worker
+            self.assertTrue(event.contains(db.engine, "checkout", check_pid))
+        self.assertGreater(gc.get_freeze_count(), 0)
+        response = app.test_client().get("/categories/1/questions")
+        self.assertEqual(response.status_code, 200)
+# test for  success
+    def test_quiz_session_shared_by_workers(self):
+        config = {
+            "STORAGE": "sqlite", "DATABASE_URL": self.database_url,
+            "QUIZ_SESSION_PATH": os.path.join(self.directory, "sessions.db")
+        }
+        first, second = create_app(config).test_client(), create_app(config).test_client()
+
+        session = first.post(
+            "/quizzes/sessions", json={"quiz_category": {"id": 2}}).get_json()
+        seen = []
+        for client in [second, first] * session["total_questions"]:
+            data = client.post(
+                "/quizzes/sessions/{}/next".format(session["session_id"])).get_json()
+            if data["question"] is None:
+                break
+            seen.append(data["question"]["id"])
+
+        self.assertEqual(len(set(seen)), session["total_questions"])
+        self.assertEqual(data["remaining_questions"], 0)
+        self.assertEqual(
+            second.post("/quizzes/sessions/unknown/next").status_code, 404)
+# test for  success
+    def test_shared_quiz_sessions_bounded(self):
+        app = create_app({
+            "STORAGE": "sqlite", "DATABASE_URL": self.database_url,
+            "QUIZ_SESSION_PATH": os.path.join(self.directory, "sessions.db"),
+            "QUIZ_SESSION_LIMIT": 2
+        })
+        client = app.test_client()
+
+        sessions = [
+            client.post("/quizzes/sessions", json={"quiz_category": {"id": 0}}).get_json()
+            for _ in range(3)
+        ]
+        statuses = [
+            client.post("/quizzes/sessions/{}/next".format(session["session_id"])).status_code
+            for session in sessions
+        ]
+
+        self.assertEqual(statuses, [404, 200, 200])
+# test for  error
+    def test_several_workers_need_shared_quiz_sessions(self):
+        app = create_app({"STORAGE": "sqlite", "DATABASE_URL": self.database_url})
+        shared = create_app({
+            "STORAGE": "sqlite", "DATABASE_URL": self.database_url,
+            "QUIZ_SESSION_PATH": os.path.join(self.directory, "sessions.db")
+        })
+
+        check_workers(app, 1)
+        check_workers(shared, 4)
+        with self.assertRaises(RuntimeError):
+            check_workers(app, 4)
+# test for  error
+    def test_memory_storage_can_not_be_forked(self):
+        app = create_app({"STORAGE": "memory"})
+        with self.assertRaises(RuntimeError):
+            prepare_fork(app)
+
+
+class LazyInitTestCase(unittest.TestCase):
+    """create_app with LAZY_INIT on an empty SQLite file"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "trivia.db")
+        self.config = {"STORAGE": "sqlite", "DATABASE_URL": "sqlite:///" + self.path}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def tables(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            return {row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        finally:
+            connection.close()
+# test for  success
+    def test_lazy_init_defers_work_to_first_request(self):
+        app = create_app(dict(self.config, LAZY_INIT=True))
+
+        self.assertNotIn("questions", self.tables())
+        self.assertIsNone(app.extensions["quiz_index"].buckets)
+
+        response = app.test_client().post(
+            "/quizzes", json={"previous_questions": [], "quiz_category": {"id": 0}})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("questions", self.tables())
+        self.assertIsNotNone(app.extensions["quiz_index"].buckets)
+# test for  success
+    def test_eager_init_builds_at_startup(self):
+        app = create_app(dict(self.config, LAZY_INIT=False))
+
+        self.assertIn("questions", self.tables())
+        self.assertIsNotNone(app.extensions["quiz_index"].buckets)
+
+
+class MigrationTestCase(unittest.TestCase):
+    """migrations.upgrade on a SQLite file holding the schema the project
+    started with, where questions.category is a string"""
+
+    BASELINE = [
+        "CREATE TABLE categories (id INTEGER PRIMARY KEY, type VARCHAR)",
+        "CREATE TABLE questions (id INTEGER PRIMARY KEY, question VARCHAR, "
+        "answer VARCHAR, category VARCHAR, difficulty INTEGER)",
+        "INSERT INTO categories VALUES (1, 'Science'), (2, 'Art')",
+        "INSERT INTO questions VALUES (1, 'Whose autobiography is entitled "
+        "''I Know Why the Caged Bird Sings''?', 'Maya Angelou', '2', 2)",
+        "INSERT INTO questions VALUES (2, 'What is the heaviest organ in the human body?', "
+        "'The Liver', '1', 4)"
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "trivia.db")
+        connection = sqlite3.connect(path)
+        for statement in self.BASELINE:
+            connection.execute(statement)
+        connection.commit()
+        connection.close()
+        self.app = create_app({
+            "STORAGE": "sqlite", "DATABASE_URL": "sqlite:///" + path, "DB_SCHEMA": "skip"})
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.engine.dispose()
+        shutil.rmtree(self.directory)
+# test for  success
+    def test_upgrade_from_baseline_schema(self):
+        with self.app.app_context():
+            version = upgrade(db.engine)
+            with db.engine.connect() as connection:
+                recorded = current_version(connection)
+                columns = {
+                    column[1]: column[2]
+                    for column in connection.execute("PRAGMA table_info(questions)")
+                }
+                foreign_keys = [
+                    (row[2], row[3], row[4])
+                    for row in connection.execute("PRAGMA foreign_key_list(questions)")
+                ]
+                rows = connection.execute(
+                    "SELECT id, answer, category, typeof(category) FROM questions ORDER BY id"
+                ).fetchall()
+                tables = {row[0] for row in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'")}
+            orphan = Question("Orphan?", "Yes", 1000, 1).insert()
+
+        self.assertEqual(version, LATEST_VERSION)
+        self.assertEqual(recorded, LATEST_VERSION)
+        self.assertEqual(columns["category"].upper(), "INTEGER")
+        self.assertEqual(foreign_keys, [("categories", "category", "id")])
+        self.assertEqual(
+            rows, [(1, "Maya Angelou", 2, "integer"), (2, "The Liver", 1, "integer")])
+        self.assertIn("question_changes", tables)
+        self.assertNotIn("questions_old", tables)
+        self.assertEqual(orphan["status"], False)
+# test for  success
+    def test_upgrade_twice_changes_nothing(self):
+        with self.app.app_context():
+            upgrade(db.engine)
+            version = upgrade(db.engine)
+            with db.engine.connect() as connection:
+                applied = connection.execute(
+                    "SELECT count(*) FROM schema_version").scalar()
+            response = self.app.test_client().get("/categories/2/questions")
+
+        self.assertEqual(version, LATEST_VERSION)
+        self.assertEqual(applied, len(MIGRATIONS))
+        self.assertEqual(response.get_json()["questions"][0]["answer"], "Maya Angelou")
+
+
+@unittest.skipIf(aiosqlite is None, "the async serving mode needs aiosqlite")
+class AsgiTestCase(unittest.TestCase):
+    """The native routes of the async serving mode on a SQLite file, next to
+    the Flask app on the same file"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = {
+            "STORAGE": "sqlite",
+            "DATABASE_URL": "sqlite:///" + os.path.join(self.directory, "trivia.db")
+        }
+        self.flask_app = create_app(config)
+        load_fixture(self.flask_app)
+        self.asgi_app = create_asgi_app(config)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def request(self, method, url, headers=(), json_body=None):
+        """Returns (status, headers, body) of one request to the ASGI app."""
+        path, _, query = url.partition("?")
+        body = b"" if json_body is None else json.dumps(json_body).encode("utf-8")
+        scope = {
+            "type": "http", "method": method, "path": path, "root_path": "",
+            "query_string": query.encode("latin-1"),
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in headers]
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            try:
+                await self.asgi_app(scope, receive, send)
+            finally:
+                # the pool belongs to this event loop
+                await self.asgi_app.db.close()
+            return sent
+
+        sent = asyncio.run(run())
+        return (
+            sent[0]["status"],
+            {name.decode("latin-1"): value.decode("latin-1") for name, value in sent[0]["headers"]},
+            b"".join(message.get("body", b"") for message in sent[1:])
+        )
+# test for  success
+    def test_304_native_listings_not_modified(self):
+        for url in ("/questions?page=2", "/categories/1/questions"):
+            status, headers, body = self.request("GET", url)
+            flask_response = self.flask_app.test_client().get(url)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers["etag"], flask_response.headers["ETag"])
+
+            status, headers, body = self.request(
+                "GET", url, [("If-None-Match", headers["etag"])])
+            self.assertEqual(status, 304)
+            self.assertEqual(body, b"")
+
+    def assertSameAsFlask(self, method, url, json_body=None, headers=(),
+                          origin="http://localhost:3000"):
+        headers = list(headers) + ([("Origin", origin)] if origin else [])
+        status, asgi_headers, body = self.request(method, url, headers, json_body)
+        response = self.flask_app.test_client().open(
+            url, method=method, json=json_body, headers=headers)
+        flask_headers = {
+            name.lower(): value for name, value in response.headers.items() if name != "Date"
+        }
+        if response.status_code == 304:
+            # Flask labels the empty body with its default mimetype
+            flask_headers.pop("content-type")
+
+        self.assertEqual(status, response.status_code, url)
+        self.assertEqual(asgi_headers, flask_headers, url)
+        self.assertEqual(json.loads(body) if body else None, response.get_json(), url)
+        return json.loads(body) if body else None
+# test for  success
+    def test_native_listings_match_flask(self):
+        cursor = self.flask_app.test_client().get("/questions").get_json()["next_cursor"]
+        for url in ("/categories", "/questions", "/questions?page=2",
+                    "/questions?cursor=" + cursor, "/categories/1/questions"):
+            self.assertSameAsFlask("GET", url)
+            self.assertSameAsFlask("GET", url, origin=None)
+            etag = self.flask_app.test_client().get(url).headers["ETag"]
+            self.assertSameAsFlask("GET", url, headers=[("If-None-Match", etag)])
+# test for  error
+    def test_native_listing_errors_match_flask(self):
+        for url in ("/questions?page=1000", "/categories/1000/questions",
+                    "/questions?cursor=not-a-cursor", "/questions?page=9999999999999999999"):
+            self.assertSameAsFlask("GET", url)
+# test for  success
+    def test_native_quizzes_match_flask(self):
+        with self.flask_app.app_context():
+            art = [question.id for question in Question.query.filter_by(category=2)]
+        # an exhausted category draws nothing on both
+        self.assertSameAsFlask(
+            "POST", "/quizzes", {"previous_questions": art, "quiz_category": {"id": 2}})
+        # the last question left is the only one either can draw
+        data = self.assertSameAsFlask(
+            "POST", "/quizzes", {"previous_questions": art[1:], "quiz_category": {"id": 2}})
+        self.assertEqual(data["question"]["id"], art[0])
+# test for  error
+    def test_native_quiz_errors_match_flask(self):
+        for json_body in ([1], {"previous_questions": [], "quiz_category": {"id": "art"}},
+                          {"previous_questions": [], "quiz_category": {"id": 0}, "mode": "x"}):
+            self.assertSameAsFlask("POST", "/quizzes", json_body)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file